@@ -123,6 +123,14 @@ class Sequence(Node):
         for n in self.__seq:
             n.setTag(tag)
 
+    async def cycle_start(self):
+        for n in self.__seq:
+            await n.cycle_start()
+
+    async def cycle_end(self):
+        for n in self.__seq:
+            await n.cycle_end()
+
     async def call(self, item):
         async def _call(item, i: int):
             if item is None:
@@ -147,6 +155,12 @@ class FilterFeeder(Feeder):
         super().__init__()
         self.__seq = Sequence(base_feeder, filter)
 
+    async def cycle_start(self):
+        await self.__seq.cycle_start()
+
+    async def cycle_end(self):
+        await self.__seq.cycle_end()
+
     async def get_feeds(self):
         """
         带过滤的Feeder的Feed过程
@@ -171,6 +185,12 @@ class AmplifierFeeder(Feeder):
         self.__base_feeder.setTag(tag)
         self.__ampl_tag = tag
 
+    async def cycle_start(self):
+        await self.__base_feeder.cycle_start()
+
+    async def cycle_end(self):
+        await self.__base_feeder.cycle_end()
+
     async def get_feeds(self):
         async for item in self.__base_feeder.get_feeds():  # 获取基本Feeder里的item
             try:
@@ -200,6 +220,12 @@ class FilterDownloader(Downloader):
         super().__init__()
         self.__seq = Sequence(filter, base_downloader)
 
+    async def cycle_start(self):
+        await self.__seq.cycle_start()
+
+    async def cycle_end(self):
+        await self.__seq.cycle_end()
+
     async def download(self, item):
         """
         带过滤的Downloader的Download过程
@@ -217,6 +243,12 @@ class CallbackDownloader(Downloader):
         super().__init__()
         self.__seq = Sequence(base_downloader, callback)
 
+    async def cycle_start(self):
+        await self.__seq.cycle_start()
+
+    async def cycle_end(self):
+        await self.__seq.cycle_end()
+
     async def download(self, item):
         """
         如果不是为了兼容，谁想写这个功能完全没变的class
@@ -236,6 +268,12 @@ class FilterCallbackDownloader(Downloader):
         super().__init__()
         self.__seq = Sequence(filter, base_downloader, callback)
 
+    async def cycle_start(self):
+        await self.__seq.cycle_start()
+
+    async def cycle_end(self):
+        await self.__seq.cycle_end()
+
     async def download(self, item):
         """
         过滤+回调
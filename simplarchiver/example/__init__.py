@@ -1,6 +1,7 @@
 from .sleep import SleepFeeder, SleepDownloader, SleepFliter, SleepAmplifier
 from .random import RandomFeeder, RandomFilterFeeder, RandomFilterDownloader
 from .just import JustDownloader, JustLogCallbackDownloader
-from .subprocess import SubprocessDownloader
+from .subprocess import SubprocessDownloader, SubprocessWorkerDownloader
 from .exception import ExceptionFilterFeeder, ExceptionFilterDownloader, ExceptionCallbackDownloader
 from .exception import ExceptionFilterCallbackDownloader
+from .admission import AdmissionController, AdmissionDownloader, AdmissionFilterDownloader, admission_controller
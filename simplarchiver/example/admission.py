@@ -0,0 +1,293 @@
+import asyncio
+import os
+import time
+import weakref
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from typing import Dict, Optional, Tuple
+
+from simplarchiver import Logger, Filter, Downloader, FilterDownloader
+
+
+def read_file(path: str) -> Optional[str]:
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class SystemLoad:
+    """
+    读取系统负载，只在Linux上有，读不到的项都是None
+    cgroup v2和v1都支持，在容器里时用cgroup的CPU配额和内存上限
+    有CPU配额时负载从cgroup自己的读数算，loadavg是整台机器的，和配额没有关系
+    """
+
+    def __init__(self, proc: str = '/proc', cgroup: str = '/sys/fs/cgroup'):
+        self.__proc = proc
+        self.__cgroup = cgroup
+        self.__last_cpu = None  # 上一次cgroup_cpu的读数和读的时间
+
+    def loadavg(self) -> Optional[float]:
+        """整台机器最近1分钟的平均负载"""
+        text = read_file(os.path.join(self.__proc, 'loadavg'))
+        return float(text.split()[0]) if text else None
+
+    def cpus(self) -> int:
+        """整台机器的CPU数，loadavg要除以它"""
+        return os.cpu_count() or 1
+
+    def quota(self) -> Optional[float]:
+        """cgroup的CPU配额相当于几个CPU，没有配额时返回None"""
+        text = read_file(os.path.join(self.__cgroup, 'cpu.max'))  # v2: "quota period"或"max period"
+        if text and not text.startswith('max'):
+            quota, period = text.split()
+            return int(quota) / int(period)
+        quota = read_file(os.path.join(self.__cgroup, 'cpu', 'cpu.cfs_quota_us'))  # v1
+        period = read_file(os.path.join(self.__cgroup, 'cpu', 'cpu.cfs_period_us'))
+        if quota and period and int(quota) > 0:
+            return int(quota) / int(period)
+        return None
+
+    def cgroup_cpu(self) -> Tuple[Optional[float], Optional[int], Optional[int]]:
+        """cgroup一共用了多少CPU秒、过了几个配额周期、其中几个周期被限流了"""
+        stat = {}
+        for path in ['cpu.stat', os.path.join('cpu', 'cpu.stat')]:  # v2, v1
+            for line in (read_file(os.path.join(self.__cgroup, path)) or '').splitlines():
+                name, _, value = line.partition(' ')
+                if value.strip().isdigit():
+                    stat[name] = int(value)
+        usage = stat['usage_usec'] / 1e6 if 'usage_usec' in stat else None
+        if usage is None:
+            text = read_file(os.path.join(self.__cgroup, 'cpuacct', 'cpuacct.usage'))  # v1，单位是纳秒
+            usage = int(text) / 1e9 if text and text.strip().isdigit() else None
+        return usage, stat.get('nr_periods'), stat.get('nr_throttled')
+
+    def cpu_pressure(self) -> Optional[float]:
+        """cgroup v2的cpu.pressure里最近10秒有任务在等CPU的时间比例"""
+        for line in (read_file(os.path.join(self.__cgroup, 'cpu.pressure')) or '').splitlines():
+            fields = line.split()
+            if len(fields) > 0 and fields[0] == 'some':
+                for field in fields[1:]:
+                    name, _, value = field.partition('=')
+                    if name == 'avg10':
+                        return float(value) / 100
+        return None
+
+    def cgroup_load(self, quota: float) -> Optional[float]:
+        """
+        用cgroup自己的读数估计每个配额CPU的负载：用掉的CPU占配额的比例，加上有任务在等CPU的时间比例
+        等CPU的时间比例用cpu.pressure，没有(cgroup v1)就用两次读数之间被限流的周期的比例
+        用掉的CPU要和上一次读数比，第一次读时返回None
+        """
+        now = time.monotonic()
+        usage, periods, throttled = self.cgroup_cpu()
+        last, self.__last_cpu = self.__last_cpu, (now, usage, periods, throttled)
+        if last is None or usage is None or last[1] is None or now <= last[0]:
+            return None
+        last_time, last_usage, last_periods, last_throttled = last
+        load = (usage - last_usage) / (now - last_time) / quota
+        waiting = self.cpu_pressure()
+        if waiting is None and None not in (periods, throttled, last_periods, last_throttled) \
+                and periods > last_periods:
+            waiting = (throttled - last_throttled) / (periods - last_periods)
+        return load + (waiting or 0)
+
+    def meminfo(self) -> Dict[str, int]:
+        """/proc/meminfo，单位是字节"""
+        info = {}
+        for line in (read_file(os.path.join(self.__proc, 'meminfo')) or '').splitlines():
+            name, _, value = line.partition(':')
+            value = value.split()
+            if len(value) > 0 and value[0].isdigit():
+                info[name] = int(value[0]) * (1024 if len(value) > 1 and value[1] == 'kB' else 1)
+        return info
+
+    def cgroup_memory(self) -> Tuple[Optional[int], Optional[int]]:
+        """cgroup里用了多少内存和上限，不算可以随时回收的文件缓存，没有上限时返回(None, None)"""
+        for current, limit, stat in [('memory.current', 'memory.max', 'memory.stat'),  # v2
+                                     ('memory/memory.usage_in_bytes', 'memory/memory.limit_in_bytes',
+                                      'memory/memory.stat')]:  # v1
+            limit = read_file(os.path.join(self.__cgroup, limit))
+            current = read_file(os.path.join(self.__cgroup, current))
+            if limit is None or current is None or not limit.strip().isdigit():
+                continue
+            limit = int(limit)
+            if limit >= 1 << 60:  # v1没有上限时是一个很大的数
+                return None, None
+            usage = int(current)
+            for line in (read_file(os.path.join(self.__cgroup, stat)) or '').splitlines():
+                name, _, value = line.partition(' ')
+                if name in ('inactive_file', 'total_inactive_file'):
+                    usage -= int(value)
+            return max(usage, 0), limit
+        return None, None
+
+    def sample(self) -> Tuple[Optional[float], Optional[float]]:
+        """返回 (每个CPU的平均负载, 可用内存的比例)"""
+        quota = self.quota()
+        if quota is not None:
+            load = self.cgroup_load(quota)
+        else:
+            load = self.loadavg()
+            load = load / self.cpus() if load is not None else None
+        available = None
+        info = self.meminfo()
+        if 'MemAvailable' in info and info.get('MemTotal', 0) > 0:
+            available = info['MemAvailable'] / info['MemTotal']
+        usage, limit = self.cgroup_memory()
+        if limit is not None and limit > 0:
+            cg_available = (limit - usage) / limit
+            available = cg_available if available is None else min(available, cg_available)
+        return load, available
+
+
+class AdmissionController(Logger):
+    """
+    按系统负载决定什么时候开始新的下载，好几个Pair共用一个就能让整台机器不超负荷
+    每个CPU的平均负载超过max_load或是可用内存比例低于min_available_memory时不放新的下载进来
+    loadavg是1分钟的平均值，反应很慢，所以每隔admit_interval最多放一个进来，不会在负载还没涨上来时一下放进去一大堆
+    同时在跑的少于min_running个时不看负载直接放，保证不会全部卡住；AdmissionFilter不占名额，对它不起作用
+    """
+
+    def __init__(self, max_load: float = 1.0, min_available_memory: float = 0.1,
+                 min_running: int = 1, max_running: int = None,
+                 admit_interval: timedelta = timedelta(seconds=1), poll_interval: timedelta = timedelta(seconds=1),
+                 system_load: SystemLoad = None):
+        """
+        max_load是每个CPU的平均负载上限，min_available_memory是可用内存比例的下限
+        min_running和max_running是同时在跑的下载数的下限和上限，max_running为None表示不限
+        poll_interval是超负荷时多久再看一次
+        system_load是读取系统负载的，为None就读本机的
+        """
+        super().__init__()
+        self.__max_load = max_load
+        self.__min_available_memory = min_available_memory
+        self.__min_running = min_running
+        self.__max_running = max_running
+        self.__admit_interval = admit_interval.total_seconds()
+        self.__poll_interval = poll_interval.total_seconds()
+        self.__system_load = system_load if system_load is not None else SystemLoad()
+        self.__locks = weakref.WeakKeyDictionary()  # 事件循环 -> (acquire用的asyncio.Lock, admit用的asyncio.Lock)
+        self.__sample: Tuple[Optional[float], Optional[float]] = (None, None)
+        self.__sampled = 0.0
+        self.__last_admit = 0.0
+        self.__overloaded = None  # 上次看到的超负荷原因，变了才打日志
+        self.running = 0  # 正在跑的下载数
+        self.admitted = 0  # 一共放进去了多少个
+
+    def __lock(self, counted: bool) -> asyncio.Lock:
+        """acquire和admit各自排队，一边排队等负载降下来时不挡着另一边"""
+        loop = asyncio.get_running_loop()
+        if loop not in self.__locks:
+            self.__locks[loop] = (asyncio.Lock(), asyncio.Lock())
+        return self.__locks[loop][0 if counted else 1]
+
+    def overloaded(self) -> Optional[str]:
+        """超负荷就返回原因，没有就返回None，读数最多每poll_interval更新一次"""
+        now = time.monotonic()
+        if now - self.__sampled >= self.__poll_interval:
+            self.__sample, self.__sampled = self.__system_load.sample(), now
+        load, available = self.__sample
+        if load is not None and load > self.__max_load:
+            return "load %.2f per cpu > %.2f" % (load, self.__max_load)
+        if available is not None and available < self.__min_available_memory:
+            return "available memory %.1f%% < %.1f%%" % (available * 100, self.__min_available_memory * 100)
+        return None
+
+    async def __wait(self, counted: bool):
+        """
+        等到可以放一个新的下载进来，counted为True时算在running里
+        不算在running里的(AdmissionFilter)不知道下载什么时候结束，所以不看min_running和max_running，只看负载和admit_interval
+        同一种的排成一队按顺序放，排在最前面的拿着这一队的锁轮询，另一队和不用排队的不受影响
+        """
+        if counted and self.running < self.__min_running:  # 不看负载也不用排队
+            return self.__admitted(counted)
+        async with self.__lock(counted):
+            while True:
+                wait = self.__poll_interval
+                if counted and self.running < self.__min_running:
+                    break
+                if not counted or self.__max_running is None or self.running < self.__max_running:
+                    since = time.monotonic() - self.__last_admit
+                    reason = self.overloaded()
+                    if reason != self.__overloaded:
+                        self.__overloaded = reason
+                        if reason is not None:
+                            self.getLogger().info("overloaded, hold new downloads: %s" % reason)
+                        else:
+                            self.getLogger().info("not overloaded anymore")
+                    if reason is None and since >= self.__admit_interval:
+                        break
+                    if reason is None:
+                        wait = self.__admit_interval - since
+                await asyncio.sleep(wait)
+            self.__admitted(counted)
+
+    def __admitted(self, counted: bool):
+        if counted:
+            self.running += 1
+        self.admitted += 1
+        self.__last_admit = time.monotonic()
+        self.getLogger().debug("admitted, %d running" % self.running)
+
+    async def acquire(self):
+        """等到可以开始一个新的下载，下载结束后要release"""
+        await self.__wait(True)
+
+    async def admit(self):
+        """等到不超负荷并且离上一次放行过了admit_interval，不占名额，不用release"""
+        await self.__wait(False)
+
+    def release(self):
+        self.running -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+admission_controller = AdmissionController()  # 默认大家共用这一个
+
+
+class AdmissionFilter(Filter):
+    """
+    等到系统不超负荷时才放item过去，放在不能包一层的下载之前用
+    过滤器不知道下载什么时候结束，所以不占名额，min_running和max_running对它不起作用，只看负载和admit_interval
+    """
+
+    def __init__(self, controller: AdmissionController = admission_controller):
+        super().__init__()
+        self.__controller = controller
+
+    async def filter(self, item):
+        await self.__controller.admit()
+        return item
+
+
+class AdmissionDownloader(Downloader):
+    """在base_downloader外面包一层，等到系统不超负荷时才开始下载，下载期间占着一个名额"""
+
+    def __init__(self, base_downloader: Downloader, controller: AdmissionController = admission_controller):
+        super().__init__()
+        self.__base_downloader = base_downloader
+        self.__controller = controller
+
+    def setTag(self, tag: str = None):
+        super().setTag(tag)
+        self.__base_downloader.setTag(tag)
+
+    async def download(self, item):
+        async with self.__controller.slot():
+            return await self.__base_downloader.download(item)
+
+
+def AdmissionFilterDownloader(base_downloader: Downloader, controller: AdmissionController = admission_controller):
+    f = FilterDownloader(base_downloader, AdmissionFilter(controller))
+    f.setTag('AdmissionFilterDownloader')
+    return f
@@ -1,2 +1,5 @@
 from .update import CentralizedUpdateDownloader, DecentralizedUpdateDownloader
-from .file import FileFeeder, DirFeeder, WalkFeeder, ExtFilterFeeder
+from .file import ScanFeeder, FileFeeder, DirFeeder, WalkFeeder, ExtFilterFeeder, PathFilterFeeder
+from .pathfilter import PathFilter
+from .watch import WatchFeeder
+from .dedup import DedupFilter, DedupFilterFeeder, DedupFilterDownloader, HashCache
@@ -0,0 +1,196 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import mmap
+import os
+import stat as st
+import weakref
+from typing import Dict, List, Optional
+
+from simplarchiver import Logger, Filter, Feeder, Downloader, FilterFeeder, FilterDownloader
+from ..storage import JSONFile, DelayedSave
+
+
+def hash_file(path: str, partial: int = None, chunk_size: int = 1024 * 1024) -> str:
+    """
+    用mmap一块一块地读文件算blake2b，在进程池里调用
+    partial不为None时只算开头和结尾各partial字节，文件不超过2*partial字节时就是整个文件
+    """
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= 0:
+            return h.hexdigest()
+        if partial is None or size <= 2 * partial:
+            ranges = [(0, size)]
+        else:
+            ranges = [(0, partial), (size - partial, size)]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as view:
+            for start, end in ranges:
+                for i in range(start, end, chunk_size):
+                    h.update(view[i:min(i + chunk_size, end)])
+    return h.hexdigest()
+
+
+class HashCache(Logger):
+    """
+    存在硬盘上的文件hash缓存，JSON格式
+    key是"设备号:inode"，值是[size, mtime_ns, 部分hash, 完整hash]，size或mtime变了就作废
+    有新hash之后过save_delay秒才写文件，攒一批再写；等着写的task被取消(比如asyncio.run结束)时也会写
+    每轮结束时DedupFilter会调用flush立即写
+    """
+
+    def __init__(self, path: str, save_delay: float = 5.0):
+        super().__init__()
+        self.__file = JSONFile(path)
+        self.__saving = DelayedSave(self.__file.save, save_delay)
+        self.__data: Optional[Dict[str, list]] = None
+
+    def setTag(self, tag: str = None):
+        super().setTag(tag)
+        self.__file.setTag(tag)
+        self.__saving.setTag(tag)
+
+    async def load(self):
+        if self.__data is None:
+            self.__data = await self.__file.load()
+
+    async def flush(self):
+        """立即把还没写的hash写到文件里"""
+        await self.__saving.flush()
+
+    @staticmethod
+    def __key(stat: os.stat_result) -> str:
+        return "%d:%d" % (stat.st_dev, stat.st_ino)
+
+    def get(self, stat: os.stat_result, full: bool) -> Optional[str]:
+        record = self.__data.get(self.__key(stat)) if self.__data is not None else None
+        if record is None or record[0] != stat.st_size or record[1] != stat.st_mtime_ns:
+            return None
+        return record[3] if full else record[2]
+
+    def put(self, stat: os.stat_result, full: bool, digest: str):
+        key = self.__key(stat)
+        record = self.__data.get(key)
+        if record is None or record[0] != stat.st_size or record[1] != stat.st_mtime_ns:
+            record = self.__data[key] = [stat.st_size, stat.st_mtime_ns, None, None]
+        record[3 if full else 2] = digest
+        self.__saving.schedule()
+
+
+class DedupFilter(Filter):
+    """
+    筛掉内容和之前出现过的文件完全一样的文件，输入是文件路径，第一次出现的那个留下
+    先比大小，大小一样再比开头和结尾的部分hash，部分hash一样才算完整hash，大多数文件根本不用读完
+    hash在进程池里用mmap分块读取计算，不占用事件循环也不受GIL限制
+    同一个文件(同一个inode)再次出现不算重复，所以每轮都返回所有文件的Feeder也能用
+    只在一轮之内去重：每轮结束(cycle_end)时忘掉这一轮见过的文件，写hash缓存，关掉算hash的进程池
+    所以和只返回新文件的增量Feeder一起用时，和以前轮次里的文件一样的新文件不会被筛掉
+    不在Pair里用时，用完要调用close
+    """
+
+    def __init__(self, cache_path: str = None, partial_size: int = 64 * 1024, min_size: int = 1,
+                 processes: int = None):
+        """
+        cache_path是hash缓存文件，按inode和mtime记下算过的hash，重启之后不用重算，为None表示不存
+        partial_size是部分hash读开头和结尾各多少字节
+        min_size是参与去重的最小文件大小，更小的文件直接放过，默认放过空文件
+        processes是算hash的进程数，为None表示CPU核数
+        """
+        super().__init__()
+        self.__cache = HashCache(cache_path) if cache_path is not None else None
+        self.__partial_size = partial_size
+        self.__min_size = min_size
+        self.__processes = processes
+        self.__pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self.__groups: Dict[int, List[Dict]] = {}  # size -> 这一轮这个大小的已留下的文件
+        self.__locks = weakref.WeakKeyDictionary()  # 事件循环 -> {size: asyncio.Lock}，同一个大小的文件一个一个比
+        self.duplicates = 0  # 筛掉的文件数
+        self.hashed = 0  # 实际读文件算hash的次数
+
+    def setTag(self, tag: str = None):
+        super().setTag(tag)
+        if self.__cache is not None:
+            self.__cache.setTag(tag)
+
+    async def cycle_end(self):
+        await self.close()
+
+    async def close(self):
+        """忘掉见过的文件，写hash缓存，关掉进程池，之后还可以接着用"""
+        self.__groups.clear()
+        self.__locks = weakref.WeakKeyDictionary()
+        if self.__cache is not None:
+            await self.__cache.flush()
+        pool, self.__pool = self.__pool, None
+        if pool is not None:
+            await asyncio.get_running_loop().run_in_executor(None, pool.shutdown)
+
+    def __lock(self, size: int) -> asyncio.Lock:
+        locks = self.__locks.setdefault(asyncio.get_running_loop(), {})
+        if size not in locks:
+            locks[size] = asyncio.Lock()
+        return locks[size]
+
+    async def __digest(self, file: Dict, full: bool) -> str:
+        """算file的部分或完整hash，算过的记在file里"""
+        stat = file['stat']
+        if full and stat.st_size <= 2 * self.__partial_size:  # 这么小的文件部分hash就是完整hash
+            full = False
+        name = 'full' if full else 'partial'
+        if name in file:
+            return file[name]
+        digest = self.__cache.get(stat, full) if self.__cache is not None else None
+        if digest is None:
+            if self.__pool is None:
+                self.__pool = concurrent.futures.ProcessPoolExecutor(self.__processes)
+            digest = await asyncio.get_running_loop().run_in_executor(
+                self.__pool, hash_file, file['path'], None if full else self.__partial_size)
+            self.hashed += 1
+            if self.__cache is not None:
+                self.__cache.put(stat, full, digest)
+        file[name] = digest
+        return digest
+
+    async def filter(self, item):
+        self.getLogger().debug("item       | %s" % item)
+        try:
+            stat = getattr(item, 'stat', None)
+            if stat is None:
+                stat = await asyncio.get_running_loop().run_in_executor(None, os.stat, item)
+            if not st.S_ISREG(stat.st_mode) or stat.st_size < self.__min_size:
+                return item
+            if self.__cache is not None:
+                await self.__cache.load()
+            me = {'path': str(item), 'stat': stat}
+            async with self.__lock(stat.st_size):
+                group = self.__groups.setdefault(stat.st_size, [])
+                for other in group:
+                    if (other['stat'].st_dev, other['stat'].st_ino) == (stat.st_dev, stat.st_ino):
+                        return item  # 同一个文件又来了
+                for other in group:
+                    if await self.__digest(other, False) != await self.__digest(me, False):
+                        continue
+                    if await self.__digest(other, True) == await self.__digest(me, True):
+                        self.duplicates += 1
+                        self.getLogger().debug("duplicate  | %s = %s" % (item, other['path']))
+                        return None
+                group.append(me)
+            return item
+        except OSError:
+            self.getLogger().exception("cannot hash %s" % item)
+            return item
+
+
+def DedupFilterFeeder(base_feeder: Feeder, cache_path: str = None, partial_size: int = 64 * 1024,
+                      min_size: int = 1, processes: int = None):
+    f = FilterFeeder(base_feeder, DedupFilter(cache_path, partial_size, min_size, processes))
+    f.setTag('DedupFilterFeeder')
+    return f
+
+
+def DedupFilterDownloader(base_downloader: Downloader, cache_path: str = None, partial_size: int = 64 * 1024,
+                          min_size: int = 1, processes: int = None):
+    f = FilterDownloader(base_downloader, DedupFilter(cache_path, partial_size, min_size, processes))
+    f.setTag('DedupFilterDownloader')
+    return f
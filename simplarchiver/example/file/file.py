@@ -1,58 +1,80 @@
 import os
 
 from simplarchiver import Feeder, Filter, FilterFeeder
-
-
-class FileFeeder(Feeder):
-    """扫描文件夹，返回所有文件的路径"""
-
-    def __init__(self, root):
+from .pathfilter import PathFilter
+from .walk import Walker, ScanSnapshot
+
+
+class ScanFeeder(Feeder):
+    """
+    扫描文件夹的Feeder，FileFeeder、DirFeeder、WalkFeeder的共同基类，子类只用指定返回文件还是文件夹
+    files和dirs表示是否返回文件和文件夹
+    """
+    files = True
+    dirs = False
+
+    def __init__(self, root, workers: int = 8, batch_size: int = 256,
+                 snapshot_path: str = None, trust_dir_mtime: bool = False, path_filter: PathFilter = None):
+        """
+        扫描在线程池里进行，workers是扫描线程数，batch_size是每批送回多少个路径
+        返回的路径是WalkEntry，带着扫描时得到的stat
+        snapshot_path是增量扫描的快照文件，给了就只返回和上次扫描相比新增或变化了的路径，为None表示每次都返回所有路径
+        快照在这一轮所有下载都结束后(cycle_end)才写，不在Pair里用时要自己调用cycle_end
+        trust_dir_mtime表示增量扫描时是否跳过mtime没变的文件夹里的文件，会漏掉原地修改文件内容的变化，详见Walker
+        path_filter是扫描时就用上的筛选条件，被排除的文件夹整个不进入
+        """
         super().__init__()
         self.__root = root
+        self.__opt = dict(workers=workers, batch_size=batch_size,
+                          snapshot_path=snapshot_path, trust_dir_mtime=trust_dir_mtime)
+        self.__path_filters = [path_filter] if path_filter is not None else []
+        snapshot = ScanSnapshot(snapshot_path) if snapshot_path is not None else None
+        self.__walker = Walker(root, files=self.files, dirs=self.dirs, workers=workers, batch_size=batch_size,
+                               snapshot=snapshot, trust_dir_mtime=trust_dir_mtime, path_filter=path_filter)
+
+    def setTag(self, tag: str = None):
+        super().setTag(tag)
+        self.__walker.setTag(tag)
+
+    async def cycle_start(self):
+        self.__walker.discard()
+
+    async def cycle_end(self):
+        await self.__walker.commit()
+
+    def with_path_filter(self, path_filter: PathFilter) -> 'ScanFeeder':
+        """
+        返回一个同一个类、设置相同、多加了一个扫描时的筛选条件的新Feeder，自己不变
+        新的Feeder和自己用同一个快照文件，所以有snapshot_path时两个不要一起用
+        """
+        f = type(self)(self.__root, **self.__opt)
+        for pf in self.__path_filters + [path_filter]:
+            f.__path_filters.append(pf)
+            f.__walker.add_path_filter(pf)
+        return f
 
     async def get_feeds(self):
-        for top, dirs, files in os.walk(self.__root, topdown=True):
-            self.getLogger().debug("scanning   | %s" % top)
-            for f in files:
-                path = os.path.join(top, f)
-                self.getLogger().debug("file found | %s" % path)
-                yield path
+        async for path in self.__walker.walk():
+            self.getLogger().debug("%s found | %s" % ("dir " if path.is_dir else "file", path))
+            yield path
 
 
-class DirFeeder(Feeder):
-    """扫描文件夹，返回所有文件夹的路径"""
+class FileFeeder(ScanFeeder):
+    """扫描文件夹，返回所有文件的路径"""
+    files = True
+    dirs = False
 
-    def __init__(self, root):
-        super().__init__()
-        self.__root = root
 
-    async def get_feeds(self):
-        for top, dirs, _ in os.walk(self.__root, topdown=True):
-            self.getLogger().debug("scanning   | %s" % top)
-            for d in dirs:
-                path = os.path.join(top, d)
-                self.getLogger().debug("dir  found | %s" % path)
-                yield os.path.join(path)
+class DirFeeder(ScanFeeder):
+    """扫描文件夹，返回所有文件夹的路径"""
+    files = False
+    dirs = True
 
 
-class WalkFeeder(Feeder):
+class WalkFeeder(ScanFeeder):
     """扫描文件夹，返回所有文件和文件夹的路径"""
-
-    def __init__(self, root):
-        super().__init__()
-        self.__root = root
-
-    async def get_feeds(self):
-        for top, dirs, files in os.walk(self.__root, topdown=True):
-            self.getLogger().debug("scanning   | %s" % top)
-            for f in files:
-                path = os.path.join(top, f)
-                self.getLogger().debug("file found | %s" % path)
-                yield path
-            for d in dirs:
-                path = os.path.join(top, d)
-                self.getLogger().debug("dir  found | %s" % path)
-                yield os.path.join(path)
+    files = True
+    dirs = True
 
 
 class ExtFilter(Filter):
@@ -73,7 +95,23 @@ class ExtFilter(Filter):
             return None
 
 
-def ExtFilterFeeder(base_feeder: FileFeeder, extension: str):
-    f = FilterFeeder(base_feeder, ExtFilter(extension))
+def PathFilterFeeder(base_feeder: Feeder, path_filter: PathFilter):
+    """
+    用PathFilter筛选base_feeder给出的路径
+    base_feeder是FileFeeder、DirFeeder或WalkFeeder时返回一个把条件加到扫描里去的新Feeder，base_feeder本身不变
+    """
+    if isinstance(base_feeder, ScanFeeder):
+        f = base_feeder.with_path_filter(path_filter)
+    else:
+        f = FilterFeeder(base_feeder, path_filter)
+    f.setTag('PathFilterFeeder')
+    return f
+
+
+def ExtFilterFeeder(base_feeder: Feeder, extension: str):
+    if isinstance(base_feeder, ScanFeeder) and not base_feeder.dirs:  # PathFilter的后缀名不管文件夹，所以只返回文件的才能这样
+        f = PathFilterFeeder(base_feeder, PathFilter(extensions=[extension]))
+    else:
+        f = FilterFeeder(base_feeder, ExtFilter(extension))
     f.setTag('ExtFilterFeeder')
     return f
@@ -0,0 +1,129 @@
+import asyncio
+import fnmatch
+import os
+import re
+from datetime import datetime
+from typing import Iterable, Callable, Optional, Tuple, List
+
+from simplarchiver import Filter
+
+
+def compile_globs(globs: Optional[Iterable[str]]) -> Optional[re.Pattern]:
+    """把多个glob合成一个正则，一次匹配完"""
+    if globs is None:
+        return None
+    globs = [os.path.normcase(g) for g in globs]
+    if len(globs) <= 0:
+        return None
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(g) for g in globs))
+
+
+def split_globs(globs: Optional[Iterable[str]]) -> Tuple[Optional[re.Pattern], Optional[re.Pattern]]:
+    """把glob分成只和文件名匹配的和和完整路径匹配的两组，分别合成正则"""
+    if globs is None:
+        return None, None
+    globs = list(globs)
+    seps = {os.sep, os.altsep} - {None}
+    return compile_globs([g for g in globs if not any(c in g for c in seps)]), \
+        compile_globs([g for g in globs if any(c in g for c in seps)])
+
+
+class PathFilter(Filter):
+    """
+    按路径筛选文件，可以直接用在FilterFeeder里，也可以交给Walker在扫描时就筛掉
+    交给Walker时被排除的文件夹整棵子树都不会进入，被筛掉的文件也不会变成item
+    extensions是要的后缀名，globs是要的文件要匹配的glob，exclude_dirs是不进入的文件夹要匹配的glob
+    glob里带路径分隔符的和完整路径匹配，不带的只和文件名匹配
+    min_size/max_size是文件大小的范围(字节)，newer_than/older_than是mtime的范围
+    predicate是自定义的条件，输入WalkEntry(扫描时)或是路径，返回是否要
+    除了exclude_dirs，其他条件都只对文件有效，文件夹只看有没有被排除
+    用在FilterFeeder里时要一级一级往上看上级文件夹有没有被排除，和Walker一样只看扫描的根文件夹下面的
+    根文件夹是root，为None时用WalkEntry带着的root，都没有(比如item是普通的str)就一直看到/
+    """
+
+    def __init__(self, extensions: Iterable[str] = None, globs: Iterable[str] = None,
+                 exclude_dirs: Iterable[str] = None,
+                 min_size: int = None, max_size: int = None,
+                 newer_than: datetime = None, older_than: datetime = None,
+                 predicate: Callable[[str], bool] = None, root: str = None):
+        super().__init__()
+        self.__extensions = set(e.lower() for e in extensions) if extensions is not None else None
+        self.__globs = split_globs(globs)
+        self.__exclude_dirs = split_globs(exclude_dirs)
+        self.__min_size = min_size
+        self.__max_size = max_size
+        self.__newer_than = newer_than.timestamp() if newer_than is not None else None
+        self.__older_than = older_than.timestamp() if older_than is not None else None
+        self.__predicate = predicate
+        self.__root = root
+
+    @property
+    def needs_stat(self) -> bool:
+        """筛选文件时要不要stat"""
+        return self.__min_size is not None or self.__max_size is not None or \
+            self.__newer_than is not None or self.__older_than is not None
+
+    @staticmethod
+    def __match(patterns: Tuple[Optional[re.Pattern], Optional[re.Pattern]], path: str) -> bool:
+        """patterns是split_globs的结果，两组都没有时算不匹配"""
+        name_pattern, path_pattern = patterns
+        path = os.path.normcase(path)
+        return (name_pattern is not None and name_pattern.match(os.path.basename(path)) is not None) or \
+            (path_pattern is not None and path_pattern.match(path) is not None)
+
+    def match_dir(self, path: str) -> bool:
+        """这个文件夹是否要进入"""
+        return self.__exclude_dirs == (None, None) or not self.__match(self.__exclude_dirs, path)
+
+    def match_file(self, path: str, stat: os.stat_result = None) -> bool:
+        """这个文件是否要，needs_stat为True时要给stat"""
+        if self.__extensions is not None and os.path.splitext(path)[1].lower() not in self.__extensions:
+            return False
+        if self.__globs != (None, None) and not self.__match(self.__globs, path):
+            return False
+        if stat is not None:
+            if self.__min_size is not None and stat.st_size < self.__min_size:
+                return False
+            if self.__max_size is not None and stat.st_size > self.__max_size:
+                return False
+            if self.__newer_than is not None and stat.st_mtime < self.__newer_than:
+                return False
+            if self.__older_than is not None and stat.st_mtime > self.__older_than:
+                return False
+        return self.__predicate is None or self.__predicate(path)
+
+    def __ancestors(self, item: str) -> List[str]:
+        """要看的上级文件夹，知道根文件夹时只要根文件夹下面的，和Walker扫描时看过的一样"""
+        root = self.__root if self.__root is not None else getattr(item, 'root', None)
+        root = os.path.normpath(root) if root is not None else None
+        ancestors, parent = [], os.path.dirname(item)
+        while parent and parent != os.path.dirname(parent):
+            if root is not None and os.path.normpath(parent) == root:
+                return ancestors
+            ancestors.append(parent)
+            parent = os.path.dirname(parent)
+        return ancestors if root is None else []  # 不在根文件夹下面的就不看上级文件夹了
+
+    def __check(self, item: str) -> bool:
+        """不是在扫描时筛选，不知道上级文件夹有没有被排除，所以要一级一级往上看"""
+        if not all(self.match_dir(parent) for parent in self.__ancestors(item)):
+            return False
+        is_dir = getattr(item, 'is_dir', None)
+        if is_dir is None:
+            is_dir = os.path.isdir(item)
+        if is_dir:
+            return self.match_dir(item)
+        stat = getattr(item, 'stat', None)
+        if stat is None and self.needs_stat:
+            stat = os.stat(item)
+        return self.match_file(item, stat)
+
+    async def filter(self, item):
+        self.getLogger().debug("item       | %s" % item)
+        try:
+            ok = await asyncio.get_running_loop().run_in_executor(None, self.__check, item)
+        except OSError:
+            self.getLogger().exception("cannot stat %s" % item)
+            return None
+        self.getLogger().debug("%s | %s" % ("accepted  " if ok else "rejected  ", item))
+        return item if ok else None
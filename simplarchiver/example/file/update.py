@@ -1,11 +1,16 @@
 import json
 import abc
 import os
-from typing import Any, Tuple, Callable
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Tuple, Callable, List, Optional
 
 import aiofiles
 
 from simplarchiver import Downloader, UpdateRW, UpdateDownloader, Logger
+from ..storage import JSONFile, LoopLocal
 
 
 class UpdatePG(Logger, metaclass=abc.ABCMeta):
@@ -18,6 +23,35 @@ class UpdatePG(Logger, metaclass=abc.ABCMeta):
     async def put(self, key: str, update_tag: str):
         pass
 
+    async def get_many(self, keys: List[str]) -> List[Any]:
+        """批量读取更新标记，默认就是一个一个地get"""
+        return [await self.get(key) for key in keys]
+
+    async def put_many(self, pairs: List[Tuple[str, str]]):
+        """批量写入更新标记，默认就是一个一个地put"""
+        for key, update_tag in pairs:
+            await self.put(key, update_tag)
+
+    async def keys(self) -> List[str]:
+        """列出所有已记录的更新标记的key，用于清理过期的更新标记，支持的子类要同时重写keys和delete_many"""
+        raise NotImplementedError("%s does not support listing keys" % self.__class__.__name__)
+
+    async def delete_many(self, keys: List[str]):
+        """删除一批更新标记，用于清理过期的更新标记"""
+        raise NotImplementedError("%s does not support deleting keys" % self.__class__.__name__)
+
+    def can_delete(self) -> bool:
+        """是否支持keys和delete_many，封装了别的UpdatePG的要问被封装的那个"""
+        return type(self).keys is not UpdatePG.keys and type(self).delete_many is not UpdatePG.delete_many
+
+    async def cycle_start(self):
+        """Pair的每一轮开始之前调用"""
+        pass
+
+    async def cycle_end(self):
+        """Pair的每一轮所有下载都结束之后调用"""
+        pass
+
 
 class UpdateList(UpdatePG):
     """用于操作下载更新标记的记录文件"""
@@ -25,6 +59,7 @@ class UpdateList(UpdatePG):
     def __init__(self, path: str):
         super().__init__()
         self.__path = path
+        self.__lock = LoopLocal(asyncio.Lock)  # 读-改-写整个文件的过程不能交错进行，否则会丢失写入的更新标记
 
     async def __check(self):
         self.getLogger().debug("Check if the update list file exists at %s" % self.__path)
@@ -39,29 +74,71 @@ class UpdateList(UpdatePG):
 
     async def get(self, key: str) -> Any:
         """读取更新标记"""
-        await self.__check()
-        async with aiofiles.open(self.__path, 'r', encoding='utf8') as f:
-            ulist = json.loads(await f.read())
-            self.getLogger().debug("Searching update tag %s in update list %s" % (key, self.__path))
-            if key in ulist:
-                value = ulist[key]
-                self.getLogger().debug("Update tag %s found in update list %s, it is %s" % (key, self.__path, value))
-                return value
-            else:
-                self.getLogger().debug("Update tag %s not found in update list %s" % (key, self.__path))
-                return None
+        async with self.__lock.get():
+            await self.__check()
+            async with aiofiles.open(self.__path, 'r', encoding='utf8') as f:
+                ulist = json.loads(await f.read())
+                self.getLogger().debug("Searching update tag %s in update list %s" % (key, self.__path))
+                if key in ulist:
+                    value = ulist[key]
+                    self.getLogger().debug("Update tag %s found in update list %s, it is %s" % (key, self.__path, value))
+                    return value
+                else:
+                    self.getLogger().debug("Update tag %s not found in update list %s" % (key, self.__path))
+                    return None
 
     async def put(self, key: str, update_tag: str):
         """写入更新标记"""
-        await self.__check()
-        async with aiofiles.open(self.__path, 'r+', encoding='utf8') as f:
-            self.getLogger().debug(
-                "Put the update tag %s with the value %s into the update list %s" % (key, update_tag, self.__path))
-            ulist = json.loads(await f.read())
-            ulist[key] = update_tag
-            await f.seek(0)
-            await f.truncate()
-            await f.write(json.dumps(ulist, indent=4))
+        async with self.__lock.get():
+            await self.__check()
+            async with aiofiles.open(self.__path, 'r+', encoding='utf8') as f:
+                self.getLogger().debug(
+                    "Put the update tag %s with the value %s into the update list %s" % (key, update_tag, self.__path))
+                ulist = json.loads(await f.read())
+                ulist[key] = update_tag
+                await f.seek(0)
+                await f.truncate()
+                await f.write(json.dumps(ulist, indent=4))
+
+    async def get_many(self, keys: List[str]) -> List[Any]:
+        """批量读取更新标记，整批只读一次文件"""
+        async with self.__lock.get():
+            await self.__check()
+            async with aiofiles.open(self.__path, 'r', encoding='utf8') as f:
+                ulist = json.loads(await f.read())
+            self.getLogger().debug("Searching %d update tags in update list %s" % (len(keys), self.__path))
+            return [ulist[key] if key in ulist else None for key in keys]
+
+    async def put_many(self, pairs: List[Tuple[str, str]]):
+        """批量写入更新标记，整批只读写一次文件"""
+        async with self.__lock.get():
+            await self.__check()
+            async with aiofiles.open(self.__path, 'r+', encoding='utf8') as f:
+                self.getLogger().debug("Put %d update tags into the update list %s" % (len(pairs), self.__path))
+                ulist = json.loads(await f.read())
+                for key, update_tag in pairs:
+                    ulist[key] = update_tag
+                await f.seek(0)
+                await f.truncate()
+                await f.write(json.dumps(ulist, indent=4))
+
+    async def keys(self) -> List[str]:
+        async with self.__lock.get():
+            await self.__check()
+            async with aiofiles.open(self.__path, 'r', encoding='utf8') as f:
+                return list(json.loads(await f.read()).keys())
+
+    async def delete_many(self, keys: List[str]):
+        async with self.__lock.get():
+            await self.__check()
+            async with aiofiles.open(self.__path, 'r+', encoding='utf8') as f:
+                self.getLogger().debug("Delete %d update tags from the update list %s" % (len(keys), self.__path))
+                ulist = json.loads(await f.read())
+                for key in keys:
+                    ulist.pop(key, None)
+                await f.seek(0)
+                await f.truncate()
+                await f.write(json.dumps(ulist, indent=4))
 
 
 class UpdateDir(UpdatePG):
@@ -98,6 +175,272 @@ class UpdateDir(UpdatePG):
         except Exception as e:
             self.getLogger().exception("Update list file has error when put %s" % e)
 
+    def __keys(self) -> List[str]:
+        keys = []
+        for top, _, files in os.walk(self.__path):
+            for f in files:
+                keys.append(os.path.relpath(os.path.join(top, f), self.__path))
+        return keys
+
+    def __delete_many(self, keys: List[str]):
+        root = os.path.abspath(self.__path)
+        for key in keys:
+            path = os.path.join(self.__path, key)
+            try:
+                os.remove(path)
+                self.getLogger().debug("Update tag file deleted: %s" % path)
+                parent = os.path.dirname(os.path.abspath(path))
+                while parent != root and len(os.listdir(parent)) <= 0:  # 顺便删掉空文件夹
+                    os.rmdir(parent)
+                    parent = os.path.dirname(parent)
+            except Exception as e:
+                self.getLogger().exception("Update list file has error when delete %s" % e)
+
+    async def keys(self) -> List[str]:
+        """文件夹可能很大，放到线程池里遍历，不阻塞事件循环"""
+        return await asyncio.get_running_loop().run_in_executor(None, self.__keys)
+
+    async def delete_many(self, keys: List[str]):
+        await asyncio.get_running_loop().run_in_executor(None, self.__delete_many, keys)
+
+
+class UpdateCache(UpdatePG):
+    """
+    给任意UpdatePG加一层LRU读缓存
+    读取时优先从缓存里找，写入时同时写缓存和被封装的UpdatePG(write-through)
+    keys第一次调用时从被封装的UpdatePG里读，之后在写入和删除时跟着改，不再读了
+    """
+
+    def __init__(self, update_put_get: UpdatePG, max_size: int = 4096, ttl: timedelta = None):
+        """
+        update_put_get是被封装的UpdatePG
+        max_size是缓存最多记录多少个更新标记，超出时丢掉最久没有用过的
+        ttl是缓存的有效期，为None表示永不过期
+        """
+        super().__init__()
+        self.__update_put_get = update_put_get
+        self.__max_size = max_size
+        self.__ttl = ttl.total_seconds() if ttl is not None else None
+        self.__cache: OrderedDict = OrderedDict()  # key -> (更新标记, 写入缓存的时间)
+        self.__keys: Optional[set] = None  # 被封装的UpdatePG里所有的key，还没读过时为None
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def setTag(self, tag: str = None):
+        super().setTag(tag)
+        self.__update_put_get.setTag(tag)
+
+    def __lookup(self, key: str) -> Tuple[bool, Any]:
+        """返回(是否命中, 更新标记)"""
+        if key in self.__cache:
+            value, t = self.__cache[key]
+            if self.__ttl is None or time.monotonic() - t <= self.__ttl:
+                self.__cache.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self.__cache[key]  # 过期了就丢掉
+        self.misses += 1
+        return False, None
+
+    def __store(self, key: str, value: Any):
+        self.__cache[key] = (value, time.monotonic())
+        self.__cache.move_to_end(key)
+        while len(self.__cache) > self.__max_size:
+            self.__cache.popitem(last=False)  # 丢掉最久没有用过的
+
+    async def get(self, key: str) -> Any:
+        hit, value = self.__lookup(key)
+        if not hit:
+            value = await self.__update_put_get.get(key)
+            self.__store(key, value)
+        self.getLogger().debug("get %s | hits %d, misses %d" % ("hit " if hit else "miss", self.hits, self.misses))
+        return value
+
+    async def get_many(self, keys: List[str]) -> List[Any]:
+        values, missing = {}, []
+        for key in keys:
+            hit, value = self.__lookup(key)
+            if hit:
+                values[key] = value
+            elif key not in missing:
+                missing.append(key)
+        if len(missing) > 0:  # 没命中的一次性从被封装的UpdatePG里读
+            for key, value in zip(missing, await self.__update_put_get.get_many(missing)):
+                self.__store(key, value)
+                values[key] = value
+        self.getLogger().debug("get_many %d keys | hits %d, misses %d" % (len(keys), self.hits, self.misses))
+        return [values[key] for key in keys]
+
+    async def put(self, key: str, update_tag: str):
+        await self.__update_put_get.put(key, update_tag)
+        self.__store(key, update_tag)
+        if self.__keys is not None:
+            self.__keys.add(key)
+
+    async def put_many(self, pairs: List[Tuple[str, str]]):
+        await self.__update_put_get.put_many(pairs)
+        for key, update_tag in pairs:
+            self.__store(key, update_tag)
+            if self.__keys is not None:
+                self.__keys.add(key)
+
+    async def keys(self) -> List[str]:
+        if self.__keys is None:
+            self.__keys = set(await self.__update_put_get.keys())
+        return list(self.__keys)
+
+    async def delete_many(self, keys: List[str]):
+        await self.__update_put_get.delete_many(keys)
+        for key in keys:
+            self.__cache.pop(key, None)
+            if self.__keys is not None:
+                self.__keys.discard(key)
+
+    def can_delete(self) -> bool:
+        return self.__update_put_get.can_delete()
+
+    async def cycle_start(self):
+        await self.__update_put_get.cycle_start()
+
+    async def cycle_end(self):
+        await self.__update_put_get.cycle_end()
+
+
+class UpdateRetention(UpdatePG):
+    """
+    记录每个更新标记最后一次被读写的时间，并清理太久没有见过的更新标记
+    Pair每一轮都会把Feeder里还存在的item拿来比对，所以一直没有被比对过的更新标记就是已经不存在的item留下的
+    轮数由Pair通过cycle_start推进，每一轮的下载都结束后在cycle_end里清理一次
+    一个更新标记都没有读写的那一轮(比如Feeder出错了)不算数，也不清理，不然一次RSS故障就会清掉所有更新标记
+    不在Pair里用的话要自己调用cycle_start和cycle_end，不调用就永远停在第0轮，只会按max_age清理
+    """
+
+    def __init__(self, update_put_get: UpdatePG, seen_path: str = None,
+                 max_cycles: int = None, max_age: timedelta = None):
+        """
+        update_put_get是被封装的UpdatePG，需要实现keys和delete_many
+        seen_path是记录最后一次见到每个更新标记的时间的文件，为None表示只记在内存里
+        max_cycles表示连续多少轮没有见过的更新标记要被清理，最小是1，即这一轮没见过就清理，为None表示不按轮数清理
+        max_age表示多长时间没有见过的更新标记要被清理，为None表示不按时间清理
+        """
+        super().__init__()
+        if max_cycles is not None and max_cycles < 1:
+            raise ValueError("max_cycles must be at least 1, got %d" % max_cycles)
+        if not update_put_get.can_delete():
+            raise TypeError("%s does not support keys and delete_many, cannot be used in UpdateRetention"
+                            % update_put_get.__class__.__name__)
+        self.__update_put_get = update_put_get
+        self.__file = JSONFile(seen_path)  # {'cycle': 当前轮数, 'seen': {key: [最后一次见到时的轮数, 最后一次见到时的时间]}}
+        self.__load_lock = LoopLocal(asyncio.Lock)
+        self.__max_cycles = max_cycles
+        self.__max_age = max_age.total_seconds() if max_age is not None else None
+        self.__cycle = 0
+        self.__seen = None  # key -> [最后一次见到时的轮数, 最后一次见到时的时间]
+        self.__touched = 0  # 这一轮读写了多少次更新标记
+        self.__compacting = False
+
+    def setTag(self, tag: str = None):
+        super().setTag(tag)
+        self.__update_put_get.setTag(tag)
+        self.__file.setTag(tag)
+
+    async def __load(self):
+        if self.__seen is not None:
+            return
+        async with self.__load_lock.get():
+            if self.__seen is not None:  # 等锁的时候别的协程已经读好了
+                return
+            data = await self.__file.load()
+            self.__cycle = data.setdefault('cycle', 0)
+            self.__seen = data.setdefault('seen', {})
+
+    async def __save(self):
+        (await self.__file.load())['cycle'] = self.__cycle
+        await self.__file.save()
+
+    async def __touch(self, keys: List[str]):
+        """记录这些key在这一轮被见到了"""
+        await self.__load()
+        now = time.time()
+        for key in keys:
+            self.__seen[key] = [self.__cycle, now]
+        self.__touched += len(keys)
+
+    def can_delete(self) -> bool:
+        return True
+
+    async def cycle_start(self):
+        await self.__update_put_get.cycle_start()
+        await self.__load()
+        self.__cycle += 1
+        self.__touched = 0
+        self.getLogger().debug("Cycle %d started" % self.__cycle)
+
+    async def cycle_end(self):
+        """这一轮的比对都做完了，没见到的就是这一轮Feeder里没有的，可以清理了"""
+        if self.__touched > 0:
+            await self.compact()
+        elif self.__cycle > 0:
+            self.__cycle -= 1  # 这一轮什么都没见到，多半是Feeder出错了，不算数
+            self.getLogger().warning("No update tag was read or written in this cycle, skip compaction")
+        await self.__update_put_get.cycle_end()
+
+    def __expired(self, record: List) -> bool:
+        cycle, t = record
+        if self.__max_cycles is not None and self.__cycle - cycle >= self.__max_cycles:
+            return True
+        if self.__max_age is not None and time.time() - t > self.__max_age:
+            return True
+        return False
+
+    async def compact(self):
+        """清理过期的更新标记，可以在任何时候调用，同一时刻只会有一个清理过程在运行"""
+        if self.__compacting:
+            return
+        self.__compacting = True
+        try:
+            await self.__load()
+            keys = await self.__update_put_get.keys()
+            now = time.time()
+            for key in keys:
+                if key not in self.__seen:  # 以前没有记录过的key就从现在开始算
+                    self.__seen[key] = [self.__cycle, now]
+            expired = [key for key in keys if self.__expired(self.__seen[key])]
+            self.getLogger().info("Compaction | %d keys, %d expired" % (len(keys), len(expired)))
+            if len(expired) > 0:
+                await self.__update_put_get.delete_many(expired)
+            for key in [key for key, record in self.__seen.items() if self.__expired(record)]:
+                del self.__seen[key]
+            await self.__save()
+        except Exception:
+            self.getLogger().exception("Catch an Exception when compacting update tags")
+        finally:
+            self.__compacting = False
+
+    async def get(self, key: str) -> Any:
+        await self.__touch([key])
+        return await self.__update_put_get.get(key)
+
+    async def get_many(self, keys: List[str]) -> List[Any]:
+        await self.__touch(keys)
+        return await self.__update_put_get.get_many(keys)
+
+    async def put(self, key: str, update_tag: str):
+        await self.__touch([key])
+        await self.__update_put_get.put(key, update_tag)
+
+    async def put_many(self, pairs: List[Tuple[str, str]]):
+        await self.__touch([key for key, _ in pairs])
+        await self.__update_put_get.put_many(pairs)
+
+    async def keys(self) -> List[str]:
+        return await self.__update_put_get.keys()
+
+    async def delete_many(self, keys: List[str]):
+        await self.__update_put_get.delete_many(keys)
+        for key in keys:
+            self.__seen.pop(key, None)
+
 
 class UpdatePGRW(UpdateRW):
     def __init__(self, update_put_get: UpdatePG, update_list_pair_gen: Callable[[Any], Tuple[str, str]]):
@@ -130,14 +473,53 @@ class UpdatePGRW(UpdateRW):
         await self.__update_put_get.put(uid, utag)
         return True
 
+    async def read_many(self, items: List) -> List[bool]:
+        """批量比对，整批item的更新标记只用一次get_many读取"""
+        pairs = [self.__update_list_pair_gen(item) for item in items]
+        results = [True] * len(items)
+        index = [i for i, (uid, utag) in enumerate(pairs) if uid is not None and utag is not None]
+        if len(index) < len(items):
+            self.getLogger().debug('read_many | %d update tags are None, return True' % (len(items) - len(index)))
+        if len(index) <= 0:
+            return results
+        last_utags = await self.__update_put_get.get_many([pairs[i][0] for i in index])
+        for i, last_utag in zip(index, last_utags):
+            uid, utag = pairs[i]
+            self.getLogger().debug('read_many | This update tag is %s; last update tag is %s' % (utag, last_utag))
+            results[i] = last_utag != utag
+        return results
+
+    async def write_many(self, items: List) -> List[bool]:
+        """批量刷新更新列表里对应的item的tag值，整批只用一次put_many写入"""
+        await self.__update_put_get.put_many([self.__update_list_pair_gen(item) for item in items])
+        return [True] * len(items)
+
+    async def cycle_start(self):
+        await self.__update_put_get.cycle_start()
+
+    async def cycle_end(self):
+        await self.__update_put_get.cycle_end()
+
 
 def CentralizedUpdateDownloader(
         base_downloader: Downloader,
         update_list_path: str,
-        update_list_pair_gen: Callable[[Any], Tuple[str, str]]):
+        update_list_pair_gen: Callable[[Any], Tuple[str, str]],
+        batch_size: int = 1,
+        cache_size: int = 0,
+        cache_ttl: timedelta = None,
+        max_cycles: int = None,
+        max_age: timedelta = None):
+    update_put_get = UpdateList(update_list_path)
+    if cache_size > 0:
+        update_put_get = UpdateCache(update_put_get, cache_size, cache_ttl)
+    if max_cycles is not None or max_age is not None:
+        update_put_get = UpdateRetention(
+            update_put_get, update_list_path.rstrip('/\\') + '.seen', max_cycles, max_age)
     f = UpdateDownloader(
         base_downloader,
-        UpdatePGRW(UpdateList(update_list_path), update_list_pair_gen)
+        UpdatePGRW(update_put_get, update_list_pair_gen),
+        batch_size
     )
     f.setTag('CentralizedUpdateDownloader')
     return f
@@ -146,10 +528,22 @@ def CentralizedUpdateDownloader(
 def DecentralizedUpdateDownloader(
         base_downloader: Downloader,
         update_list_path: str,
-        update_list_pair_gen: Callable[[Any], Tuple[str, str]]):
+        update_list_pair_gen: Callable[[Any], Tuple[str, str]],
+        batch_size: int = 1,
+        cache_size: int = 0,
+        cache_ttl: timedelta = None,
+        max_cycles: int = None,
+        max_age: timedelta = None):
+    update_put_get = UpdateDir(update_list_path)
+    if cache_size > 0:
+        update_put_get = UpdateCache(update_put_get, cache_size, cache_ttl)
+    if max_cycles is not None or max_age is not None:
+        update_put_get = UpdateRetention(
+            update_put_get, update_list_path.rstrip('/\\') + '.seen', max_cycles, max_age)
     f = UpdateDownloader(
         base_downloader,
-        UpdatePGRW(UpdateDir(update_list_path), update_list_pair_gen)
+        UpdatePGRW(update_put_get, update_list_pair_gen),
+        batch_size
     )
     f.setTag('CentralizedUpdateDownloader')
     return f
@@ -0,0 +1,241 @@
+import asyncio
+import concurrent.futures
+import gzip
+import json
+import os
+import threading
+from typing import List, Optional, Dict
+
+from simplarchiver import Logger
+from ..storage import replace_file
+from .pathfilter import PathFilter
+
+
+class WalkEntry(str):
+    """
+    扫描到的路径，就是一个str，顺便带着扫描时得到的信息，下游的Filter可以直接用，不用再stat一次
+    is_dir表示是不是文件夹(跟随符号链接)，stat是os.stat_result，没有获取时为None，root是扫描的根文件夹
+    """
+
+    def __new__(cls, path: str, is_dir: bool = False, stat: os.stat_result = None, root: str = None):
+        entry = super().__new__(cls, path)
+        entry.is_dir = is_dir
+        entry.stat = stat
+        entry.root = root
+        return entry
+
+    def __reduce__(self):  # 让pickle之类的还能正常工作
+        return WalkEntry, (str(self), self.is_dir, self.stat, self.root)
+
+
+class ScanSnapshot(Logger):
+    """
+    上次扫描时的文件夹快照，gzip压缩的JSON，给增量扫描用
+    格式是 文件夹路径 -> [文件夹的mtime, {文件名: [inode, size, mtime]}, [子文件夹名]]，时间都是纳秒
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.__path = path
+
+    def __load(self) -> Dict[str, list]:
+        if not os.path.isfile(self.__path):
+            return {}
+        with gzip.open(self.__path, 'rt', encoding='utf8') as f:
+            return json.load(f)
+
+    def __save(self, snapshot: Dict[str, list]):
+        data = json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')).encode('utf8')
+        replace_file(self.__path, gzip.compress(data, compresslevel=6))
+
+    async def load(self) -> Dict[str, list]:
+        try:
+            snapshot = await asyncio.get_running_loop().run_in_executor(None, self.__load)
+            self.getLogger().debug("Loaded snapshot of %d dirs from %s" % (len(snapshot), self.__path))
+            return snapshot
+        except Exception as e:
+            self.getLogger().exception("Snapshot file has error %s" % e)
+            return {}
+
+    async def save(self, snapshot: Dict[str, list]):
+        await asyncio.get_running_loop().run_in_executor(None, self.__save, snapshot)
+        self.getLogger().debug("Saved snapshot of %d dirs to %s" % (len(snapshot), self.__path))
+
+
+class Walker(Logger):
+    """
+    用os.scandir扫描文件夹，扫描在线程池里进行，不会卡住事件循环
+    每个子文件夹都是线程池里的一个任务，多个子文件夹同时扫描
+    扫描结果攒成一批一批的通过一个有界的asyncio.Queue送回事件循环，取得慢的时候扫描线程会停下来等
+    和os.walk一样不进入指向文件夹的符号链接，但会返回它们；同时扫描多个文件夹，所以返回的顺序是不确定的
+
+    给了snapshot就是增量扫描：只返回和上次扫描相比新增或是inode、size、mtime变了的文件，以及新增的文件夹
+    完整扫描完一遍之后新快照先暂存起来，调用commit才写进快照文件，提前退出的那次扫描不算数
+    Feeder在这一轮所有下载都结束后(cycle_end)才commit，这样下载失败或进程中途退出时，下一轮还会返回这些文件
+    trust_dir_mtime为True时，mtime没变的文件夹不再列出内容、不再stat里面的文件，直接沿用快照，只进入它的子文件夹
+    这样快很多，但是文件夹的mtime只在增删改名它的直接子项时改变，所以原地修改文件内容(不改名)的变化会被漏掉
+    孙子辈的变化不影响文件夹的mtime，所以子文件夹还是每个都要看一遍，整棵子树是剪不掉的
+
+    给了path_filter就在扫描线程里直接筛选：被排除的文件夹不进入，不要的文件不返回，增量扫描的快照里也不会有被排除的文件夹
+    """
+
+    def __init__(self, root: str, files: bool = True, dirs: bool = False,
+                 workers: int = 8, batch_size: int = 256, queue_size: int = 16, with_stat: bool = True,
+                 snapshot: ScanSnapshot = None, trust_dir_mtime: bool = False, path_filter: PathFilter = None):
+        """
+        root是要扫描的文件夹，files和dirs表示是否返回文件和文件夹
+        workers是扫描线程数，batch_size是每批最多多少个路径，queue_size是最多攒多少批还没被取走
+        with_stat表示是否在扫描线程里获取每个路径的stat，增量扫描时总会获取文件的stat
+        snapshot是增量扫描用的快照，为None表示每次都返回所有路径
+        path_filter是扫描时就用上的筛选条件，之后还可以用add_path_filter再加，要同时满足所有条件
+        """
+        super().__init__()
+        self.__root = root
+        self.__files = files
+        self.__dirs = dirs
+        self.__workers = workers
+        self.__batch_size = batch_size
+        self.__queue_size = queue_size
+        self.__with_stat = with_stat
+        self.__snapshot = snapshot
+        self.__trust_dir_mtime = trust_dir_mtime
+        self.__path_filters: List[PathFilter] = [path_filter] if path_filter is not None else []
+        self.__staged: Optional[Dict[str, list]] = None  # 扫描完了还没commit的快照
+
+    def add_path_filter(self, path_filter: PathFilter):
+        """加一个扫描时的筛选条件，要在开始扫描之前加"""
+        self.__path_filters.append(path_filter)
+
+    def setTag(self, tag: str = None):
+        super().setTag(tag)
+        if self.__snapshot is not None:
+            self.__snapshot.setTag(tag)
+
+    @staticmethod
+    def __stat(entry: os.DirEntry) -> os.stat_result:
+        try:
+            return entry.stat()
+        except OSError:  # 坏掉的符号链接
+            return entry.stat(follow_symlinks=False)
+
+    async def walk(self):
+        """逐个yield扫描到的WalkEntry"""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        slots = threading.Semaphore(self.__queue_size)  # 队列的容量，扫描线程在这里等，不占用事件循环
+        executor = concurrent.futures.ThreadPoolExecutor(self.__workers, thread_name_prefix="Walker")
+        lock = threading.Lock()
+        stopped = threading.Event()  # 取的一方提前退出时让扫描线程都停下
+        pending = 0  # 还没扫描完的文件夹数
+        old = await self.__snapshot.load() if self.__snapshot is not None else None
+        new = {}  # 这次扫描的快照，各个扫描线程往里写不同的key
+        dirty = threading.Event()  # 快照有没有变化，没变就不用重写快照文件
+        filters = list(self.__path_filters)
+        filter_stat = any(f.needs_stat for f in filters)
+
+        def put(batch: Optional[List[WalkEntry]]):
+            """在扫描线程里把一批结果送回事件循环，队列满了就等着，None表示全部扫描完了，不占容量"""
+            while batch is not None and not slots.acquire(timeout=0.1):
+                if stopped.is_set():
+                    return
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, batch)
+            except RuntimeError:  # 事件循环已经关了
+                pass
+
+        def submit(path: str):
+            nonlocal pending
+            with lock:
+                pending += 1
+            try:
+                executor.submit(scan, path)
+            except RuntimeError:  # 已经停下了
+                with lock:
+                    pending -= 1
+
+        def scan(path: str):
+            nonlocal pending
+            last = old.get(path) if old is not None else None  # 上次扫描时这个文件夹的快照
+            try:
+                if stopped.is_set():
+                    return
+                mtime = os.stat(path).st_mtime_ns if old is not None else None  # 在列出内容之前取，漏不了
+                if last is not None and self.__trust_dir_mtime and mtime == last[0]:
+                    self.getLogger().debug("unchanged  | %s" % path)
+                    new[path] = last
+                    for d in last[2]:
+                        d = os.path.join(path, d)
+                        if d in old and all(f.match_dir(d) for f in filters):  # 上次进入过的子文件夹，也就是不包括符号链接
+                            submit(d)
+                    return
+                self.getLogger().debug("scanning   | %s" % path)
+                files, subdirs, batch = {}, [], []
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            is_dir = entry.is_dir()
+                            if is_dir and not all(f.match_dir(entry.path) for f in filters):
+                                continue  # 被排除的文件夹，不进入也不返回
+                            if is_dir and not entry.is_symlink():
+                                submit(entry.path)
+                            stat = self.__stat(entry) if self.__with_stat or (
+                                    not is_dir and (old is not None or filter_stat)) else None
+                            if old is not None:  # 增量扫描，只要新的和变了的
+                                if is_dir:
+                                    subdirs.append(entry.name)
+                                    changed = last is None or entry.name not in last[2]
+                                else:
+                                    files[entry.name] = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+                                    changed = last is None or last[1].get(entry.name) != files[entry.name]
+                                if not changed:
+                                    continue
+                            if (is_dir and self.__dirs) or (not is_dir and self.__files):
+                                path_entry = WalkEntry(entry.path, is_dir, stat, self.__root)
+                                if is_dir or all(f.match_file(path_entry, stat) for f in filters):
+                                    batch.append(path_entry)
+                        except OSError:
+                            self.getLogger().exception("cannot scan %s" % entry.path)
+                        if len(batch) >= self.__batch_size:
+                            put(batch)
+                            batch = []
+                if len(batch) > 0:
+                    put(batch)
+                if old is not None:
+                    new[path] = [mtime, files, subdirs]
+                    if new[path] != last:
+                        dirty.set()
+            except OSError:
+                self.getLogger().exception("cannot scan %s" % path)
+                if last is not None:  # 这次没扫描成功就沿用上次的
+                    new[path] = last
+            finally:
+                with lock:
+                    pending -= 1
+                    finished = pending <= 0
+                if finished:
+                    put(None)  # 全部扫描完了
+
+        try:
+            submit(self.__root)
+            while True:
+                batch = await queue.get()
+                if batch is None:
+                    break
+                slots.release()
+                for entry in batch:
+                    yield entry
+        finally:
+            stopped.set()
+            executor.shutdown(wait=False)
+        if self.__snapshot is not None and (dirty.is_set() or len(new) != len(old)):  # 完整扫描完一遍才更新快照
+            self.__staged = new
+
+    def discard(self):
+        """丢掉还没commit的快照"""
+        self.__staged = None
+
+    async def commit(self):
+        """把上次完整扫描得到的快照写进快照文件，没有变化或是没扫描完就什么都不做"""
+        staged, self.__staged = self.__staged, None
+        if staged is not None:
+            await self.__snapshot.save(staged)
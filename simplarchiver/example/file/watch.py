@@ -0,0 +1,237 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+from datetime import timedelta
+from typing import Dict, List
+
+from simplarchiver import Feeder
+from .pathfilter import PathFilter
+from .walk import Walker
+
+# 见 /usr/include/linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class Inotify:
+    """用ctypes调用libc里的inotify，只在Linux上能用"""
+    libc = None
+
+    def __init__(self):
+        if Inotify.libc is None:
+            Inotify.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(Inotify.libc, 'inotify_init1'):
+            raise OSError("inotify is not supported on this system")
+        self.fd = Inotify.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+        wd = Inotify.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def rm_watch(self, wd: int):
+        Inotify.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self) -> List[tuple]:
+        """读出当前所有事件，返回 [(wd, mask, name)]"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events, pos = [], 0
+        while pos + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WatchFeeder(Feeder):
+    """
+    用inotify监视文件夹，有文件被创建、写入、移动进来时返回它的路径，只能在Linux上用
+    同一个文件在debounce时间内的多次变化只返回一次，等它安静下来才返回
+    新建或移动进来的文件夹会被递归监视，里面已有的文件也会返回
+    inotify事件队列溢出时会丢事件，这时会重新扫描整个文件夹，返回所有文件
+    第一轮开始时开始监视，之后一直监视到事件循环结束，两轮之间(Pair的interval)的变化留到下一轮返回
+    asyncio.run结束时会取消所有没完成的task，这时停止监视；自己管理事件循环的要在结束前调用close
+    """
+
+    def __init__(self, root: str, debounce: timedelta = timedelta(seconds=1), duration: timedelta = None,
+                 initial_scan: bool = False, workers: int = 8, path_filter: PathFilter = None):
+        """
+        debounce是文件安静多久之后才返回
+        duration是每轮返回多久，为None表示一直返回，get_feeds永远不会结束
+        到时间时还没安静下来的文件和还没扫描的文件夹留到下一轮，下一轮一开始就接着等它们安静下来
+        一直返回时这个Feeder会一直占着Pair的一个feeder_concurrency名额，Pair的interval对它也没有意义
+        所以要么单独放在一个Pair里，要么设置duration让它每轮返回一段时间
+        initial_scan表示开始监视时是否先返回已有的所有文件
+        workers是扫描新文件夹时用的线程数
+        path_filter是筛选条件，被排除的文件夹不监视
+        """
+        super().__init__()
+        self.__root = root
+        self.__debounce = debounce.total_seconds()
+        self.__duration = duration.total_seconds() if duration is not None else None
+        self.__initial_scan = initial_scan
+        self.__workers = workers
+        self.__path_filter = path_filter
+        self.__tag = None
+        self.__inotify = None
+        self.__loop = None  # 在哪个事件循环里监视
+        self.__wake = None
+        self.__reaper = None  # 等着被取消然后停止监视的task
+        self.__watching = False  # 整个文件夹是不是都监视上了
+        self.__wds: Dict[int, str] = {}  # wd -> 被监视的文件夹
+        self.__pending: Dict[str, float] = {}  # 路径 -> 什么时候可以返回，时间是loop.time()
+        self.__rescans: List[str] = []  # 要扫描并监视的文件夹
+
+    def setTag(self, tag: str = None):
+        super().setTag(tag)
+        self.__tag = tag  # 扫描新文件夹时的Walker也用这个tag
+
+    def __accept(self, path: str) -> bool:
+        if self.__path_filter is None:
+            return True
+        try:
+            return self.__path_filter.match_file(path, os.stat(path) if self.__path_filter.needs_stat else None)
+        except OSError:
+            return False
+
+    def __watch(self, path: str):
+        try:
+            self.__wds[self.__inotify.add_watch(path)] = path
+        except OSError as e:
+            self.getLogger().warning("cannot watch %s: %s" % (path, e))
+
+    def __unwatch(self, path: str):
+        """文件夹被移走了，它和它下面的监视都作废"""
+        for wd, p in list(self.__wds.items()):
+            if p == path or p.startswith(path + os.sep):
+                self.__inotify.rm_watch(wd)
+                self.__wds.pop(wd, None)
+
+    def __on_readable(self):
+        for wd, mask, name in self.__inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self.getLogger().warning("inotify queue overflow, rescan %s" % self.__root)
+                self.__rescans.append(self.__root)
+                continue
+            if mask & IN_IGNORED:
+                self.__wds.pop(wd, None)
+                continue
+            if wd not in self.__wds or not name:
+                continue
+            path = os.path.join(self.__wds[wd], name)
+            if mask & IN_ISDIR and self.__path_filter is not None and not self.__path_filter.match_dir(path):
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.__rescans.append(path)
+                elif mask & IN_MOVED_FROM:
+                    self.__unwatch(path)
+            elif mask & (IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.getLogger().debug("event      | %s" % path)
+                self.__pending[path] = self.__loop.time() + self.__debounce  # 每次变化都往后推
+        self.__wake.set()
+
+    async def __add_tree(self, path: str, with_files: bool):
+        """监视path和它下面的所有文件夹，with_files为True时把里面的文件都放进pending"""
+        self.__watch(path)  # 先监视再扫描，扫描期间新建的文件也不会漏
+        walker = Walker(path, files=with_files, dirs=True, workers=self.__workers, with_stat=False,
+                        path_filter=self.__path_filter)
+        walker.setTag(self.__tag)
+        async for p in walker.walk():
+            if p.is_dir:
+                if not os.path.islink(p):
+                    self.__watch(p)
+            else:
+                self.__pending[p] = self.__loop.time() + self.__debounce
+
+    def __attach(self, loop: asyncio.AbstractEventLoop):
+        """在loop里开始监视，inotify已经打开的话就接着用，在这之前的事件都还在inotify里"""
+        if self.__loop is loop:
+            return
+        if self.__inotify is None:
+            self.__inotify = Inotify()
+        elif self.__loop is not None and not self.__loop.is_closed():  # 换了事件循环，旧的事件循环不用再读了
+            self.__loop.remove_reader(self.__inotify.fd)
+        self.__loop, self.__wake = loop, asyncio.Event()
+        loop.add_reader(self.__inotify.fd, self.__on_readable)
+        self.__reaper = loop.create_task(self.__reap())
+
+    async def __reap(self):
+        """一直等到被取消(比如asyncio.run结束)，然后停止监视"""
+        try:
+            await asyncio.get_running_loop().create_future()
+        finally:
+            self.__reaper = None
+            self.close()
+
+    def close(self):
+        """停止监视，还没返回的文件都丢掉，之后再调用get_feeds会重新开始监视"""
+        if self.__reaper is not None and not self.__reaper.done():
+            self.__reaper.cancel()
+        self.__reaper = None
+        if self.__inotify is None:
+            return
+        if self.__loop is not None and not self.__loop.is_closed():
+            self.__loop.remove_reader(self.__inotify.fd)
+        self.__inotify.close()
+        self.__inotify, self.__loop, self.__wake, self.__watching = None, None, None, False
+        self.__wds.clear()
+        self.__pending.clear()
+        self.__rescans.clear()
+        self.getLogger().debug("stopped watching %s" % self.__root)
+
+    async def get_feeds(self):
+        loop = asyncio.get_running_loop()
+        self.__attach(loop)
+        end = loop.time() + self.__duration if self.__duration is not None else None
+        try:
+            if not self.__watching:
+                await self.__add_tree(self.__root, self.__initial_scan)
+                self.__watching = True
+                self.getLogger().debug("watching %d dirs under %s" % (len(self.__wds), self.__root))
+            while end is None or loop.time() < end:
+                self.__wake.clear()
+                while len(self.__rescans) > 0:
+                    await self.__add_tree(self.__rescans.pop(), True)
+                now = loop.time()
+                for path in [p for p, t in self.__pending.items() if t <= now]:
+                    del self.__pending[path]
+                    if os.path.isfile(path) and self.__accept(path):  # 安静下来之前可能已经被删掉或移走了
+                        self.getLogger().debug("file found | %s" % path)
+                        yield path
+                timeouts = [t - loop.time() for t in self.__pending.values()]
+                if end is not None:
+                    timeouts.append(end - loop.time())
+                try:
+                    await asyncio.wait_for(self.__wake.wait(), max(min(timeouts), 0) if len(timeouts) > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if len(self.__pending) + len(self.__rescans) > 0:  # 还在监视，它们留到下一轮
+                self.getLogger().debug("%d files and %d dirs left to next round" % (
+                    len(self.__pending), len(self.__rescans)))
@@ -1,4 +1,10 @@
 import asyncio
+import concurrent.futures
+import json
+import threading
+import weakref
+from datetime import timedelta
+from typing import Dict, List, Tuple, Optional
 
 import qbittorrentapi
 
@@ -6,23 +12,131 @@ from simplarchiver import Downloader
 
 
 class QBittorrentDownloader(Downloader):
-    """用qBittorrent Web API下载种子文件"""
+    """
+    用qBittorrent Web API下载种子文件
+    同样设置的QBittorrentDownloader共用一个登录好的qbittorrentapi.Client，登录失效(403)时重新登录再试一次
+    batch_window时间内到达的、除了urls和torrent_files之外参数都一样的item合并成一次torrents_add调用
+    所有请求都在一个专用的小线程池里进行，不占用默认线程池
+    """
+    clients: Dict[str, qbittorrentapi.Client] = {}  # 设置 -> 登录好的Client
+    clients_lock = threading.Lock()
+    executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
 
-    def __init__(self, **qb_cli_opt):
-        """qb_cli_opt是用于运行时创建qbittorrentapi.client.Client的输入参数"""
+    def __init__(self, batch_window: timedelta = timedelta(seconds=0.5), max_batch: int = 50, **qb_cli_opt):
+        """
+        qb_cli_opt是用于运行时创建qbittorrentapi.client.Client的输入参数
+        batch_window是等多久把到达的item攒成一批，max_batch是一批最多多少个，攒够了就不等了
+        """
         super().__init__()
         self.qb_cli_opt = qb_cli_opt
+        self.__batch_window = batch_window.total_seconds()
+        self.__max_batch = max_batch
+        self.__key = json.dumps(qb_cli_opt, sort_keys=True, default=str)
+        self.__pending = weakref.WeakKeyDictionary()  # 事件循环 -> {合并用的key: [(kwargs, future)]}
+        self.__timers = weakref.WeakKeyDictionary()  # 事件循环 -> {合并用的key: 到时间提交这一批的task}
+        self.__tasks = set()  # 还在跑的提交任务，留着引用免得被回收
+
+    def __client(self) -> qbittorrentapi.Client:
+        with QBittorrentDownloader.clients_lock:
+            client = QBittorrentDownloader.clients.get(self.__key)
+            if client is None:
+                client = qbittorrentapi.Client(**self.qb_cli_opt)
+                client.auth_log_in()
+                QBittorrentDownloader.clients[self.__key] = client
+                self.getLogger().info("Logged in to qBittorrent")
+            return client
+
+    def __log_in_again(self, client: qbittorrentapi.Client):
+        with QBittorrentDownloader.clients_lock:
+            self.getLogger().info("Session expired, log in to qBittorrent again")
+            try:
+                client.auth_log_in()
+            except Exception:
+                QBittorrentDownloader.clients.pop(self.__key, None)  # 下次重新创建Client
+                raise
 
     def __torrent_add(self, kwargs):
         try:
-            qbt_client = qbittorrentapi.Client(**self.qb_cli_opt)
-            qbt_client.auth_log_in()
-            return qbt_client.torrents_add(**kwargs)
+            client = self.__client()
+            try:
+                return client.torrents_add(**kwargs)
+            except qbittorrentapi.Forbidden403Error:
+                self.__log_in_again(client)
+                return client.torrents_add(**kwargs)
         except Exception as e:
             self.getLogger().exception(e)
             return e
 
+    @staticmethod
+    def __as_list(value) -> List:
+        if value is None:
+            return []
+        return [value] if isinstance(value, str) else list(value)
+
+    @staticmethod
+    def __group(kwargs: dict) -> str:
+        """参数里除了urls和torrent_files都一样的item可以合并，torrent_files不是路径的不合并"""
+        files = kwargs.get('torrent_files')
+        if files is not None and not isinstance(files, str) and not (
+                isinstance(files, (list, tuple)) and all(isinstance(f, str) for f in files)):
+            return 'alone:%d' % id(kwargs)
+        return json.dumps({k: v for k, v in kwargs.items() if k not in ('urls', 'torrent_files')},
+                          sort_keys=True, default=str)
+
+    async def __run(self, kwargs):
+        if QBittorrentDownloader.executor is None:
+            QBittorrentDownloader.executor = concurrent.futures.ThreadPoolExecutor(
+                2, thread_name_prefix="QBittorrentDownloader")
+        return await asyncio.get_running_loop().run_in_executor(
+            QBittorrentDownloader.executor, self.__torrent_add, kwargs)
+
+    async def __submit(self, batch: List[Tuple[dict, asyncio.Future]]):
+        if len(batch) == 1:
+            result = await self.__run(batch[0][0])
+            results = [result]
+        else:
+            merged = dict(batch[0][0])
+            urls = [u for kwargs, _ in batch for u in self.__as_list(kwargs.get('urls'))]
+            files = [f for kwargs, _ in batch for f in self.__as_list(kwargs.get('torrent_files'))]
+            merged['urls'] = urls if len(urls) > 0 else None
+            merged['torrent_files'] = files if len(files) > 0 else None
+            self.getLogger().debug("add %d items in one request" % len(batch))
+            result = await self.__run(merged)
+            if result == 'Ok.':
+                results = [result] * len(batch)
+            else:  # 不知道是哪个失败了，一个一个重新加
+                self.getLogger().warning("batch of %d items failed: %s, add them one by one" % (len(batch), result))
+                results = await asyncio.gather(*[self.__run(kwargs) for kwargs, _ in batch])
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def __flush(self, pending: Dict[str, list], timers: Dict[str, asyncio.Task], group: str):
+        timer = timers.pop(group, None)
+        if timer is not None:  # 攒够了提前提交，这一批的计时作废，免得到时间把下一批也提前提交了
+            timer.cancel()
+        batch = pending.pop(group, None)
+        if batch:
+            task = asyncio.create_task(self.__submit(batch))
+            self.__tasks.add(task)
+            task.add_done_callback(self.__tasks.discard)
+
+    async def __flush_later(self, pending: Dict[str, list], timers: Dict[str, asyncio.Task], group: str):
+        await asyncio.sleep(self.__batch_window)
+        timers.pop(group, None)
+        self.__flush(pending, timers, group)
+
     async def download(self, item):
         """下载输入的item实际上是qbittorrentapi.Client。torrents_add的输入参数**kwargs"""
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, self.__torrent_add, item)
+        loop = asyncio.get_running_loop()
+        pending = self.__pending.setdefault(loop, {})
+        timers = self.__timers.setdefault(loop, {})
+        group = self.__group(item)
+        future = loop.create_future()
+        if group not in pending:
+            pending[group] = []
+            timers[group] = asyncio.create_task(self.__flush_later(pending, timers, group))
+        pending[group].append((item, future))
+        if len(pending[group]) >= self.__max_batch:
+            self.__flush(pending, timers, group)
+        return await future
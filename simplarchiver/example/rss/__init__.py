@@ -2,3 +2,5 @@ from .rsshub import RSSHubFeeder, RSSHubMultiPageFeeder
 from .filter import TTRSSHubLinkFeeder, TTRSSHubLinkDownloader
 from .filter import EnclosureOnlyDownloader, EnclosureExceptDownloader
 from .ttrss import TTRSSGenFeeder, TTRSSCatFeeder
+from .common import ConditionalGetCache, HedgePolicy, SeenSet, host_scheduler
+from .httpcache import HttpCache, cached_httpx_client_opt_generator
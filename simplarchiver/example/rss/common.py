@@ -1,8 +1,594 @@
+import asyncio
+import codecs
+import collections
+import contextlib
+import copy
+import hashlib
+import json
+import logging
+import os
+import struct
+import time
+import weakref
+from typing import Dict, Callable, List, AsyncIterator, Set, Any, Tuple, Optional
+from urllib.parse import urlparse
+from xml.etree import ElementTree
+
+import aiofiles
 import httpx
 
+from simplarchiver import Logger
+from ..storage import JSONFile, LoopLocal, DelayedSave, write_file
+
 
 def default_httpx_client_opt_generator():
     return {
         'timeout': httpx.Timeout(10.0),
         'transport': httpx.AsyncHTTPTransport(retries=5)
     }
+
+
+def httpx_client_opt_generator(timeout: float = 10.0, retries: int = 5,
+                               max_connections: int = 100, max_keepalive_connections: int = 20,
+                               keepalive_expiry: float = 30.0, http2: bool = False) -> Callable[[], Dict]:
+    """
+    生成一个httpx_client_opt_generator，可以设置连接池大小、keep-alive时长以及是否使用HTTP/2
+    HTTP/2需要安装h2(pip install httpx[http2])，没有安装时退回HTTP/1.1
+    """
+    if http2:
+        try:
+            import h2
+        except ImportError:
+            logging.getLogger("httpx_client_opt_generator").warning("h2 is not installed, fall back to HTTP/1.1")
+            http2 = False
+
+    def generator():
+        return {
+            'timeout': httpx.Timeout(timeout),
+            'transport': httpx.AsyncHTTPTransport(
+                retries=retries, http2=http2,
+                limits=httpx.Limits(max_connections=max_connections,
+                                    max_keepalive_connections=max_keepalive_connections,
+                                    keepalive_expiry=keepalive_expiry))
+        }
+
+    return generator
+
+
+async def aiter_xml_elements(chunks: AsyncIterator[bytes], tags: Set[str]):
+    """
+    边下载边解析XML，每当tags里的标签闭合时就yield (元素, 父元素)
+    yield之后该元素会被清空并从父元素中删掉，解析大文件时内存占用不会一直增长
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    parents: List[ElementTree.Element] = []
+    async for chunk in chunks:
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if event == 'start':
+                parents.append(elem)
+                continue
+            parents.pop()
+            if elem.tag in tags:
+                parent = parents[-1] if len(parents) > 0 else None
+                yield elem, parent
+                elem.clear()
+                if parent is not None:
+                    parent.remove(elem)
+    parser.close()
+
+
+class JSONStream:
+    """边下载边解析JSON用的缓冲区，按需从chunks里读取更多内容"""
+
+    def __init__(self, chunks: AsyncIterator[bytes]):
+        self.__chunks = chunks.__aiter__()
+        self.__utf8 = codecs.getincrementaldecoder('utf8')()  # 多字节字符可能被截断在chunk边界上
+        self.__decoder = json.JSONDecoder()
+        self.__buf, self.__pos, self.__eof = '', 0, False
+
+    async def __more(self):
+        try:
+            text = self.__utf8.decode(await self.__chunks.__anext__())
+        except StopAsyncIteration:
+            self.__eof = True
+            text = self.__utf8.decode(b'', final=True)
+        self.__buf, self.__pos = self.__buf[self.__pos:] + text, 0  # 丢掉已经解析过的部分
+
+    async def peek(self) -> str:
+        """跳过空白，返回下一个字符，读完了返回空字符串"""
+        while True:
+            while self.__pos < len(self.__buf) and self.__buf[self.__pos] in ' \t\r\n':
+                self.__pos += 1
+            if self.__pos < len(self.__buf):
+                return self.__buf[self.__pos]
+            if self.__eof:
+                return ''
+            await self.__more()
+
+    async def expect(self, chars: str) -> str:
+        """跳过空白，读取一个chars里的字符并返回"""
+        c = await self.peek()
+        if c == '' or c not in chars:
+            raise ValueError("expect one of %s but got %s" % (list(chars), repr(c)))
+        self.__pos += 1
+        return c
+
+    async def value(self) -> Any:
+        """跳过空白，读取一个完整的JSON值"""
+        await self.peek()
+        while True:
+            try:
+                obj, end = self.__decoder.raw_decode(self.__buf, self.__pos)
+                # 数字可能被截断在chunk边界上，后面跟着不是数字的字符才能确定读完了
+                if self.__eof or (end < len(self.__buf) and self.__buf[end] not in '0123456789.eE+-'):
+                    self.__pos = end
+                    return obj
+            except ValueError:
+                if self.__eof:
+                    raise
+            await self.__more()
+
+
+async def aiter_json_array(chunks: AsyncIterator[bytes], key: str):
+    """
+    边下载边解析JSON，最外层是一个对象，逐个yield其中key对应的数组里的元素
+    读完这个数组就返回，不再解析后面的内容；找不到key时抛出KeyError
+    """
+    stream = JSONStream(chunks)
+    await stream.expect('{')
+    if await stream.peek() == '}':
+        raise KeyError(key)
+    while True:
+        k = await stream.value()
+        await stream.expect(':')
+        if k == key and await stream.peek() == '[':
+            await stream.expect('[')
+            if await stream.peek() == ']':
+                return
+            while True:
+                yield await stream.value()
+                if await stream.expect(',]') == ']':
+                    return
+        await stream.value()
+        if await stream.expect(',}') == '}':
+            raise KeyError(key)
+
+
+class HostScheduler(Logger):
+    """
+    按host调度请求：每个host最多同时发起多少个请求、相邻两个请求最少间隔多少秒
+    超出的请求按先来后到排队，服务器返回429/503并带有Retry-After时，这个host后面的请求都等到那之后再发
+    一个请求从发出一直占着名额到响应读完，边下载边解析时下游处理得慢也会一直占着，所以最多占max_hold秒就把名额让出来
+    对冲请求(request.extensions里有'hedge')不占名额，不然并发数为1时它只能排在被对冲的慢请求后面，起不了作用
+    """
+
+    def __init__(self, concurrency: int = None, min_interval: float = 0.0, max_hold: float = 30.0):
+        """
+        concurrency和min_interval是没有单独设置的host用的默认值，concurrency为None表示不限
+        max_hold是一个请求最多占着名额多少秒，超过了即使响应还没读完也让给别的请求，为None表示不限
+        """
+        super().__init__()
+        self.__default = (concurrency, min_interval)
+        self.max_hold = max_hold
+        self.__config: Dict[str, Tuple[Optional[int], float]] = {}  # host -> (concurrency, min_interval)
+        self.__states = weakref.WeakKeyDictionary()  # 事件循环 -> {host: 状态}，asyncio的锁只能在一个事件循环里用
+
+    def set_default(self, concurrency: int = None, min_interval: float = 0.0):
+        self.__default = (concurrency, min_interval)
+
+    def configure(self, host: str, concurrency: int = None, min_interval: float = 0.0):
+        """单独设置一个host，host和url里的一样，带端口号的要写上端口号"""
+        self.__config[host] = (concurrency, min_interval)
+
+    def __state(self, host: str) -> Dict:
+        loop = asyncio.get_running_loop()
+        if loop not in self.__states:
+            self.__states[loop] = {}
+        states = self.__states[loop]
+        config = self.__config.get(host, self.__default)
+        if host not in states or states[host]['config'] != config:  # 设置变了就按新的来
+            concurrency, _ = config
+            states[host] = {
+                'config': config,
+                'sem': asyncio.Semaphore(concurrency) if concurrency is not None else None,
+                'lock': asyncio.Lock(),
+                'last': None,  # 上一个请求发出的时间
+                'not_before': 0.0  # Retry-After要求的时间
+            }
+        return states[host]
+
+    async def acquire(self, host: str, slot: bool = True) -> Dict:
+        """排队等到可以向host发请求，返回的状态要交给release，slot为False时不占名额，只遵守间隔和Retry-After"""
+        state = self.__state(host)
+        if slot and state['sem'] is not None:
+            await state['sem'].acquire()
+        try:
+            _, min_interval = state['config']
+            async with state['lock']:
+                loop = asyncio.get_running_loop()
+                start = state['not_before']
+                if state['last'] is not None:
+                    start = max(start, state['last'] + min_interval)
+                if start > loop.time():
+                    self.getLogger().debug("wait %.3fs before requesting %s" % (start - loop.time(), host))
+                    await asyncio.sleep(start - loop.time())
+                state['last'] = loop.time()
+        except BaseException:
+            self.release(state, slot)
+            raise
+        return state
+
+    def release(self, state: Dict, slot: bool = True):
+        """slot要和acquire时的一样"""
+        if slot and state['sem'] is not None:
+            state['sem'].release()
+
+    def retry_after(self, state: Dict, response: httpx.Response):
+        """服务器要求稍后再试时，推迟这个host后面的所有请求"""
+        if response.status_code not in (429, 503):
+            return
+        value = response.headers.get('Retry-After', '')
+        if value.isdigit():
+            state['not_before'] = asyncio.get_running_loop().time() + int(value)
+            self.getLogger().warning("%s asks to retry after %ss" % (response.url.netloc.decode(), value))
+
+
+host_scheduler = HostScheduler()
+
+
+class HostScheduledStream(httpx.AsyncByteStream):
+    """
+    响应读完或是关闭时把名额还给HostScheduler，以先到者为准
+    边下载边解析时下游处理得慢会一直占着名额，所以最多占max_hold秒，到时间了还没读完也先还回去
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None], max_hold: float = None):
+        self.__stream = stream
+        self.__release = release
+        self.__timer = asyncio.get_running_loop().call_later(max_hold, self.__release_once) \
+            if max_hold is not None else None
+
+    def __release_once(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        if self.__release is not None:
+            self.__release()
+            self.__release = None
+
+    async def __aiter__(self):
+        async for chunk in self.__stream:
+            yield chunk
+        self.__release_once()  # 读完了就不用再占着名额，不用等到关闭
+
+    async def aclose(self):
+        try:
+            await self.__stream.aclose()
+        finally:
+            self.__release_once()
+
+
+class HostScheduledTransport(httpx.AsyncBaseTransport):
+    """套在httpx的transport外面，每个请求都先经过HostScheduler排队"""
+    scheduled = True
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, scheduler: HostScheduler = None):
+        self.__transport = transport
+        self.__scheduler = scheduler or host_scheduler
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        slot = not request.extensions.get('hedge', False)  # 对冲请求不占名额
+        state = await self.__scheduler.acquire(request.url.netloc.decode(), slot)
+        try:
+            response = await self.__transport.handle_async_request(request)
+        except BaseException:
+            self.__scheduler.release(state, slot)
+            raise
+        self.__scheduler.retry_after(state, response)
+        response.stream = HostScheduledStream(response.stream, lambda: self.__scheduler.release(state, slot),
+                                              self.__scheduler.max_hold)
+        return response
+
+    async def aclose(self):
+        await self.__transport.aclose()
+
+
+def scheduled_transport(transport: httpx.AsyncBaseTransport = None) -> httpx.AsyncBaseTransport:
+    """给transport套上HostScheduledTransport，已经套过的不再重复套"""
+    transport = transport or httpx.AsyncHTTPTransport()
+    if getattr(transport, 'scheduled', False):
+        return transport
+    return HostScheduledTransport(transport)
+
+
+class HttpxClientPool(Logger):
+    """
+    共享的httpx.AsyncClient池
+    同一个事件循环里，同一个host、同一个httpx_client_opt_generator的请求共用一个httpx.AsyncClient
+    这样多次请求之间可以复用keep-alive连接，不用每次都重新握手
+    所有client的请求都经过host_scheduler排队
+    httpx.AsyncClient里的连接只能在创建它的事件循环里用，所以每个事件循环各有一套client
+    每个事件循环里都有一个等着被取消的task，asyncio.run结束时会取消所有没完成的task，这时关闭这个事件循环的所有client
+    自己管理事件循环、结束时不取消task的，要在事件循环结束前调用aclose
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.__clients: Dict[asyncio.AbstractEventLoop, Dict] = {}  # 事件循环 -> {(host, opt生成器): client}
+        self.__reapers: Dict[asyncio.AbstractEventLoop, asyncio.Task] = {}  # 事件循环 -> 关闭client的task
+
+    def client(self, url: str, httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator
+               ) -> httpx.AsyncClient:
+        """获取请求url所用的client，只能在事件循环里调用，返回的client不要关闭"""
+        loop = asyncio.get_running_loop()
+        if loop not in self.__clients:
+            self.__clients[loop] = {}
+            self.__reapers[loop] = loop.create_task(self.__reap(loop))
+        clients = self.__clients[loop]
+        key = (urlparse(url).netloc, httpx_client_opt_generator)
+        if key not in clients or clients[key].is_closed:
+            self.getLogger().debug("new httpx client for %s" % key[0])
+            opt = httpx_client_opt_generator()
+            opt['transport'] = scheduled_transport(opt.get('transport'))  # 所有请求都要经过host_scheduler
+            clients[key] = httpx.AsyncClient(**opt)
+        return clients[key]
+
+    async def __reap(self, loop: asyncio.AbstractEventLoop):
+        """一直等到被取消，然后关闭这个事件循环的所有client"""
+        try:
+            await loop.create_future()
+        finally:
+            self.__reapers.pop(loop, None)
+            await self.__close(loop)
+
+    async def __close(self, loop: asyncio.AbstractEventLoop):
+        clients = self.__clients.pop(loop, {})
+        if len(clients) > 0:
+            self.getLogger().debug("close %d httpx clients" % len(clients))
+        for client in clients.values():
+            try:
+                await client.aclose()
+            except Exception:
+                self.getLogger().exception("Catch an Exception when closing httpx client:")
+
+    async def aclose(self):
+        """关闭当前事件循环里的所有client"""
+        loop = asyncio.get_running_loop()
+        reaper = self.__reapers.pop(loop, None)
+        if reaper is not None:
+            reaper.cancel()
+        await self.__close(loop)
+
+    def __len__(self):
+        """有client的事件循环数"""
+        return len(self.__clients)
+
+
+httpx_client_pool = HttpxClientPool()
+
+
+class HedgePolicy(Logger):
+    """
+    对冲请求：请求发出后过了一段时间还没有响应，就再发一个一样的请求(或是发给镜像)，哪个先响应就用哪个，另一个取消掉
+    等待的时间是最近响应时间的分位数，这样只有慢得不正常的请求才会被对冲
+    被取消的慢请求也记下它等了多久，这是它响应时间的下限，不记的话分位数会越来越小，对冲得越来越频繁
+    对冲请求不占HostScheduler的名额
+    """
+
+    def __init__(self, percentile: float = 0.95, min_delay: float = 1.0, max_delay: float = 30.0,
+                 window: int = 100, min_samples: int = 10, mirror: Callable[[str], Optional[str]] = None):
+        """
+        percentile是用最近响应时间的多少分位数作为等待时间，结果限制在min_delay和max_delay之间
+        window是记录最近多少次响应时间，记录不到min_samples次时等待max_delay
+        mirror是一个函数，输入url返回对冲请求要发往的url，为None或返回None时还是发往原来的url
+        """
+        super().__init__()
+        self.__percentile = percentile
+        self.__min_delay = min_delay
+        self.__max_delay = max_delay
+        self.__min_samples = min_samples
+        self.__mirror = mirror
+        self.__latencies = collections.deque(maxlen=window)
+        self.requests = 0  # 发起的请求数
+        self.hedged = 0  # 发出了对冲请求的次数
+        self.hedge_wins = 0  # 对冲请求先响应的次数
+
+    def delay(self) -> float:
+        """发对冲请求之前要等多久"""
+        if len(self.__latencies) < self.__min_samples:
+            return self.__max_delay
+        latencies = sorted(self.__latencies)
+        delay = latencies[int(self.__percentile * (len(latencies) - 1))]
+        return min(max(delay, self.__min_delay), self.__max_delay)
+
+    async def __send(self, url: str, headers: Dict[str, str],
+                     httpx_client_opt_generator: Callable[[], Dict], hedge: bool = False) -> httpx.Response:
+        client = httpx_client_pool.client(url, httpx_client_opt_generator)
+        request = client.build_request('GET', url, headers=headers, extensions={'hedge': True} if hedge else None)
+        start = time.monotonic()
+        try:
+            response = await client.send(request, stream=True)
+        except asyncio.CancelledError:
+            self.__latencies.append(time.monotonic() - start)  # 输给了另一个请求，至少要这么久
+            raise
+        self.__latencies.append(time.monotonic() - start)
+        return response
+
+    async def send(self, url: str, headers: Dict[str, str],
+                   httpx_client_opt_generator: Callable[[], Dict]) -> httpx.Response:
+        """发起GET请求，返回已经收到header的response，用完要关闭"""
+        self.requests += 1
+        delay = self.delay()
+        primary = asyncio.create_task(self.__send(url, headers, httpx_client_opt_generator))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if primary in done:
+                return primary.result()
+            hedge_url = (self.__mirror(url) if self.__mirror is not None else None) or url
+            self.hedged += 1
+            self.getLogger().debug("no response from %s in %.3fs, send hedged request to %s" % (url, delay, hedge_url))
+            hedge = asyncio.create_task(self.__send(hedge_url, headers, httpx_client_opt_generator, True))
+            pending = {primary, hedge}
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in [primary, hedge] if task in done and task.exception() is None]
+                if len(winners) <= 0:  # 先完成的出错了就等另一个
+                    continue
+                for task in winners[1:]:  # 同时完成的只留一个
+                    await task.result().aclose()
+                if winners[0] is hedge:
+                    self.hedge_wins += 1
+                self.getLogger().debug("%s request won: %s" % ("hedged" if winners[0] is hedge else "primary", url))
+                return winners[0].result()
+            return primary.result()  # 都出错了就抛出原请求的错误
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+@contextlib.asynccontextmanager
+async def stream_get(url: str, headers: Dict[str, str], httpx_client_opt_generator: Callable[[], Dict],
+                     hedge: HedgePolicy = None):
+    """用连接池里的client发起GET请求并以流的方式读取响应，给了hedge就按对冲请求发起"""
+    if hedge is None:
+        client = httpx_client_pool.client(url, httpx_client_opt_generator)
+        async with client.stream('GET', url, headers=headers) as response:
+            yield response
+        return
+    response = await hedge.send(url, headers, httpx_client_opt_generator)
+    try:
+        yield response
+    finally:
+        await response.aclose()
+
+
+class SeenSet(Logger):
+    """
+    按feed url记录见过的item，每个item只记它link的8字节blake2b摘要，每个feed最多记max_entries个
+    记录文件是二进制的：每个feed依次是 url的摘要(8字节) 摘要个数(4字节) 摘要们(每个8字节)
+    超出max_entries时丢掉最久没在feed里出现过的
+    """
+    MAGIC = b'SEEN1'
+
+    def __init__(self, path: str = None, max_entries: int = 1024):
+        """path是记录文件的路径，为None表示只记在内存里"""
+        super().__init__()
+        self.__path = path
+        self.__max_entries = max_entries
+        self.__data: Dict[bytes, List[bytes]] = None  # url的摘要 -> 摘要列表，越新的越靠前
+        self.__lock = LoopLocal(asyncio.Lock)
+
+    @staticmethod
+    def digest(key: str) -> bytes:
+        return hashlib.blake2b(key.encode('utf8'), digest_size=8).digest()
+
+    async def __load(self) -> Dict[bytes, List[bytes]]:
+        if self.__data is not None:
+            return self.__data
+        self.__data = {}
+        if self.__path is None or not os.path.isfile(self.__path):
+            return self.__data
+        try:
+            async with aiofiles.open(self.__path, 'rb') as f:
+                raw = await f.read()
+            if raw[:len(self.MAGIC)] != self.MAGIC:
+                raise ValueError("not a seen set file")
+            pos = len(self.MAGIC)
+            while pos < len(raw):
+                url, n = struct.unpack_from('>8sI', raw, pos)
+                pos += 12
+                self.__data[url] = [raw[i:i + 8] for i in range(pos, pos + n * 8, 8)]
+                pos += n * 8
+            self.getLogger().debug("Loaded seen items of %d feeds from %s" % (len(self.__data), self.__path))
+        except Exception as e:
+            self.getLogger().exception("Seen set file has error %s" % e)
+        return self.__data
+
+    async def seen(self, url: str) -> Set[bytes]:
+        """这个feed以前见过的item的摘要"""
+        return set((await self.__load()).get(self.digest(url), []))
+
+    async def update(self, url: str, digests: List[bytes]):
+        """记下这一轮feed里所有item的摘要，新的在前，旧的里面没在这一轮出现的排在后面"""
+        data = await self.__load()
+        key = self.digest(url)
+        current = set(digests)
+        merged = list(dict.fromkeys(digests)) + [d for d in data.get(key, []) if d not in current]
+        data[key] = merged[:self.__max_entries]
+        await self.__save()
+
+    async def __save(self):
+        if self.__path is None:
+            return
+        async with self.__lock.get():
+            raw = [self.MAGIC]
+            for url, digests in self.__data.items():
+                raw.append(struct.pack('>8sI', url, len(digests)))
+                raw.extend(digests)
+            await write_file(self.__path, b''.join(raw))
+
+
+class ConditionalGetCache(Logger):
+    """
+    按url记录服务器返回的ETag和Last-Modified，下次请求时带上If-None-Match和If-Modified-Since
+    服务器返回304时说明内容没变，可以不下载也不解析，直接重放上次解析出来的item
+    记录和重放的item都是复制出来的，后面的Filter和Downloader改了item也不会影响记录
+    有更新时过save_delay秒才写文件，这期间的更新攒在一起只写一次；事件循环结束时还没写的也会写掉
+    """
+
+    def __init__(self, path: str = None, replay: bool = True, save_delay: float = 1.0):
+        """
+        path是记录文件的路径，为None表示只记在内存里
+        replay表示304时是否重放上次解析出来的item，为False时304就什么都不返回
+        save_delay是有更新之后等多少秒再写文件
+        """
+        super().__init__()
+        self.__file = JSONFile(path)  # url -> {'etag', 'last_modified', 'items'}
+        self.__replay = replay
+        self.__saving = DelayedSave(self.__file.save, save_delay)
+
+    def setTag(self, tag: str = None):
+        super().setTag(tag)
+        self.__file.setTag(tag)
+        self.__saving.setTag(tag)
+
+    async def headers(self, url: str) -> Dict[str, str]:
+        """发起请求时要带上的header"""
+        cache = await self.__file.load()
+        headers = {}
+        if url in cache:
+            if cache[url].get('etag') is not None:
+                headers['If-None-Match'] = cache[url]['etag']
+            if cache[url].get('last_modified') is not None:
+                headers['If-Modified-Since'] = cache[url]['last_modified']
+        self.getLogger().debug("validators of %s: %s" % (url, headers))
+        return headers
+
+    async def items(self, url: str) -> List:
+        """收到304后要重放的item"""
+        cache = await self.__file.load()
+        if not self.__replay or url not in cache:
+            return []
+        return copy.deepcopy(cache[url].get('items', []))
+
+    async def update(self, url: str, headers: httpx.Headers, items: List):
+        """收到200并解析完之后记录下新的ETag、Last-Modified和解析出来的item"""
+        cache = await self.__file.load()
+        etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+        if etag is None and last_modified is None:  # 服务器不支持条件请求就没必要记录
+            if cache.pop(url, None) is not None:
+                self.__saving.schedule()
+            return
+        record = {'etag': etag, 'last_modified': last_modified}
+        if self.__replay:
+            record['items'] = copy.deepcopy(items)
+        if cache.get(url) == record:
+            return
+        cache[url] = record
+        self.__saving.schedule()
+
+    async def save(self):
+        """立即写文件"""
+        await self.__saving.flush()
@@ -1,10 +1,9 @@
-from typing import Dict, Callable
-from xml.etree import ElementTree
-
-import httpx
+import time
+from datetime import timedelta
+from typing import Dict, Callable, Tuple
 
 from simplarchiver import Feeder, Filter, FilterFeeder, FilterDownloader, Downloader
-from .common import default_httpx_client_opt_generator
+from .common import default_httpx_client_opt_generator, httpx_client_pool, aiter_xml_elements
 
 
 class TTRSSHubLinkFilter(Filter):
@@ -13,13 +12,40 @@ class TTRSSHubLinkFilter(Filter):
     实际上就是在filter中根据TTRSS返回的item["link"]获取RSS Feed里面的link标签内容，以此替换item["link"]
     """
 
-    def __init__(self, httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator):
+    def __init__(self, httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator,
+                 cache_ttl: timedelta = None):
         """
         httpx_client_opt_generator是一个函数，返回发起请求所用的httpx.AsyncClient()设置
-        httpx.AsyncHTTPTransport不能重复使用，所以每次都得返回新的
+        同一个事件循环里同一个host的请求共享一个client，每个client调用一次此函数
+        cache_ttl是feed_url -> (link, pubDate)缓存的有效期，有效期内同一个feed_url不再重复下载，为None表示不缓存
         """
         super().__init__()
         self.httpx_client_opt_generator = httpx_client_opt_generator
+        self.__ttl = cache_ttl.total_seconds() if cache_ttl is not None else None
+        self.__cache: Dict[str, Tuple[str, str, float]] = {}  # feed_url -> (link, pubDate, 记录时间)
+
+    async def __resolve(self, feed_url: str) -> Tuple[str, str]:
+        """边下载边解析，拿到channel的link和第一个item的pubDate就断开，不下载剩下的内容"""
+        link, pubDate, first_item = None, None, False
+        client = httpx_client_pool.client(feed_url, self.httpx_client_opt_generator)
+        async with client.stream('GET', feed_url) as response:
+            elements = aiter_xml_elements(response.aiter_bytes(), {'link', 'item'})
+            try:
+                async for elem, parent in elements:
+                    if elem.tag == 'link' and parent is not None and parent.tag == 'channel':
+                        link = elem.text
+                    elif elem.tag == 'item' and not first_item:
+                        first_item = True
+                        pubDate = elem.findtext('pubDate')
+                    if link is not None and first_item:
+                        break
+            finally:
+                await elements.aclose()
+        if link is None:
+            raise ValueError("no channel link in %s" % feed_url)
+        if not first_item:
+            raise ValueError("no item in %s" % feed_url)
+        return link, pubDate
 
     async def filter(self, item):
         """
@@ -28,28 +54,32 @@ class TTRSSHubLinkFilter(Filter):
         专为TTRSSHubLinkFeeder和TTRSSHubLinkDownloader设计
         """
         feed_url = item["feed_url"]
+        cached = self.__cache.get(feed_url)
+        if cached is not None and time.monotonic() - cached[2] <= self.__ttl:
+            item["link"], item['pubDate'] = cached[0], cached[1]
+            self.getLogger().debug("got the original link of %s from cache: %s" % (feed_url, item["link"]))
+            return item
         self.getLogger().debug("getting the original link of %s" % feed_url)
-        async with httpx.AsyncClient(**self.httpx_client_opt_generator()) as client:
-            response = await client.get(feed_url)
-            root = ElementTree.XML(response.content)
-            channel = root.find('channel')
-            link = channel.find('link').text
-            item["link"] = link
-            item['pubDate'] = list(root.iter('item'))[0].find('pubDate').text
+        link, pubDate = await self.__resolve(feed_url)
+        if self.__ttl is not None:
+            self.__cache[feed_url] = (link, pubDate, time.monotonic())
+        item["link"], item['pubDate'] = link, pubDate
         self.getLogger().debug("got the original link of %s: %s" % (feed_url, item["link"]))
         return item
 
 
 def TTRSSHubLinkFeeder(base_feeder: Feeder,
-                       httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator):
-    f = FilterFeeder(base_feeder, TTRSSHubLinkFilter(httpx_client_opt_generator))
+                       httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator,
+                       cache_ttl: timedelta = None):
+    f = FilterFeeder(base_feeder, TTRSSHubLinkFilter(httpx_client_opt_generator, cache_ttl))
     f.setTag('TTRSSHubLinkFeeder')
     return f
 
 
 def TTRSSHubLinkDownloader(base_downloader: Downloader,
-                           httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator):
-    f = FilterDownloader(base_downloader, TTRSSHubLinkFilter(httpx_client_opt_generator))
+                           httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator,
+                           cache_ttl: timedelta = None):
+    f = FilterDownloader(base_downloader, TTRSSHubLinkFilter(httpx_client_opt_generator, cache_ttl))
     f.setTag('TTRSSHubLinkDownloader')
     return f
 
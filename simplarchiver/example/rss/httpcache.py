@@ -0,0 +1,242 @@
+import asyncio
+import hashlib
+import mmap
+import os
+import time
+import zlib
+from email.utils import parsedate_to_datetime
+from typing import Dict, Callable, List, Optional, Tuple
+
+import httpx
+
+from simplarchiver import Logger
+from ..storage import replace_file
+from .common import default_httpx_client_opt_generator, JSONFile, scheduled_transport
+
+
+def parse_cache_control(value: str) -> Dict[str, Optional[str]]:
+    """Cache-Control: max-age=60, no-cache -> {'max-age': '60', 'no-cache': None}"""
+    directives = {}
+    for part in value.split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else None
+    return directives
+
+
+def http_date(value: Optional[str]) -> Optional[float]:
+    """HTTP日期转时间戳，解析不了返回None"""
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except Exception:
+        return None
+
+
+class HttpCache(Logger):
+    """
+    存在硬盘上的HTTP缓存，只缓存GET请求的200响应
+    按Cache-Control、Expires、Age判断是否新鲜，新鲜的直接从硬盘返回，不新鲜的带上ETag和Last-Modified发起条件请求
+    响应体用zlib压缩后每个url存一个文件，读取时用mmap映射进来再解压
+    所有文件的总大小超过max_size时按最近最少使用的顺序删除
+    """
+
+    def __init__(self, path: str, max_size: int = 64 * 1024 * 1024, default_ttl: float = 0):
+        """
+        path是存放缓存的文件夹
+        max_size是缓存文件的总大小上限(字节，压缩后)
+        default_ttl是响应里没有Cache-Control和Expires时认为它新鲜多少秒，为0表示每次都要发请求验证
+        开发时反复重放同一轮可以设大一点，这样就完全不用请求上游了
+        """
+        super().__init__()
+        self.__path = path
+        self.__max_size = max_size
+        self.__default_ttl = default_ttl
+        os.makedirs(path, exist_ok=True)
+        self.__index = JSONFile(os.path.join(path, 'index.json'))  # url -> 缓存记录
+        self.hits = 0  # 直接从硬盘返回的次数
+        self.revalidated = 0  # 条件请求返回304的次数
+        self.misses = 0  # 完整下载的次数
+
+    def setTag(self, tag: str = None):
+        super().setTag(tag)
+        self.__index.setTag(tag)
+
+    def __body_path(self, url: str) -> str:
+        return os.path.join(self.__path, hashlib.sha1(url.encode('utf8')).hexdigest() + '.z')
+
+    @staticmethod
+    def __read_body(path: str) -> bytes:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size <= 0:
+                return b''
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return zlib.decompress(m)
+
+    @staticmethod
+    def __write_body(path: str, body: bytes) -> int:
+        data = zlib.compress(body)
+        replace_file(path, data)
+        return len(data)
+
+    def __expires(self, headers: httpx.Headers, now: float) -> Optional[float]:
+        """算出响应什么时候过期，返回None表示不能缓存"""
+        cc = parse_cache_control(headers.get('Cache-Control', ''))
+        if 'no-store' in cc:
+            return None
+        if 'no-cache' in cc:
+            return now
+        age = int(headers['Age']) if headers.get('Age', '').isdigit() else 0
+        if cc.get('max-age') is not None and cc['max-age'].isdigit():
+            return now + int(cc['max-age']) - age
+        if 'Expires' in headers:
+            expires = http_date(headers['Expires'])
+            if expires is None:  # 解析不了的Expires按已过期处理
+                return now
+            return now + max(0.0, expires - (http_date(headers.get('Date')) or now)) - age
+        return now + self.__default_ttl
+
+    async def lookup(self, request: httpx.Request) -> Tuple[Optional[Dict], bool]:
+        """查找缓存，返回 (缓存记录, 是否新鲜)"""
+        entry = (await self.__index.load()).get(str(request.url))
+        if entry is None:
+            return None, False
+        for name, value in entry.get('vary', {}).items():
+            if request.headers.get(name) != value:
+                return None, False
+        entry['last_used'] = time.time()
+        return entry, time.time() < entry['expires']
+
+    async def body(self, entry: Dict) -> Optional[bytes]:
+        """读取缓存的响应体，文件被删了或者坏了返回None"""
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self.__read_body, entry['file'])
+        except Exception:
+            self.getLogger().exception("cannot read cached body of %s" % entry['url'])
+            return None
+
+    async def store(self, request: httpx.Request, status_code: int, headers: List[Tuple[str, str]], body: bytes):
+        """记录一个200响应，不能缓存的什么都不做"""
+        now = time.time()
+        h = httpx.Headers(headers)
+        expires = self.__expires(h, now)
+        if expires is None or h.get('Vary', '').strip() == '*':
+            return
+        url = str(request.url)
+        vary = {}
+        for name in h.get('Vary', '').split(','):
+            if name.strip():
+                vary[name.strip().lower()] = request.headers.get(name.strip())
+        path = self.__body_path(url)
+        size = await asyncio.get_running_loop().run_in_executor(None, self.__write_body, path, body)
+        index = await self.__index.load()
+        index[url] = {'url': url, 'status_code': status_code, 'headers': headers, 'vary': vary,
+                      'file': path, 'size': size, 'expires': expires, 'last_used': now}
+        self.getLogger().debug("cached %s, %d bytes compressed to %d bytes" % (url, len(body), size))
+        await self.__evict()
+        await self.__index.save()
+
+    async def refresh(self, entry: Dict, headers: httpx.Headers):
+        """条件请求返回304后，用304里的header更新缓存记录"""
+        stored = httpx.Headers(entry['headers'])
+        for name in ['Cache-Control', 'Expires', 'Date', 'ETag', 'Last-Modified', 'Age']:
+            if name in headers:
+                stored[name] = headers[name]
+        expires = self.__expires(stored, time.time())
+        entry['headers'] = stored.multi_items()
+        entry['expires'] = expires if expires is not None else 0
+        await self.__index.save()
+
+    async def __evict(self):
+        index = await self.__index.load()
+        total = sum(entry['size'] for entry in index.values())
+        for entry in sorted(list(index.values()), key=lambda e: e['last_used']):
+            if total <= self.__max_size:
+                break
+            index.pop(entry['url'], None)
+            total -= entry['size']
+            try:
+                os.remove(entry['file'])
+            except OSError:
+                pass
+            self.getLogger().debug("evicted %s from cache" % entry['url'])
+
+
+class HttpCacheTransport(httpx.AsyncBaseTransport):
+    """套在httpx的transport外面，GET请求先查HttpCache"""
+
+    scheduled = True
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, cache: HttpCache):
+        self.__transport = scheduled_transport(transport)  # 在缓存里面排队，命中缓存的请求不用排队
+        self.__cache = cache
+
+    @staticmethod
+    def __response(entry: Dict, body: bytes, status_code: int = None) -> httpx.Response:
+        return httpx.Response(status_code or entry['status_code'], headers=entry['headers'],
+                              stream=httpx.ByteStream(body))
+
+    @staticmethod
+    def __matches(entry: Dict, request: httpx.Request) -> bool:
+        """请求自己带的条件是否和缓存的一致，一致就可以直接回304"""
+        headers = httpx.Headers(entry['headers'])
+        etag = request.headers.get('If-None-Match')
+        if etag is not None:
+            return etag == headers.get('ETag')
+        return request.headers.get('If-Modified-Since') is not None and \
+            request.headers.get('If-Modified-Since') == headers.get('Last-Modified')
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if request.method != 'GET' or 'no-store' in parse_cache_control(request.headers.get('Cache-Control', '')):
+            return await self.__transport.handle_async_request(request)
+        conditional = 'If-None-Match' in request.headers or 'If-Modified-Since' in request.headers
+        entry, fresh = await self.__cache.lookup(request)
+        body = await self.__cache.body(entry) if entry is not None else None
+        if body is not None and fresh:
+            self.__cache.hits += 1
+            self.__cache.getLogger().debug("cache hit: %s" % request.url)
+            if conditional and self.__matches(entry, request):
+                return self.__response(entry, b'', 304)
+            return self.__response(entry, body)
+        if body is not None and not conditional:  # 请求自己没带条件才由缓存来加
+            stored = httpx.Headers(entry['headers'])
+            if stored.get('ETag') is not None:
+                request.headers['If-None-Match'] = stored['ETag']
+            if stored.get('Last-Modified') is not None:
+                request.headers['If-Modified-Since'] = stored['Last-Modified']
+        response = await self.__transport.handle_async_request(request)
+        if response.status_code == 304 and body is not None and not conditional:
+            await response.aclose()
+            self.__cache.revalidated += 1
+            self.__cache.getLogger().debug("cache revalidated: %s" % request.url)
+            await self.__cache.refresh(entry, response.headers)
+            return self.__response(entry, body)
+        if response.status_code != 200:
+            return response
+        self.__cache.misses += 1
+        try:
+            raw = b''.join([chunk async for chunk in response.aiter_raw()])  # 原样记下，Content-Encoding交给client去解
+        finally:
+            await response.aclose()
+        headers = response.headers.multi_items()
+        await self.__cache.store(request, response.status_code, headers, raw)
+        return httpx.Response(response.status_code, headers=headers, stream=httpx.ByteStream(raw),
+                              extensions=response.extensions)
+
+    async def aclose(self):
+        await self.__transport.aclose()
+
+
+def cached_httpx_client_opt_generator(cache: HttpCache,
+                                      httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator
+                                      ) -> Callable[[], Dict]:
+    """
+    生成一个httpx_client_opt_generator，在httpx_client_opt_generator给出的transport外面套上HttpCache
+    把它传给各个Feeder和Filter就能让它们的请求都走缓存
+    """
+
+    def generator():
+        opt = httpx_client_opt_generator()
+        opt['transport'] = HttpCacheTransport(opt.get('transport'), cache)
+        return opt
+
+    return generator
@@ -1,11 +1,13 @@
+import asyncio
 import json
-from typing import Dict, Callable, List
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from typing import Dict, Callable, List, Optional
 from xml.etree import ElementTree
 
-import httpx
-
 from simplarchiver import Feeder
-from .common import default_httpx_client_opt_generator
+from .common import default_httpx_client_opt_generator, ConditionalGetCache, aiter_xml_elements
+from .common import JSONFile, HedgePolicy, stream_get, SeenSet
 
 
 class RSSHubFeeder(Feeder):
@@ -15,23 +17,74 @@ class RSSHubFeeder(Feeder):
     如果有enclosure还会返回enclosure值
     """
 
-    def __init__(self, url: str, httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator):
+    def __init__(self, url: str, httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator,
+                 conditional_get_cache: ConditionalGetCache = None, stream: bool = False,
+                 hedge: HedgePolicy = None, seen_set: SeenSet = None):
         """
         httpx_client_opt_generator是一个函数，返回发起请求所用的httpx.AsyncClient()设置
-        httpx.AsyncHTTPTransport不能重复使用，所以每次都得返回新的
+        同一个事件循环里同一个host的请求共享一个client，每个client调用一次此函数
+        conditional_get_cache用于发起条件请求，为None表示每次都完整下载
+        stream表示是否边下载边解析，每解析出一个item就yield一个，适合很大的RSS
+        边下载边解析时，在所有item被取走之前连接不会断开
+        hedge是对冲请求的设置，为None表示不对冲，多个Feeder可以共用一个HedgePolicy
+        seen_set用于跨轮次去重，以前的轮次里yield过的item不再yield，为None表示每次都yield所有item
+        这一轮见过的item在所有下载都结束后(cycle_end)才记下，不在Pair里用时要自己调用cycle_end
+        所以中途退出的那一轮不算数；但Feeder看不到下载结果，记下之后这一轮下载失败的item也不会再yield
+        只适合下载失败可以接受的场景，或者配合会重试的下载器使用
         """
         super().__init__()
         self.__url = url
         self.httpx_client_opt_generator = httpx_client_opt_generator
+        self.__cache = conditional_get_cache
+        self.__stream = stream
+        self.__hedge = hedge
+        self.__seen = seen_set
+        self.__digests = None  # 这一轮feed里所有item的摘要，等cycle_end时记到seen_set里
 
-    async def get_feeds(self):
-        async with httpx.AsyncClient(**self.httpx_client_opt_generator()) as client:
-            self.getLogger().debug("get rss xml from %s" % self.__url)
-            response = await client.get(self.__url)
+    def setTag(self, tag: str = None):
+        super().setTag(tag)
+        if self.__seen is not None:
+            self.__seen.setTag(tag)
+
+    async def cycle_start(self):
+        self.__digests = None
+
+    async def cycle_end(self):
+        """这一轮的下载都结束了，记下这一轮见过的item"""
+        digests, self.__digests = self.__digests, None
+        if self.__seen is not None and digests is not None:
+            await self.__seen.update(self.__url, digests)
+
+    async def __iter_items(self, response):
+        """从response中逐个取出item标签"""
+        if self.__stream:
+            async for item, _ in aiter_xml_elements(response.aiter_bytes(), {'item'}):
+                yield item
+        else:
+            await response.aread()
             self.getLogger().debug("got rss xml: %s" % response.text)
-            root = ElementTree.XML(response.text)
+            for item in ElementTree.XML(response.text).iter('item'):
+                yield item
+
+    async def get_feeds(self):
+        self.getLogger().debug("get rss xml from %s" % self.__url)
+        headers = await self.__cache.headers(self.__url) if self.__cache is not None else {}
+        seen = await self.__seen.seen(self.__url) if self.__seen is not None else set()
+        digests = []  # 这一轮feed里所有item的摘要，给seen_set用
+        async with stream_get(self.__url, headers, self.httpx_client_opt_generator, self.__hedge) as response:
+            if response.status_code == 304 and self.__cache is not None:
+                self.getLogger().debug("rss xml not modified, replay the last items: %s" % self.__url)
+                for i in await self.__cache.items(self.__url):
+                    if self.__seen is not None:
+                        digests.append(SeenSet.digest(i['link']))
+                        if digests[-1] in seen:
+                            continue
+                    yield i
+                self.__digests = digests
+                return
             fed = set()  # 用集合去除重复项
-            for item in root.iter('item'):
+            items = []  # 记下yield过的item，给条件请求重放用
+            async for item in self.__iter_items(response):
                 link = item.find('link').text
                 i = {}
                 for subitem in item.iter():
@@ -42,8 +95,17 @@ class RSSHubFeeder(Feeder):
                     if item.find('enclosure') is not None:
                         enclosure = item.find('enclosure').get("url")
                         i['enclosure'] = enclosure
+                    items.append(i)
+                    if self.__seen is not None:
+                        digests.append(SeenSet.digest(link))
+                        if digests[-1] in seen:
+                            self.getLogger().debug("item seen in the last cycles, skip it: %s" % link)
+                            continue
                     self.getLogger().debug("yield item: %s" % json.dumps(i))
                     yield i
+        if self.__cache is not None and response.status_code == 200:
+            await self.__cache.update(self.__url, response.headers, items)
+        self.__digests = digests
 
 
 class RSSHubMultiPageFeeder(Feeder):
@@ -54,36 +116,203 @@ class RSSHubMultiPageFeeder(Feeder):
     """
 
     def __init__(self, url_gen: Callable[[int, List[Dict]], str], max_pages: int = 999,
-                 httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator):
+                 httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator,
+                 conditional_get_cache: ConditionalGetCache = None, stream: bool = False,
+                 concurrency: int = 1, ordered: bool = True,
+                 incremental_path: str = None, incremental_key: str = None,
+                 hedge: HedgePolicy = None):
         """
         url_gen是输入数字生成url的函数
         max_pages是最多获取多少页
         httpx_client_opt_generator是一个函数，返回发起请求所用的httpx.AsyncClient()设置
-        httpx.AsyncHTTPTransport不能重复使用，所以每次都得返回新的
+        同一个事件循环里同一个host的请求共享一个client，每个client调用一次此函数
+        conditional_get_cache用于对每一页发起条件请求，为None表示每次都完整下载
+        stream表示是否对每一页边下载边解析
+        concurrency表示最多同时获取多少页，为1时一页一页地获取
+        concurrency大于1时url_gen的第二个参数(上一页的item)永远是空列表，所以只适用于不依赖上一页内容的url_gen
+        并且在遇到空页面时就不再继续获取后面的页面
+        ordered表示concurrency大于1时是否按页码顺序输出item，为False时哪一页先获取到就先输出哪一页
+        incremental_path是记录上次见过的最新item的文件，为None表示每次都获取所有页面
+        记录了最新item之后，只要某一页里出现了不比它新的item，就不再获取后面的页面
+        最新item在这一轮所有下载都结束后(cycle_end)才记录，不在Pair里用时要自己调用cycle_end
+        Feeder看不到下载结果，所以记录之后，这一轮下载失败的item只要所在的页面在停下的那一页后面，以后就再也不会获取到了
+        只适合下载失败可以接受的场景，或者配合会重试的下载器使用
+        incremental_key是这个url_gen在记录文件里的名字，为None时用第0页的url
+        hedge是获取每一页时的对冲请求设置，为None表示不对冲
         """
         super().__init__()
         self.__url_gen = url_gen
         self.__max_pages = max_pages
         self.httpx_client_opt_generator = httpx_client_opt_generator
+        self.__cache = conditional_get_cache
+        self.__stream = stream
+        self.__concurrency = concurrency
+        self.__ordered = ordered
+        self.__incremental = JSONFile(incremental_path) if incremental_path is not None else None
+        self.__incremental_key = incremental_key
+        self.__hedge = hedge
         self.__tag_for_feeder = "Temp Feeder"
+        self.__newest = None  # 这一轮见过的最新item，等cycle_end时记录
 
     def setTag(self, tag):
         super().setTag(tag)
         self.__tag_for_feeder = tag
+        if self.__incremental is not None:
+            self.__incremental.setTag(tag)
+
+    @staticmethod
+    def __pubdate(item) -> Optional[datetime]:
+        try:
+            return parsedate_to_datetime(item['pubDate'])
+        except Exception:
+            return None
+
+    async def __load_newest(self) -> Dict:
+        """读取上次记录的最新item，没有记录时返回空dict"""
+        if self.__incremental is None:
+            return {}
+        key = self.__incremental_key or self.__url_gen(0, [])
+        newest = (await self.__incremental.load()).get(key, {})
+        self.getLogger().debug("newest item of last time: %s" % newest)
+        return newest
+
+    async def cycle_start(self):
+        self.__newest = None
+
+    async def cycle_end(self):
+        """这一轮的下载都结束了，记录这一轮见过的最新item"""
+        newest, self.__newest = self.__newest, None
+        if newest is not None:
+            await self.__save_newest(newest)
+
+    async def __save_newest(self, newest: Dict):
+        if self.__incremental is None or newest.get('link') is None:
+            return
+        key = self.__incremental_key or self.__url_gen(0, [])
+        (await self.__incremental.load())[key] = {'link': newest['link'], 'pubDate': newest.get('pubDate')}
+        await self.__incremental.save()
+        self.getLogger().debug("newest item recorded: %s" % newest)
+
+    def __update_newest(self, newest: Dict, page: int, item):
+        """记下这一轮见过的最新item: pubDate最大的那个，都没有pubDate时就是第0页的第一个"""
+        date = self.__pubdate(item)
+        if date is not None and (newest.get('date') is None or date > newest['date']):
+            newest.update({'link': item.get('link'), 'pubDate': item.get('pubDate'), 'date': date})
+        elif newest.get('link') is None and page == 0:
+            newest['link'] = item.get('link')
+
+    def __is_known(self, known: Dict, item) -> bool:
+        """item是否不比上次记录的最新item新"""
+        if len(known) <= 0:
+            return False
+        if known.get('link') is not None and item.get('link') == known['link']:
+            return True
+        date, known_date = self.__pubdate(item), self.__pubdate(known)
+        return date is not None and known_date is not None and date <= known_date
 
     async def get_feeds(self):
+        if self.__concurrency > 1:
+            async for item in self.__get_feeds_concurrent():
+                yield item
+            return
+        known, newest, failed = await self.__load_newest(), {}, False
         last_page = []
         for page in range(0, self.__max_pages):
             url = self.__url_gen(page, last_page)
             if not url:
-                return
+                break
             last_page = []
-            rf = RSSHubFeeder(url, self.httpx_client_opt_generator)
+            rf = RSSHubFeeder(url, self.httpx_client_opt_generator, self.__cache, self.__stream, self.__hedge)
             rf.setTag(self.__tag_for_feeder)
             self.getLogger().debug("got page %d: %s" % (page, url))
+            page_known = False
             try:
                 async for item in rf.get_feeds():
                     last_page.append(item)
+                    self.__update_newest(newest, page, item)
+                    page_known = page_known or self.__is_known(known, item)
                     yield item
             except Exception:
+                failed = True
                 self.getLogger().exception("Catch an Exception from page %d: %s" % (page, url))
+            if page_known:
+                self.getLogger().debug("page %d contains known item, stop getting pages after it" % page)
+                break
+        if not failed:  # 所有页面都成功获取之后才记录最新item，否则下次可能会漏掉出错的那几页
+            self.__newest = newest
+
+    async def __get_page(self, page: int, url: str):
+        """获取一整页的item，出错返回None"""
+        rf = RSSHubFeeder(url, self.httpx_client_opt_generator, self.__cache, self.__stream, self.__hedge)
+        rf.setTag(self.__tag_for_feeder)
+        self.getLogger().debug("got page %d: %s" % (page, url))
+        try:
+            return [item async for item in rf.get_feeds()]
+        except Exception:
+            self.getLogger().exception("Catch an Exception from page %d: %s" % (page, url))
+            return None
+
+    async def __get_feeds_concurrent(self):
+        """同时获取多个页面，遇到空页面或是包含已知item的页面就不再获取后面的页面"""
+        known, newest, failed = await self.__load_newest(), {}, False
+        tasks: Dict[int, asyncio.Task] = {}  # 页码 -> 获取该页的任务
+        next_page = 0
+        stop_page = self.__max_pages  # 页码不小于stop_page的页面都不要了
+
+        def launch():
+            nonlocal next_page, stop_page
+            while len(tasks) < self.__concurrency and next_page < stop_page:
+                url = self.__url_gen(next_page, [])
+                if not url:
+                    stop_page = next_page
+                    return
+                tasks[next_page] = asyncio.create_task(self.__get_page(next_page, url))
+                next_page += 1
+
+        def stop_at(page: int):
+            nonlocal stop_page
+            self.getLogger().debug("stop getting pages from page %d" % page)
+            stop_page = min(stop_page, page)
+            for p in [p for p in tasks if p >= stop_page]:
+                tasks.pop(p).cancel()
+
+        def handle(page: int, items):
+            """处理获取到的一页，返回要输出的item"""
+            nonlocal failed
+            if items is None:
+                failed = True
+                return []
+            if len(items) <= 0:
+                stop_at(page)
+                return []
+            page_known = False
+            for item in items:
+                self.__update_newest(newest, page, item)
+                page_known = page_known or self.__is_known(known, item)
+            if page_known:
+                stop_at(page + 1)
+            return items
+
+        try:
+            launch()
+            if self.__ordered:
+                page = 0
+                while page in tasks:
+                    for item in handle(page, await tasks.pop(page)):
+                        yield item
+                    page += 1
+                    launch()
+            else:
+                while len(tasks) > 0:
+                    done, _ = await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_COMPLETED)
+                    for page in sorted(p for p, t in tasks.items() if t in done):
+                        if page not in tasks:  # 已经被stop_at取消了
+                            continue
+                        for item in handle(page, tasks.pop(page).result()):
+                            yield item
+                    launch()
+        finally:
+            for task in tasks.values():  # 提前退出时不要留下还在运行的任务
+                task.cancel()
+        if not failed:  # 所有页面都成功获取之后才记录最新item，否则下次可能会漏掉出错的那几页
+            self.__newest = newest
@@ -1,13 +1,39 @@
 import asyncio
+import copy
 import json
 import logging
+import re
+import weakref
 from datetime import datetime
-from typing import Dict, Callable
+from functools import lru_cache
+from typing import Dict, Callable, Tuple
 
 import httpx
 
 from simplarchiver import Feeder
-from .common import default_httpx_client_opt_generator
+from .common import default_httpx_client_opt_generator, httpx_client_pool, ConditionalGetCache, JSONFile
+from .common import aiter_json_array, HedgePolicy, stream_get
+
+
+RFC3339 = re.compile(r'(\d{4}-\d{2}-\d{2})T(([01]\d|2[0-3]):[0-5]\d:[0-5]\d)(Z|[+-]\d{2}:?\d{2})')
+
+
+@lru_cache(maxsize=4096)
+def rfc822_date(date: str) -> str:
+    """YYYY-MM-DD -> 'Sat, 01 May 2021'，同一天的文章很多，记下来不用每次都算"""
+    return datetime.strftime(datetime.strptime(date, "%Y-%m-%d"), "%a, %d %b %Y")
+
+
+def rfc3339_to_rfc822(updated: str) -> str:
+    """
+    把TTRSS返回的updated时间转成RSS的pubDate格式
+    和strptime+strftime的结果一样，只是日期部分查表、时间部分直接复制，常见格式以外的还是交给strptime
+    """
+    match = RFC3339.fullmatch(updated)
+    if match is None:
+        pubDate = datetime.strptime(updated, "%Y-%m-%dT%H:%M:%S%z")
+        return datetime.strftime(pubDate, "%a, %d %b %Y %H:%M:%S GMT")
+    return "%s %s GMT" % (rfc822_date(match.group(1)), match.group(2))
 
 
 class TTRSSGenFeeder(Feeder):
@@ -17,87 +43,153 @@ class TTRSSGenFeeder(Feeder):
     如果有enclosure还会返回enclosure值
     """
 
-    def __init__(self, url: str, httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator):
+    def __init__(self, url: str, httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator,
+                 conditional_get_cache: ConditionalGetCache = None, stream: bool = False,
+                 hedge: HedgePolicy = None):
         """
         httpx_client_opt_generator是一个函数，返回发起请求所用的httpx.AsyncClient()设置
-        httpx.AsyncHTTPTransport不能重复使用，所以每次都得返回新的
+        同一个事件循环里同一个host的请求共享一个client，每个client调用一次此函数
+        conditional_get_cache用于发起条件请求，为None表示每次都完整下载
+        stream表示是否边下载边解析，每解析出一个article就yield一个，适合很大的GeneratedFeeds
+        边下载边解析时，在所有article被取走之前连接不会断开
+        hedge是对冲请求的设置，为None表示不对冲，多个Feeder可以共用一个HedgePolicy
         """
         super().__init__()
         self.__url = url
         self.httpx_client_opt_generator = httpx_client_opt_generator
+        self.__cache = conditional_get_cache
+        self.__stream = stream
+        self.__hedge = hedge
 
-    async def get_feeds(self):
-        async with httpx.AsyncClient(**self.httpx_client_opt_generator()) as client:
-            self.getLogger().debug("get GeneratedFeeds json from %s" % self.__url)
-            response = await client.get(self.__url)
+    async def __iter_articles(self, response):
+        """从response中逐个取出article"""
+        if self.__stream:
+            async for article in aiter_json_array(response.aiter_bytes(), 'articles'):
+                yield article
+        else:
+            await response.aread()
             data = json.loads(response.text)
-            self.getLogger().debug("got GeneratedFeeds json: %s" % data)
+            self.getLogger().debug("got GeneratedFeeds json with %d articles" % len(data['articles']))
             for article in data['articles']:
+                yield article
+
+    async def get_feeds(self):
+        self.getLogger().debug("get GeneratedFeeds json from %s" % self.__url)
+        headers = await self.__cache.headers(self.__url) if self.__cache is not None else {}
+        async with stream_get(self.__url, headers, self.httpx_client_opt_generator, self.__hedge) as response:
+            if response.status_code == 304 and self.__cache is not None:
+                self.getLogger().debug("GeneratedFeeds json not modified, replay the last articles: %s" % self.__url)
+                for article in await self.__cache.items(self.__url):
+                    yield article
+                return
+            articles = []  # 记下yield过的article，给条件请求重放用
+            async for article in self.__iter_articles(response):
                 article['pubDate'] = 'Invalid'
                 if 'updated' in article:
-                    pubDate = datetime.strptime(article['updated'], "%Y-%m-%dT%H:%M:%S%z")
-                    article['pubDate'] = datetime.strftime(pubDate, "%a, %d %b %Y %H:%M:%S GMT")
+                    article['pubDate'] = rfc3339_to_rfc822(article['updated'])
+                if self.__cache is not None:
+                    articles.append(article)
                 yield article
+        if self.__cache is not None and response.status_code == 200:
+            await self.__cache.update(self.__url, response.headers, articles)
 
 
-class TTRSSClient(httpx.AsyncClient):
-    """一个简单的异步TTRSS客户端"""
-    sem_list: Dict[str, asyncio.Semaphore] = {}  # 同一时刻一个链接只能有一个客户端登录，这里用一个信号量列表控制
+class TTRSSClient:
+    """
+    一个简单的异步TTRSS客户端
+    登录得到的sid按(url, username)记在类里，所有轮次、所有Feeder共用，不再每次都登录登出
+    sid失效(服务器返回NOT_LOGGED_IN)时会自动重新登录再重试一次
+    同一个sid上可以同时发起多个API请求
+    """
+    sessions: Dict[Tuple[str, str], str] = {}  # (url, username) -> sid
+    login_locks = weakref.WeakKeyDictionary()  # 事件循环 -> {(url, username): asyncio.Lock}，同一时刻只让一个协程去登录
 
-    def __init__(self, url: str, username: str, password: str, **kwargs):
-        super().__init__(**kwargs)
+    def __init__(self, url: str, username: str, password: str,
+                 httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator):
         self.__url = url
         self.__username = username
         self.__password = password
+        self.__httpx_client_opt_generator = httpx_client_opt_generator
+        self.__key = (url, username)
         self.__logger = logging.getLogger("TTRSSClient")
-        self.__sid = None
-        if self.__url not in TTRSSClient.sem_list:  # 给每个链接一个信号量
-            TTRSSClient.sem_list[self.__url] = None  # 信号量必须在事件循环开始后生成，此处先给个标记
+
+    def __get_login_lock(self) -> asyncio.Lock:
+        """asyncio.Lock必须在事件循环里生成，每个事件循环各有一套"""
+        loop = asyncio.get_running_loop()
+        if loop not in TTRSSClient.login_locks:
+            TTRSSClient.login_locks[loop] = {}
+        locks = TTRSSClient.login_locks[loop]
+        if self.__key not in locks:
+            locks[self.__key] = asyncio.Lock()
+        return locks[self.__key]
+
+    def __client(self) -> httpx.AsyncClient:
+        return httpx_client_pool.client(self.__url, self.__httpx_client_opt_generator)  # 共享连接池里的client
+
+    async def __login(self, stale_sid: str = None):
+        """登录并记下sid，stale_sid是已经失效的sid，如果别的协程已经换了新的sid就不用再登录了"""
+        async with self.__get_login_lock():
+            if TTRSSClient.sessions.get(self.__key) != stale_sid:
+                return
+            try:
+                data = (await self.__client().post(self.__url, content=json.dumps({
+                    'op': 'login',
+                    'user': self.__username,
+                    'password': self.__password
+                }))).json()
+                self.__logger.debug('TTRSS API login response: %s' % data)
+                TTRSSClient.sessions[self.__key] = data['content']['session_id']
+                self.__logger.debug('TTRSS API login successful, sid: %s' % TTRSSClient.sessions[self.__key])
+            except Exception:
+                self.__logger.exception('TTRSS API login failed, error: ')
 
     async def __aenter__(self):
-        for url in TTRSSClient.sem_list:  # 信号量必须在事件循环开始后生成
-            if TTRSSClient.sem_list[url] is None:  # 已经生成的信号量不要变
-                self.__logger.debug('semaphore for TTRSS API %s initialized' % url)
-                TTRSSClient.sem_list[url] = asyncio.Semaphore(1)  # 生成信号量
-        await TTRSSClient.sem_list[self.__url].__aenter__()  # 同一时刻一个链接只能有一个客户端登录
-        self.__logger.debug('semaphore for TTRSS API %s got' % self.__url)
-        await super().__aenter__()
-        self.__logger.debug('httpx cli for TTRSS API %s initialized' % self.__url)
-        try:
-            data = (await super().post(self.__url, content=json.dumps({
-                'op': 'login',
-                'user': self.__username,
-                'password': self.__password
-            }))).json()
-            self.__logger.debug('TTRSS API login response: %s' % data)
-            self.__sid = data['content']['session_id']
-            self.__logger.debug('TTRSS API login successful, sid: %s' % self.__sid)
-        except Exception:
-            self.__logger.exception('TTRSS API login failed, error: ')
+        if self.__key not in TTRSSClient.sessions:
+            await self.__login()
+        else:
+            self.__logger.debug('reuse TTRSS API session, sid: %s' % TTRSSClient.sessions[self.__key])
         return self
 
     async def __aexit__(self, *args, **kwargs):
+        pass  # sid留给下一轮和别的Feeder用，要退出登录请调用logout
+
+    async def logout(self):
+        """退出登录并丢掉记下的sid"""
+        sid = TTRSSClient.sessions.pop(self.__key, None)
+        if sid is None:
+            return
         try:
-            data = (await super().post(self.__url, content=json.dumps({
-                "sid": self.__sid,
+            data = (await self.__client().post(self.__url, content=json.dumps({
+                "sid": sid,
                 "op": "logout"
             }))).json()
             self.__logger.debug('TTRSS API logout response: %s' % data)
-            self.__logger.debug('TTRSS API logout successful, sid: %s' % self.__sid)
+            self.__logger.debug('TTRSS API logout successful, sid: %s' % sid)
         except Exception:
             self.__logger.exception('TTRSS API logout failed, error: ')
-        await super().__aexit__(*args, **kwargs)
-        await TTRSSClient.sem_list[self.__url].__aexit__(*args, **kwargs)
-        self.__logger.debug('semaphore for TTRSS API %s released' % self.__url)
 
     async def api(self, data: dict):
-        data['sid'] = self.__sid
-        self.__logger.debug("post data to  TTRSS API %s: %s" % (self.__url, data))
-        try:
-            return (await super().post(self.__url, content=json.dumps(data))).json()['content']
-        except Exception:
-            self.__logger.exception('TTRSS API post failed, error: ')
-            return None
+        for retry in range(2):
+            sid = TTRSSClient.sessions.get(self.__key)
+            if sid is None:
+                await self.__login()
+                sid = TTRSSClient.sessions.get(self.__key)
+            data = {**data, 'sid': sid}
+            self.__logger.debug("post data to  TTRSS API %s: %s" % (self.__url, data))
+            try:
+                response = (await self.__client().post(self.__url, content=json.dumps(data))).json()
+            except Exception:
+                self.__logger.exception('TTRSS API post failed, error: ')
+                return None
+            content = response.get('content')
+            if response.get('status') != 0 and isinstance(content, dict) and content.get('error') == 'NOT_LOGGED_IN':
+                if retry <= 0:
+                    self.__logger.debug('TTRSS API session expired, login again, sid: %s' % sid)
+                    await self.__login(sid)
+                    continue
+                self.__logger.error('TTRSS API still not logged in after login again')
+                return None
+            return content
 
 
 class TTRSSCatFeeder(Feeder):
@@ -107,10 +199,19 @@ class TTRSSCatFeeder(Feeder):
     """
 
     def __init__(self, url: str, username: str, password: str, cat_id: int,
-                 httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator):
+                 httpx_client_opt_generator: Callable[[], Dict] = default_httpx_client_opt_generator,
+                 concurrency: int = 8, cat_headlines_limit: int = 200, cat_headlines_pages: int = 5,
+                 since_id_path: str = None):
         """
         httpx_client_opt_generator是一个函数，返回发起请求所用的httpx.AsyncClient()设置
-        httpx.AsyncHTTPTransport不能重复使用，所以每次都得返回新的
+        同一个事件循环里同一个host的请求共享一个client，每个client调用一次此函数
+        先按Category一次获取一批最新内容，从中找出每个订阅的最新内容链接
+        cat_headlines_limit是按Category获取时每次获取多少条，cat_headlines_pages是最多获取多少次，为0表示不按Category获取
+        按Category没找到的订阅再一个一个地获取，concurrency是一个一个获取时最多同时发起多少个请求
+        since_id_path是记录每个订阅上次见过的最新内容id的文件，为None表示每次都返回所有订阅
+        记录了id之后每次只获取比它新的内容，没有新内容的订阅就不返回了
+        id在这一轮所有下载都结束后(cycle_end)才记录，不在Pair里用时要自己调用cycle_end
+        有请求失败的那一轮不更新Category的id，不然失败的订阅的新内容会落到Category的id下面，以后就再也获取不到了
         """
         super().__init__()
         self.ttrss_client_opt = {
@@ -118,9 +219,100 @@ class TTRSSCatFeeder(Feeder):
         }  # 发起请求所用的ttrss客户端设置
         self.__cat_id = cat_id
         self.httpx_client_opt_generator = httpx_client_opt_generator
+        self.__concurrency = concurrency
+        self.__cat_headlines_limit = cat_headlines_limit
+        self.__cat_headlines_pages = cat_headlines_pages
+        self.__since_id = JSONFile(since_id_path) if since_id_path is not None else None
+        self.__staged = None  # 这一轮要记录的id，等cycle_end时记录
+
+    def setTag(self, tag):
+        super().setTag(tag)
+        if self.__since_id is not None:
+            self.__since_id.setTag(tag)
+
+    def __since_key(self) -> str:
+        return "%s#%s" % (self.ttrss_client_opt['url'], self.__cat_id)
+
+    async def __load_since_id(self) -> Dict:
+        """读取这个Category上次记录的id: {'cat': Category里最新的内容id, 'feeds': {订阅id: 最新的内容id}}"""
+        if self.__since_id is None:
+            return {'cat': None, 'feeds': {}}
+        data = await self.__since_id.load()
+        return copy.deepcopy(data.get(self.__since_key(), {'cat': None, 'feeds': {}}))  # 改的是副本，cycle_end时才写回去
+
+    async def cycle_start(self):
+        self.__staged = None
+
+    async def cycle_end(self):
+        """这一轮的下载都结束了，记录这一轮见过的最新内容id"""
+        staged, self.__staged = self.__staged, None
+        if self.__since_id is None or staged is None:
+            return
+        (await self.__since_id.load())[self.__since_key()] = staged
+        await self.__since_id.save()
+
+    async def __get_cat_headlines(self, client: TTRSSClient, feeds, since: Dict
+                                  ) -> Tuple[Dict[str, Dict], Dict[str, int], bool, bool]:
+        """
+        按Category获取最新内容
+        返回 (订阅id -> 最新内容, 订阅id -> 见过的最大内容id, 是否已经取完了所有新内容, 请求是否都成功了)
+        有since_id时只获取比它新的内容
+        """
+        wanted = set(str(feed['id']) for feed in feeds)
+        recent, max_ids = {}, {}
+        complete = False
+        for page in range(0, self.__cat_headlines_pages):
+            data = {
+                "op": "getHeadlines",
+                "feed_id": self.__cat_id,
+                "is_cat": True,
+                "limit": self.__cat_headlines_limit,
+                "skip": page * self.__cat_headlines_limit,
+                "view_mode": "all_articles",
+                "order_by": "feed_dates"
+            }
+            if since.get('cat') is not None:
+                data['since_id'] = since['cat']
+            content = await client.api(data)
+            if not isinstance(content, list):  # 请求失败或者API返回了错误
+                return recent, max_ids, False, False
+            for headline in content:  # 按时间排好序的，每个订阅第一次出现的就是最新的
+                feed_id = str(headline.get('feed_id'))
+                if feed_id in wanted and feed_id not in recent:
+                    recent[feed_id] = headline
+                if feed_id in wanted and headline.get('id') is not None:
+                    max_ids[feed_id] = max(headline['id'], max_ids.get(feed_id, headline['id']))
+            self.getLogger().debug("got %d headlines of cat %d, found recent link of %d/%d feeds" % (
+                len(content), self.__cat_id, len(recent), len(wanted)))
+            if len(content) < self.__cat_headlines_limit:
+                complete = True
+                break
+            if len(recent) >= len(wanted):
+                break
+        return recent, max_ids, complete, True
+
+    async def __get_feed_headline(self, client: TTRSSClient, feed, since: Dict, sem: asyncio.Semaphore):
+        async with sem:
+            data = {
+                "op": "getHeadlines",
+                "feed_id": feed['id'],
+                "limit": 1,
+                "view_mode": "all_articles",
+                "order_by": "feed_dates"
+            }
+            if str(feed['id']) in since.get('feeds', {}):
+                data['since_id'] = since['feeds'][str(feed['id'])]
+            return feed, await client.api(data)
+
+    @staticmethod
+    def __record(since: Dict, feed_id: str, article_id: int):
+        """记下订阅见过的最新内容id，Category的id等所有请求都成功了再记"""
+        if article_id is None:
+            return
+        since['feeds'][feed_id] = max(article_id, since['feeds'].get(feed_id, article_id))
 
     async def get_feeds(self):
-        async with TTRSSClient(**self.httpx_client_opt_generator(), **self.ttrss_client_opt) as client:
+        async with TTRSSClient(**self.ttrss_client_opt, httpx_client_opt_generator=self.httpx_client_opt_generator) as client:
             self.getLogger().debug("succeeded login to TTRSS")
             feeds = await client.api({
                 "op": "getFeeds",
@@ -128,17 +320,42 @@ class TTRSSCatFeeder(Feeder):
                 "limit": None
             })
             self.getLogger().debug("got cat data of cat %d: %s" % (self.__cat_id, json.dumps(feeds)))
+            since = await self.__load_since_id()
+            recent, max_ids, complete, ok = await self.__get_cat_headlines(client, feeds, since)
+            rest = []
             for feed in feeds:
+                feed_id = str(feed['id'])
+                if feed_id not in recent:
+                    if complete and feed_id in since.get('feeds', {}):  # 所有新内容都取完了还没有，说明没有新内容
+                        continue
+                    rest.append(feed)
+                    continue
+                self.__record(since, feed_id, max_ids.get(feed_id))
+                i = {'recent_link': recent[feed_id]['link'], 'feed_url': feed['feed_url']}
+                self.getLogger().debug("yield an item: %s" % json.dumps(i))
+                yield i
+            self.getLogger().debug("%d feeds not found in cat headlines, get them one by one" % len(rest))
+            sem = asyncio.Semaphore(self.__concurrency)
+            for task in asyncio.as_completed([self.__get_feed_headline(client, feed, since, sem) for feed in rest]):
+                feed, content = await task
+                if not isinstance(content, list):  # 请求失败或者API返回了错误
+                    ok = False
+                    self.getLogger().error("cannot get headlines of %s" % feed['feed_url'])
+                    continue
+                if len(content) <= 0:
+                    self.getLogger().debug("no new headline since last time: %s" % feed['feed_url'])
+                    continue
                 try:
-                    content = await client.api({
-                        "op": "getHeadlines",
-                        "feed_id": feed['id'],
-                        "limit": 1,
-                        "view_mode": "all_articles",
-                        "order_by": "feed_dates"
-                    })
+                    self.__record(since, str(feed['id']), content[0].get('id'))
                     i = {'recent_link': content[0]['link'], 'feed_url': feed['feed_url']}
                     self.getLogger().debug("yield an item: %s" % json.dumps(i))
                     yield i
                 except Exception:
+                    ok = False
                     self.getLogger().exception("cannot feed: %s" % feed)
+            newest = max(since['feeds'].values(), default=None)
+            if not ok:  # 有请求失败时Category的id不动，下一轮还从原来的位置获取
+                self.getLogger().warning("some requests of cat %d failed, keep its since_id" % self.__cat_id)
+            elif newest is not None:
+                since['cat'] = newest if since['cat'] is None else max(newest, since['cat'])
+            self.__staged = since
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import os
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import aiofiles
+
+from simplarchiver import Logger
+
+
+def replace_file(path: str, data: bytes):
+    """先写临时文件再替换，写到一半出错也不会损坏原文件，会卡住事件循环，要在线程池里调用"""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+async def write_file(path: str, data: bytes):
+    """replace_file的异步版本"""
+    tmp = path + '.tmp'
+    async with aiofiles.open(tmp, 'wb') as f:
+        await f.write(data)
+    os.replace(tmp, path)
+
+
+class LoopLocal:
+    """
+    每个事件循环各有一个的对象，比如asyncio.Lock
+    asyncio的对象必须在事件循环里生成，换了事件循环就要重新生成
+    """
+
+    def __init__(self, factory: Callable[[], Any] = asyncio.Lock):
+        self.__factory = factory
+        self.__value = None
+        self.__loop = None
+
+    def get(self) -> Any:
+        loop = asyncio.get_running_loop()
+        if self.__loop is not loop:
+            self.__value, self.__loop = self.__factory(), loop
+        return self.__value
+
+
+class DelayedSave(Logger):
+    """
+    有修改之后过delay秒才调用save写文件，这期间的修改攒在一起只写一次
+    等着写的task被取消(比如asyncio.run结束)时也会写，flush可以让它立即写
+    """
+
+    def __init__(self, save: Callable[[], Awaitable[None]], delay: float):
+        super().__init__()
+        self.__save = save
+        self.__delay = delay
+        self.__task: Optional[asyncio.Task] = None
+        self.__dirty = False
+
+    def schedule(self):
+        """有修改了，过一会儿再写"""
+        self.__dirty = True
+        task = self.__task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self.__task = asyncio.create_task(self.__run())
+
+    async def __run(self):
+        try:
+            await asyncio.sleep(self.__delay)
+        finally:
+            self.__task = None
+            try:
+                await self.__write()
+            except Exception:
+                self.getLogger().exception("Catch an Exception when saving:")
+
+    async def __write(self):
+        if not self.__dirty:
+            return
+        self.__dirty = False
+        try:
+            await self.__save()
+        except BaseException:
+            self.__dirty = True  # 没写成，下次再写
+            raise
+
+    async def flush(self):
+        """立即把还没写的修改写掉"""
+        task = self.__task
+        if task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop():
+            task.cancel()  # 取消时会写文件
+            await asyncio.gather(task, return_exceptions=True)
+        else:
+            await self.__write()
+
+
+class JSONFile(Logger):
+    """
+    整体读写的JSON记录文件，path为None表示只记在内存里
+    第一次load时从文件读取，之后都在内存里修改，save时整体写回文件
+    """
+
+    def __init__(self, path: str = None):
+        super().__init__()
+        self.__path = path
+        self.__data: Dict = None
+        self.__lock = LoopLocal(asyncio.Lock)
+
+    async def load(self) -> Dict:
+        if self.__data is not None:
+            return self.__data
+        self.__data = {}
+        if self.__path is None or not os.path.isfile(self.__path):
+            return self.__data
+        try:
+            async with aiofiles.open(self.__path, 'r', encoding='utf8') as f:
+                self.__data.update(json.loads(await f.read()))  # 原地修改，同时在load的其他协程拿到的也是同一个dict
+            self.getLogger().debug("Loaded %d records from %s" % (len(self.__data), self.__path))
+        except Exception as e:
+            self.getLogger().exception("Record file has error %s" % e)
+        return self.__data
+
+    async def save(self):
+        if self.__path is None or self.__data is None:
+            return
+        async with self.__lock.get():
+            await write_file(self.__path, json.dumps(self.__data, ensure_ascii=False).encode('utf8'))
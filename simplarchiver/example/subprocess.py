@@ -1,16 +1,67 @@
 import asyncio
-from typing import Callable
+import json
+import os
+import re
+import signal
+import weakref
+from collections import deque
+from datetime import timedelta
+from typing import Callable, Optional, List
 
-from simplarchiver import Downloader
+from simplarchiver import Downloader, Logger
+
+
+class OutputTail:
+    """
+    子进程输出的最后max_lines行，按\r和\n分行，这样进度条的每次刷新都算一行
+    存的是没解码的bytes，要看的时候才解码
+    """
+    NEWLINE = re.compile(rb'[\r\n]')
+
+    def __init__(self, max_lines: int, encoding: str = 'utf-8', max_line_length: int = 64 * 1024):
+        self.__lines = deque(maxlen=max_lines)
+        self.__encoding = encoding
+        self.__max_line_length = max_line_length
+        self.__partial = b''  # 最后一行还没读完的部分
+        self.count = 0  # 一共读到了多少行
+
+    def feed(self, data: bytes):
+        parts = self.NEWLINE.split(self.__partial + data)
+        self.__partial = parts.pop()[-self.__max_line_length:]
+        parts = [p for p in parts if p]
+        self.count += len(parts)
+        self.__lines.extend(parts[-self.__lines.maxlen:])
+
+    def close(self):
+        if self.__partial:
+            self.__lines.append(self.__partial)
+            self.count += 1
+            self.__partial = b''
+
+    def __decode(self, line: bytes) -> str:
+        return line.decode(self.__encoding, errors='replace').strip()
+
+    def last(self) -> Optional[str]:
+        return self.__decode(self.__lines[-1]) if len(self.__lines) > 0 else None
+
+    def lines(self) -> List[str]:
+        return [self.__decode(line) for line in self.__lines]
 
 
 class SubprocessDownloader(Downloader):
-    """运行指令开子进程下载"""
+    """
+    运行指令开子进程下载
+    给了tail_lines就不再把每一行输出都打到日志里，而是只留最后tail_lines行，每隔log_interval打一次最新的一行
+    子进程返回值不为0时再把留下的最后几行都打出来，适合输出很多进度条的下载器
+    """
 
-    def __init__(self, cmd_gen: Callable[[dict], str], stdout_encoding='utf-8'):
+    def __init__(self, cmd_gen: Callable[[dict], str], stdout_encoding='utf-8',
+                 tail_lines: int = None, log_interval: timedelta = timedelta(seconds=5)):
         """
         url_gen是输入item生成指令的函数
         stdout_encoding是标准输出的解码方式
+        tail_lines是stdout和stderr各留最后多少行，为None表示每一行都打到日志里
+        log_interval是留最后几行时每隔多久打一次最新的一行
         callback是指令运行完成后的回调函数，其输入分别是：
             1) 收到的item
             2) 生成的指令
@@ -19,6 +70,22 @@ class SubprocessDownloader(Downloader):
         super().__init__()
         self.__cmd_gen = cmd_gen
         self.__stdout_encoding = stdout_encoding
+        self.__tail_lines = tail_lines
+        self.__log_interval = log_interval.total_seconds()
+
+    async def __capture(self, f: asyncio.StreamReader, name: str, tail: OutputTail):
+        """整块整块地读，放进tail里，每隔log_interval打一次最新的一行"""
+        loop = asyncio.get_running_loop()
+        next_log = loop.time()
+        while True:
+            data = await f.read(64 * 1024)
+            if not data:
+                break
+            tail.feed(data)
+            if loop.time() >= next_log and tail.last() is not None:
+                self.getLogger().info('%s  | %s' % (name, tail.last()))
+                next_log = loop.time() + self.__log_interval
+        tail.close()
 
     async def __readline_info(self, f):
         async for line in f:
@@ -38,6 +105,224 @@ class SubprocessDownloader(Downloader):
             cmd,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE)
-        await asyncio.gather(self.__readline_info(proc.stdout), self.__readline_debug(proc.stderr))
+        if self.__tail_lines is None:
+            await asyncio.gather(self.__readline_info(proc.stdout), self.__readline_debug(proc.stderr))
+            return_code = await proc.wait()
+            return None if return_code == 0 else return_code  # 返回return code，被信号杀掉时是负数，也算失败
+        tails = {name: OutputTail(self.__tail_lines, self.__stdout_encoding) for name in ['stdout', 'stderr']}
+        await asyncio.gather(self.__capture(proc.stdout, 'stdout', tails['stdout']),
+                             self.__capture(proc.stderr, 'stderr', tails['stderr']))
         return_code = await proc.wait()
-        return None if return_code <= 0 else return_code  # 返回return code
+        for name, tail in tails.items():
+            if return_code != 0:
+                self.getLogger().warning('%s  | exited with %d, last %d of %d lines:' % (
+                    name, return_code, len(tail.lines()), tail.count))
+                for line in tail.lines():
+                    self.getLogger().warning('%s  | %s' % (name, line))
+            else:
+                self.getLogger().debug('%s  | %d lines' % (name, tail.count))
+        return None if return_code == 0 else return_code  # 返回return code，被信号杀掉时是负数，也算失败
+
+
+class WorkerCrashedError(Exception):
+    """常驻子进程在返回结果之前退出了"""
+    pass
+
+
+class SubprocessWorker(Logger):
+    """
+    一个常驻的子进程，按行从stdin收JSON格式的item，按行往stdout写JSON格式的结果
+    收到的每一行是 {"id": 序号, "item": item}
+    要写回一行 {"id": 同一个序号, "return_code": 0或者别的}，return_code为0或是没有表示成功
+    stdout里不是结果的行和stderr里的行都只在DEBUG级别输出，stderr另外留最后tail_lines行，崩溃时打出来
+    """
+
+    def __init__(self, cmd: str, encoding: str = 'utf-8', tail_lines: int = 20):
+        super().__init__()
+        self.__cmd = cmd
+        self.__encoding = encoding
+        self.stderr = OutputTail(tail_lines, encoding)  # stderr的最后几行
+        self.__proc: Optional[asyncio.subprocess.Process] = None
+        self.__readers = []
+        self.__id = 0
+        self.__result: Optional[asyncio.Future] = None
+        self.items = 0  # 当前这个进程已经处理了多少个item
+        self.crashes = 0  # 连续崩溃的次数
+
+    @property
+    def running(self) -> bool:
+        return self.__proc is not None and self.__proc.returncode is None
+
+    async def start(self):
+        self.__proc = await asyncio.create_subprocess_shell(
+            self.__cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=16 * 1024 * 1024,
+            start_new_session=os.name == 'posix')  # 自己一个进程组，杀的时候连shell启动的子进程一起杀
+        self.items = 0
+        self.__readers = [asyncio.create_task(self.__read_stdout(self.__proc.stdout)),
+                          asyncio.create_task(self.__read_stderr(self.__proc.stderr))]
+        self.getLogger().info("worker  | started pid %d: %s" % (self.__proc.pid, self.__cmd))
+
+    async def __read_stdout(self, f: asyncio.StreamReader):
+        try:
+            async for line in f:
+                line = line.decode(self.__encoding, errors='replace').strip()
+                msg = None
+                if line.startswith('{'):
+                    try:
+                        msg = json.loads(line)
+                    except ValueError:
+                        pass
+                result = self.__result
+                if isinstance(msg, dict) and result is not None and not result.done() and msg.get('id') == self.__id:
+                    result.set_result(msg)
+                else:
+                    self.getLogger().debug('stdout  | %s' % line)
+        except ValueError:  # 一行太长
+            self.getLogger().exception("worker  | cannot read stdout")
+        finally:
+            if self.__result is not None and not self.__result.done():
+                self.__result.set_exception(WorkerCrashedError("worker exited before returning the result"))
+
+    async def __read_stderr(self, f: asyncio.StreamReader):
+        async for line in f:
+            self.stderr.feed(line)
+            self.getLogger().debug('stderr  | %s' % line.decode(self.__encoding, errors='replace').strip())
+
+    async def run(self, item, timeout: float = None) -> dict:
+        """把item交给子进程，等它返回结果，子进程没在运行就先启动"""
+        if not self.running:
+            await self.start()
+        self.__id += 1
+        self.items += 1
+        self.__result = asyncio.get_running_loop().create_future()
+        line = json.dumps({'id': self.__id, 'item': item}, ensure_ascii=False, default=str) + '\n'
+        try:
+            self.__proc.stdin.write(line.encode(self.__encoding))
+            await self.__proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError) as e:
+            raise WorkerCrashedError("cannot write to worker: %s" % e)
+        return await asyncio.wait_for(self.__result, timeout)
+
+    @staticmethod
+    def __kill(proc: asyncio.subprocess.Process):
+        try:
+            if os.name == 'posix':
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except ProcessLookupError:
+            pass
+
+    async def stop(self, kill: bool = False, timeout: float = 10) -> Optional[int]:
+        """关掉stdin让子进程自己退出，kill为True或是超时就直接杀掉，返回return code"""
+        if self.__proc is None:
+            return None
+        proc, self.__proc = self.__proc, None
+        if proc.returncode is None:
+            if kill:
+                self.__kill(proc)
+            else:
+                proc.stdin.close()
+            try:
+                await asyncio.wait_for(proc.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.__kill(proc)
+                await proc.wait()
+        await asyncio.gather(*self.__readers, return_exceptions=True)
+        self.getLogger().info("worker  | pid %d exited with %s after %d items" % (proc.pid, proc.returncode, self.items))
+        return proc.returncode
+
+
+class SubprocessWorkerDownloader(Downloader):
+    """
+    用常驻子进程下载，省掉每个item都启动一次解释器的时间，协议见SubprocessWorker
+    同时运行workers个子进程，每个子进程同一时间只处理一个item
+    子进程在每轮结束(cycle_end)时退出，下一轮用到时再启动；不在Pair里用时可以用async with，或是自己调用close
+    子进程处理完max_items_per_worker个item之后就让它退出，下一个item来的时候再启动一个新的，防止内存泄漏之类的问题积累
+    子进程崩溃或超时就杀掉重启，连续崩溃时重启的等待时间从restart_delay开始每次翻倍，最多等max_restart_delay
+    """
+
+    def __init__(self, cmd: str, workers: int = 4, max_items_per_worker: int = 100,
+                 timeout: timedelta = None, restart_delay: timedelta = timedelta(seconds=1),
+                 max_restart_delay: timedelta = timedelta(minutes=1), retry_on_crash: bool = True,
+                 stdout_encoding='utf-8'):
+        """
+        cmd是启动子进程的指令
+        timeout是每个item最多处理多久，超时算作崩溃，为None表示不限
+        retry_on_crash表示子进程崩溃时是否换一个新进程再试一次这个item
+        """
+        super().__init__()
+        self.__cmd = cmd
+        self.__workers = workers
+        self.__max_items = max_items_per_worker
+        self.__timeout = timeout.total_seconds() if timeout is not None else None
+        self.__restart_delay = restart_delay.total_seconds()
+        self.__max_restart_delay = max_restart_delay.total_seconds()
+        self.__retry_on_crash = retry_on_crash
+        self.__stdout_encoding = stdout_encoding
+        self.__pools = weakref.WeakKeyDictionary()  # 事件循环 -> 空闲的SubprocessWorker组成的asyncio.Queue
+        self.__tag = None
+
+    def setTag(self, tag: str = None):
+        super().setTag(tag)
+        self.__tag = tag
+
+    def __pool(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if loop not in self.__pools:
+            pool = asyncio.Queue()
+            for _ in range(self.__workers):
+                worker = SubprocessWorker(self.__cmd, self.__stdout_encoding)
+                worker.setTag(self.__tag)
+                pool.put_nowait(worker)
+            self.__pools[loop] = pool
+        return self.__pools[loop]
+
+    async def download(self, item):
+        self.getLogger().debug("item    | %s" % item)
+        pool = self.__pool()
+        worker: SubprocessWorker = await pool.get()
+        try:
+            for attempt in range(2 if self.__retry_on_crash else 1):
+                if worker.crashes > 0 and not worker.running:
+                    delay = min(self.__restart_delay * 2 ** (worker.crashes - 1), self.__max_restart_delay)
+                    self.getLogger().info("worker  | restart in %.1fs after %d crashes" % (delay, worker.crashes))
+                    await asyncio.sleep(delay)
+                try:
+                    result = await worker.run(item, self.__timeout)
+                except (WorkerCrashedError, asyncio.TimeoutError) as e:
+                    self.getLogger().warning("worker  | crashed on %s: %r" % (item, e))
+                    for line in worker.stderr.lines():
+                        self.getLogger().warning("stderr  | %s" % line)
+                    return_code = await worker.stop(kill=True)
+                    worker.crashes += 1
+                    continue
+                worker.crashes = 0
+                if worker.items >= self.__max_items:
+                    await worker.stop()
+                return_code = result.get('return_code')
+                return None if not return_code else return_code
+            return return_code if return_code else -1
+        finally:
+            pool.put_nowait(worker)
+
+    async def close(self):
+        """让当前事件循环里的子进程都退出，之后还可以接着用，用到时再启动"""
+        pool = self.__pools.pop(asyncio.get_running_loop(), None)
+        if pool is None:
+            return
+        workers = [await pool.get() for _ in range(self.__workers)]  # 正在用的要等它用完
+        await asyncio.gather(*[w.stop() for w in workers])
+
+    async def cycle_end(self):
+        await self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
@@ -53,6 +53,14 @@ class Node(Logger, metaclass=abc.ABCMeta):
         self.__queue = None
         self.__semaphore = None
 
+    async def cycle_start(self):
+        """Pair的每一轮开始之前调用，需要按轮做事的Node可以重写此函数，封装了别的Node的要把调用传下去"""
+        pass
+
+    async def cycle_end(self):
+        """Pair的每一轮所有下载都结束之后调用，可以在这里保存缓存、关闭子进程之类的"""
+        pass
+
     def set_parallel(self, n: int = 1):
         assert self.__semaphore == None
         self.__n = n
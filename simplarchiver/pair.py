@@ -18,6 +18,18 @@ class DownloadController(Logger):
         super().setTag(tag)
         self.__downloader.setTag(tag)
 
+    async def cycle_start(self):
+        try:
+            await self.__downloader.cycle_start()
+        except Exception:
+            self.getLogger().exception('Catch an Exception from cycle_start of your Downloader:')
+
+    async def cycle_end(self):
+        try:
+            await self.__downloader.cycle_end()
+        except Exception:
+            self.getLogger().exception('Catch an Exception from cycle_end of your Downloader:')
+
     async def put(self, item):
         """将待下载的feed item入队列"""
         self.getLogger().debug('putting item: %s' % item)
@@ -73,6 +85,18 @@ class FeedController(Logger):
         super().setTag(tag)
         self.__feeder.setTag(tag)
 
+    async def cycle_start(self):
+        try:
+            await self.__feeder.cycle_start()
+        except Exception:
+            self.getLogger().exception('Catch an Exception from cycle_start of your Feeder:')
+
+    async def cycle_end(self):
+        try:
+            await self.__feeder.cycle_end()
+        except Exception:
+            self.getLogger().exception('Catch an Exception from cycle_end of your Feeder:')
+
     async def __get_feeds(self, sem: asyncio.Semaphore):
         """以固定并发数进行self.__feeder.get_feeds()"""
         try:
@@ -185,6 +209,10 @@ class Pair(Logger):
         # got Future <Future pending> attached to a different loop
         # 这是由于asyncio.run会生成新的事件循环，不同事件循环中的事件不能互相调用
 
+        self.__log_coroutine_once('cycle_start | start')
+        await asyncio.gather(*[c.cycle_start() for c in self.__fcs + self.__dcs])
+        self.__log_coroutine_once('cycle_start | end')
+
         self.__log_coroutine_once('feeder     tasks | start  creating')
         # Download任务开始之后是一直在运行的，等到Feed任务给他发停止信息才会停
         for dc in self.__dcs:
@@ -207,6 +235,10 @@ class Pair(Logger):
             await dc.join()
         self.__log_coroutine_once('downloader tasks | finish join')
 
+        self.__log_coroutine_once('cycle_end   | start')
+        await asyncio.gather(*[c.cycle_end() for c in self.__fcs + self.__dcs])
+        self.__log_coroutine_once('cycle_end   | end')
+
     async def __coroutine_once_no_raise(self):
         self.__log_coroutine_once('start')
         while True:
@@ -1,3 +1,5 @@
+from typing import List, Callable, Awaitable
+
 from .abc import *
 
 
@@ -20,67 +22,160 @@ class UpdateRW(Logger, metaclass=abc.ABCMeta):
         """
         pass
 
+    async def read_many(self, items: List) -> List[bool]:
+        """
+        批量比对更新标记，返回值与items一一对应
+        默认就是一个一个地read，子类可以重写此函数以实现一次读取整批的更新标记
+        """
+        return [await self.read(item) for item in items]
+
+    async def write_many(self, items: List) -> List[bool]:
+        """
+        批量记录更新标记，返回值与items一一对应
+        默认就是一个一个地write，子类可以重写此函数以实现一次写入整批的更新标记
+        """
+        return [await self.write(item) for item in items]
+
+    async def cycle_start(self):
+        """Pair的每一轮开始之前调用，需要按轮做事的子类可以重写此函数"""
+        pass
+
+    async def cycle_end(self):
+        """Pair的每一轮所有下载都结束之后调用"""
+        pass
+
+
+class UpdateBatch:
+    """
+    把同时到达的item攒成一批，一起交给handle处理，UpdateFilter的读和UpdeteCallback的写共用
+    handle输入一批item，返回与之一一对应的结果
+    """
+
+    def __init__(self, handle: Callable[[List], Awaitable[List]], batch_size: int = 1, batch_delay: float = 0.05):
+        self.__handle = handle
+        self.__batch_size = batch_size
+        self.__batch_delay = batch_delay
+        self.__batch = []  # 等待处理的(item, future)
+        self.__batch_timer = None
+
+    async def __flush(self):
+        """将当前积攒的一批item拿去处理，并把结果交给各自的future"""
+        if self.__batch_timer is not None:
+            self.__batch_timer.cancel()
+            self.__batch_timer = None
+        batch, self.__batch = self.__batch, []
+        if len(batch) <= 0:
+            return
+        results = await self.__handle([item for item, _ in batch])
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def __flush_later(self):
+        await asyncio.sleep(self.__batch_delay)
+        self.__batch_timer = None
+        await self.__flush()
+
+    async def __call__(self, item):
+        if self.__batch_size <= 1:
+            return (await self.__handle([item]))[0]
+        future = asyncio.get_running_loop().create_future()  # future必须在事件循环里生成
+        self.__batch.append((item, future))
+        if len(self.__batch) >= self.__batch_size:  # 攒够了一批就立即处理
+            await self.__flush()
+        elif self.__batch_timer is None:  # 攒不够就等一会再处理
+            self.__batch_timer = asyncio.create_task(self.__flush_later())
+        return await future
+
 
 class UpdateFilter(Filter):
 
-    def __init__(self, update_rw: UpdateRW):
+    def __init__(self, update_rw: UpdateRW, batch_size: int = 1, batch_delay: float = 0.05):
         """
         base_downloader是要封装的普通下载器
         update_rw用于指定如何写入和读取更新信息
+        batch_size表示最多将多少个同时到达的item合成一批进行比对，为1时不合批
+        batch_delay表示一批item最多等待多少秒就开始比对
         """
         super().__init__()
         # update_rw.setTag(tag) # 继承自内置类Filter的类不需要在初始化时setTag
         self.__update_rw = update_rw
+        self.__batch = UpdateBatch(self.filter_many, batch_size, batch_delay)
 
     def setTag(self, tag: str = None):  # 继承自内置类Filter的类的Tag是在FilterFeeder或FilterDownloader初始化时setTag进去的
         super().setTag(tag)
         self.__update_rw.setTag(tag)
 
-    async def filter(self, item):
-        """过滤掉更新列表里已有记录且tag值相同的item"""
+    async def cycle_start(self):  # UpdeteCallback和这里共用一个update_rw，只从这里传下去
+        await self.__update_rw.cycle_start()
+
+    async def cycle_end(self):
+        await self.__update_rw.cycle_end()
+
+    async def filter_many(self, items: List) -> List:
+        """一次比对一批item，返回值与items一一对应，被过滤掉的item对应None"""
+        self.getLogger().debug('filter a batch of %d items' % len(items))
         try:
-            if await self.__update_rw.read(item):
+            updated = await self.__update_rw.read_many(items)
+        except Exception:
+            self.getLogger().exception('An error occured, %d items will be downloaded' % len(items))
+            return items
+        results = []
+        for item, u in zip(items, updated):
+            if u:
                 self.getLogger().debug('item will be downloaded: %s' % item)
-                return item
+                results.append(item)
             else:
                 self.getLogger().debug('item will be skipped: %s' % item)
-                return None
-        except Exception:
-            self.getLogger().exception('An error occured, item will be downloaded: %s' % item)
-            return item
+                results.append(None)
+        return results
+
+    async def filter(self, item):
+        """过滤掉更新列表里已有记录且tag值相同的item"""
+        return await self.__batch(item)
 
 
 class UpdeteCallback(Callback):
 
-    def __init__(self, update_rw: UpdateRW):
+    def __init__(self, update_rw: UpdateRW, batch_size: int = 1, batch_delay: float = 0.05):
         """
         base_downloader是要封装的普通下载器
         update_rw用于指定如何写入和读取更新信息
+        batch_size表示最多将多少个同时下载完的item合成一批写入更新标记，为1时不合批
+        batch_delay表示一批item最多等待多少秒就开始写入
         """
         super().__init__()
         # update_rw.setTag(tag) # 继承自内置类Filter的类不需要在初始化时setTag
         self.__update_rw = update_rw
+        self.__batch = UpdateBatch(self.write_many, batch_size, batch_delay)
 
     def setTag(self, tag: str = None):  # 继承自内置类Filter的类的Tag是在FilterFeeder或FilterDownloader初始化时setTag进去的
         super().setTag(tag)
         self.__update_rw.setTag(tag)
 
+    async def write_many(self, items: List) -> List[bool]:
+        """一次写入一批item的更新标记，返回值与items一一对应"""
+        self.getLogger().debug('write a batch of %d update tags' % len(items))
+        try:
+            return await self.__update_rw.write_many(items)
+        except Exception:
+            self.getLogger().exception('An error occured when writing %d update tags' % len(items))
+            return [False] * len(items)
+
     async def callback(self, item, return_code):
         """如果下载成功就刷新更新列表里对应的item的tag值"""
         if return_code is None:
             self.getLogger().debug('Download finished , update will be writen: %s' % item)
-            try:
-                if await self.__update_rw.write(item):
-                    self.getLogger().debug('Update tag has been writen: %s' % item)
-                else:
-                    self.getLogger().debug('Update tag has not been writen: %s' % item)
-            except Exception:
-                self.getLogger().exception('An error occured when writing update tag: %s' % item)
+            if await self.__batch(item):
+                self.getLogger().debug('Update tag has been writen: %s' % item)
+            else:
+                self.getLogger().debug('Update tag has not been writen: %s' % item)
         else:
             self.getLogger().debug('Downloader exit %s, update will not be writen: %s' % (return_code, item))
 
 
-def UpdateDownloader(base_downloader: Downloader, update_rw: UpdateRW):
-    f = FilterCallbackDownloader(base_downloader, UpdateFilter(update_rw), UpdeteCallback(update_rw))
+def UpdateDownloader(base_downloader: Downloader, update_rw: UpdateRW, batch_size: int = 1):
+    f = FilterCallbackDownloader(base_downloader,
+                                 UpdateFilter(update_rw, batch_size), UpdeteCallback(update_rw, batch_size))
     f.setTag('UpdateDownloader')
     return f
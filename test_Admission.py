@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from datetime import timedelta
+
+from simplarchiver.example import SleepDownloader, AdmissionController, AdmissionDownloader, AdmissionFilterDownloader
+from simplarchiver.example.admission import SystemLoad
+
+logging.basicConfig(level=logging.INFO, format=' %(asctime)s | %(levelname)-8s | %(name)-26s | %(message)s')
+
+
+def log(msg):
+    logging.info('test_Admission | %s' % msg)
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+async def main():
+    log("this machine: load per cpu, available memory = %s, %s cpus" % (SystemLoad().sample(), SystemLoad().cpus()))
+    with tempfile.TemporaryDirectory() as tmp:
+        proc, cgroup = os.path.join(tmp, 'proc'), os.path.join(tmp, 'cgroup')
+        write(os.path.join(proc, 'meminfo'), "MemTotal: 1000 kB\nMemFree: 100 kB\nMemAvailable: 500 kB\n")
+        write(os.path.join(cgroup, 'memory.max'), "%d\n" % (1024 * 1024))
+        write(os.path.join(cgroup, 'memory.current'), "%d\n" % (712 * 1024))
+        write(os.path.join(cgroup, 'memory.stat'), "anon 1\ninactive_file %d\n" % (200 * 1024))
+        load = SystemLoad(proc, cgroup)
+
+        def set_load(value):  # 每个CPU的负载，loadavg是整台机器的
+            write(os.path.join(proc, 'loadavg'), "%.2f 1.00 1.00 1/100 12345\n" % (value * os.cpu_count()))
+
+        set_load(0.5)
+        assert load.quota() is None and load.sample() == (0.5, 0.5)  # cgroup里扣掉文件缓存还剩一半
+
+        quota_cgroup = os.path.join(tmp, 'quota_cgroup')
+        write(os.path.join(quota_cgroup, 'cpu.max'), "200000 100000\n")  # 2个CPU的配额
+        write(os.path.join(quota_cgroup, 'cpu.stat'), "usage_usec 0\nnr_periods 0\nnr_throttled 0\n")
+        quota_load = SystemLoad(proc, quota_cgroup)
+        assert quota_load.quota() == 2 and quota_load.sample()[0] is None  # 第一次读还没法算用了多少CPU
+        time.sleep(0.2)
+        write(os.path.join(quota_cgroup, 'cpu.stat'), "usage_usec 400000\nnr_periods 2\nnr_throttled 1\n")
+        value = quota_load.sample()[0]
+        assert 1.2 < value <= 1.5, value  # 用满了配额，一半的周期被限流；和loadavg无关
+        write(os.path.join(quota_cgroup, 'cpu.pressure'), "some avg10=20.00 avg60=0.00 avg300=0.00 total=0\n")
+        time.sleep(0.2)
+        write(os.path.join(quota_cgroup, 'cpu.stat'), "usage_usec 600000\nnr_periods 4\nnr_throttled 3\n")
+        value = quota_load.sample()[0]
+        assert 0.6 < value <= 0.7, value  # 用了一半的配额，有cpu.pressure时用它
+        log("load per cpu from cgroup with quota: %.2f" % value)
+
+        controller = AdmissionController(max_load=1.0, min_available_memory=0.2, min_running=1,
+                                         admit_interval=timedelta(seconds=0.1),
+                                         poll_interval=timedelta(seconds=0.05), system_load=load)
+        downloaders = [AdmissionDownloader(SleepDownloader(i, seconds=0.5), controller) for i in range(8)]
+        logging.getLogger().setLevel(logging.WARNING)
+        start = time.perf_counter()
+        await asyncio.gather(*[d.download('item') for d in downloaders])
+        logging.getLogger().setLevel(logging.INFO)
+        log("not overloaded: 8 downloads in %.2fs" % (time.perf_counter() - start))
+
+        set_load(4.0)  # 每个CPU负载2，超了
+        logging.getLogger().setLevel(logging.WARNING)
+        tasks = [asyncio.create_task(d.download('item')) for d in downloaders]
+        await asyncio.sleep(1)
+        assert controller.running == 1  # 只让最少的那一个跑
+        logging.getLogger().setLevel(logging.INFO)
+        log("overloaded: %d running after 1s" % controller.running)
+        set_load(0.5)
+        start = time.perf_counter()
+        await asyncio.gather(*tasks)
+        log("load dropped: the rest finished in %.2fs" % (time.perf_counter() - start))
+        assert controller.running == 0 and controller.admitted == 16
+
+        set_load(4.0)  # 过滤器不占名额，超负荷时一个都不放
+        downloader = AdmissionFilterDownloader(SleepDownloader('filter', seconds=0), controller)
+        logging.getLogger().setLevel(logging.WARNING)
+        tasks = [asyncio.create_task(downloader.download('item')) for _ in range(20)]
+        await asyncio.sleep(0.5)
+        assert controller.admitted == 16 and not any(t.done() for t in tasks)
+        logging.getLogger().setLevel(logging.INFO)
+        log("overloaded: AdmissionFilter holds all 20 items")
+        set_load(0.5)
+        start = time.perf_counter()
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        assert elapsed >= 19 * 0.1 and controller.admitted == 36 and controller.running == 0  # 每admit_interval放一个
+        log("load dropped: AdmissionFilter let 20 items through in %.2fs" % elapsed)
+
+        controller = AdmissionController(max_load=1.0, min_running=1, max_running=1,
+                                         admit_interval=timedelta(seconds=0), poll_interval=timedelta(seconds=0.05),
+                                         system_load=load)
+        downloaders = [AdmissionDownloader(SleepDownloader(i, seconds=1), controller) for i in range(3)]
+        downloader = AdmissionFilterDownloader(SleepDownloader('filter', seconds=0), controller)
+        logging.getLogger().setLevel(logging.WARNING)
+        tasks = [asyncio.create_task(d.download('item')) for d in downloaders]
+        await asyncio.sleep(0.1)
+        start = time.perf_counter()
+        await downloader.download('item')  # 下载在排队等名额，不挡着过滤器
+        elapsed = time.perf_counter() - start
+        assert elapsed < 0.5 and controller.running == 1, elapsed
+        await asyncio.gather(*tasks)
+        logging.getLogger().setLevel(logging.INFO)
+        log("AdmissionFilter passed in %.2fs while downloads were queued for max_running" % elapsed)
+
+
+asyncio.run(main())
@@ -0,0 +1,76 @@
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from simplarchiver import FilterFeeder
+from simplarchiver.example.file import FileFeeder, DedupFilter
+
+logging.basicConfig(level=logging.INFO, format=' %(asctime)s | %(levelname)-8s | %(name)-26s | %(message)s')
+
+
+def log(msg):
+    logging.info('test_Dedup | %s' % msg)
+
+
+def make_tree(root):
+    """一些不同的文件、完全一样的副本、大小一样的、开头结尾一样只有中间不一样的"""
+    random.seed(0)
+    for i in range(200):
+        os.makedirs(os.path.join(root, str(i % 10)), exist_ok=True)
+        with open(os.path.join(root, str(i % 10), '%d.bin' % i), 'wb') as f:
+            f.write(random.randbytes(random.choice([100, 4096, 300 * 1024])))
+    for i in range(0, 200, 7):
+        shutil.copy(os.path.join(root, str(i % 10), '%d.bin' % i), os.path.join(root, str((i + 1) % 10), 'copy%d' % i))
+    for i in range(20):
+        data = bytearray(b'x' * 1024 * 1024)
+        data[512 * 1024] = i
+        with open(os.path.join(root, 'middle%d' % i), 'wb') as f:
+            f.write(data)
+    for i in range(5):
+        open(os.path.join(root, 'empty%d' % i), 'wb').close()
+
+
+def naive(root):
+    """直接读整个文件算hash"""
+    seen, kept = set(), set()
+    for top, _, files in os.walk(root):
+        for name in sorted(files):
+            path = os.path.join(top, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()
+            if len(data) <= 0 or digest not in seen:
+                kept.add(digest if len(data) > 0 else path)
+            seen.add(digest)
+    return len(kept)
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'tree')
+        make_tree(root)
+        expected = naive(root)
+        cache = os.path.join(tmp, 'hashes.json')
+        for what in ["first run", "second run with hash cache"]:
+            dedup = DedupFilter(cache_path=cache)
+            feeder = FilterFeeder(FileFeeder(root), dedup)
+            start = time.perf_counter()
+            got = [path async for path in feeder.get_feeds() if path is not None]
+            assert len(got) == expected, (len(got), expected)
+            log("%s: %d files kept in %.3fs, %d duplicates, %d files read" % (
+                what, len(got), time.perf_counter() - start, dedup.duplicates, dedup.hashed))
+            await feeder.cycle_end()  # Pair每轮结束时会调用，写hash缓存并关掉进程池
+            assert os.path.isfile(cache)
+        hashed = dedup.hashed
+        got = [path async for path in feeder.get_feeds() if path is not None]  # 上一轮见过的文件已经忘掉了
+        assert len(got) == expected and dedup.hashed == hashed, (len(got), dedup.hashed - hashed)
+        log("next cycle: %d files kept again, no file read" % len(got))
+        await dedup.close()
+
+
+asyncio.run(main())
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from datetime import timedelta
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from simplarchiver.example.qbittorrent import QBittorrentDownloader
+
+logging.basicConfig(level=logging.INFO, format=' %(asctime)s | %(levelname)-8s | %(name)-26s | %(message)s')
+
+# 一个假的qBittorrent Web API，记下登录次数和每次torrents/add加了哪些url
+logins, adds, sessions = [], [], set()
+
+
+class FakeQBittorrent(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body=b'', headers=None):
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sid(self):
+        for part in self.headers.get('Cookie', '').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == 'SID':
+                return value
+        return None
+
+    def do_GET(self):
+        if self.path.startswith('/api/v2/app/webapiVersion'):
+            return self.reply(200, b'2.8.3')
+        if self.path.startswith('/api/v2/app/version'):
+            return self.reply(200, b'v4.5.0')
+        self.reply(404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if self.path.startswith('/api/v2/auth/login'):
+            self.rfile.read(length)
+            sid = uuid.uuid4().hex
+            sessions.add(sid)
+            logins.append(sid)
+            return self.reply(200, b'Ok.', {'Set-Cookie': 'SID=%s; path=/' % sid})
+        if self.sid() not in sessions:
+            self.rfile.read(length)
+            return self.reply(403, b'Forbidden')
+        if self.path.startswith('/api/v2/torrents/add'):
+            body = self.rfile.read(length)
+            if self.headers['Content-Type'].startswith('multipart/'):
+                form = BytesParser().parsebytes(b'Content-Type: %s\r\n\r\n' % self.headers['Content-Type'].encode() + body)
+                urls = ''.join(part.get_payload(decode=True).decode() for part in form.get_payload()
+                               if part.get_param('name', header='content-disposition') == 'urls')
+            else:
+                urls = parse_qs(body.decode()).get('urls', [''])[0]
+            adds.append([u for u in urls.split('\n') if u])
+            time.sleep(0.05)  # 真的qBittorrent处理一次请求也要一点时间
+            return self.reply(200, b'Ok.')
+        self.rfile.read(length)
+        self.reply(404)
+
+
+def log(msg):
+    logging.info('test_QBittorrent | %s' % msg)
+
+
+async def main(port):
+    opt = dict(host='127.0.0.1', port=port, username='admin', password='adminadmin')
+    d = QBittorrentDownloader(batch_window=timedelta(seconds=0.2), **opt)
+    d.setTag('test_QBittorrent')
+    start = time.perf_counter()
+    results = await asyncio.gather(*[d.download({'urls': 'magnet:?xt=%d' % i, 'save_path': '/a'}) for i in range(20)] +
+                                   [d.download({'urls': 'magnet:?xt=b%d' % i, 'save_path': '/b'}) for i in range(5)])
+    assert results == ['Ok.'] * 25, results
+    assert len(logins) == 1 and sorted(len(a) for a in adds) == [5, 20], (logins, adds)
+    log("25 items in %.3fs: %d login, %d torrents/add requests" % (time.perf_counter() - start, len(logins), len(adds)))
+
+    sessions.clear()  # 登录过期了
+    another = QBittorrentDownloader(batch_window=timedelta(seconds=0.2), **opt)  # 同样设置的共用一个Client
+    assert await another.download({'urls': 'magnet:?xt=c'}) == 'Ok.'
+    assert len(logins) == 2 and adds[-1] == ['magnet:?xt=c'], (logins, adds)
+    log("logged in again after the session expired")
+
+    d = QBittorrentDownloader(batch_window=timedelta(seconds=0.5), max_batch=3, **opt)
+    adds.clear()
+
+    async def download_later(i, delay):
+        await asyncio.sleep(delay)
+        return await d.download({'urls': 'magnet:?xt=d%d' % i})
+
+    results = await asyncio.gather(*[download_later(i, delay) for i, delay in enumerate([0, 0.1, 0.1, 0.3, 0.4, 0.6])])
+    assert results == ['Ok.'] * 6 and [len(a) for a in adds] == [3, 3], adds  # 提前提交的那一批的计时不影响下一批
+    log("a batch flushed at max_batch does not cut the next batch short")
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), FakeQBittorrent)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+asyncio.run(main(server.server_address[1]))
+server.shutdown()
@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from simplarchiver import Feeder
+from datetime import timedelta
+
+from simplarchiver.example.rss import RSSHubFeeder, RSSHubMultiPageFeeder, ConditionalGetCache
+from simplarchiver.example.rss import HttpCache, cached_httpx_client_opt_generator, host_scheduler, HedgePolicy
+from simplarchiver.example.rss import SeenSet
+from simplarchiver.example.rss.filter import TTRSSHubLinkFilter
+from simplarchiver.example.rss.common import httpx_client_pool
+
+logging.basicConfig(level=logging.DEBUG, format=' %(asctime)s | %(levelname)-8s | %(name)-26s | %(message)s')
+
+
+def log(msg):
+    logging.info('test_RSSHubLocal | %s' % msg)
+
+
+class FakeRSSHub(BaseHTTPRequestHandler):
+    """一个假的RSSHub，/feed?page=n返回第n页，每页10个item，共5页"""
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    connections = 0
+    requests = 0
+    not_modified = 0
+    active = 0  # 正在处理的慢请求数
+    max_active = 0
+    lock = threading.Lock()
+    stalls = 0
+
+    def setup(self):
+        super().setup()
+        FakeRSSHub.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        FakeRSSHub.requests += 1
+        query = parse_qs(urlparse(self.path).query)
+        if 'stall' in query:
+            with FakeRSSHub.lock:
+                FakeRSSHub.stalls += 1
+                stall = FakeRSSHub.stalls % 4 == 0  # 每4个请求有1个特别慢
+            if stall:
+                time.sleep(1)
+        if 'slow' in query:
+            with FakeRSSHub.lock:
+                FakeRSSHub.active += 1
+                FakeRSSHub.max_active = max(FakeRSSHub.max_active, FakeRSSHub.active)
+            time.sleep(0.1)
+            with FakeRSSHub.lock:
+                FakeRSSHub.active -= 1
+        page = int(query['page'][0]) if 'page' in query else 0
+        items = ''.join('<item><title>item %d</title><link>http://example.com/%d</link>'
+                        '<pubDate>Sat, 01 May 2021 00:%02d:00 GMT</pubDate></item>' % (i, i, 59 - i)
+                        for i in range(page * 10, page * 10 + 10)) if page < 5 else ''
+        body = ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+                '<title>fake</title><link>http://example.com/</link>%s</channel></rss>' % items).encode('utf8')
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            FakeRSSHub.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        if 'maxage' in query:
+            self.send_header('Cache-Control', 'max-age=%s' % query['maxage'][0])
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), FakeRSSHub)
+server.handle_error = lambda request, client_address: None  # 被取消的对冲请求会让服务端写入时断开连接
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = 'http://127.0.0.1:%d/feed' % server.server_port
+
+
+async def count(feeder: Feeder):
+    n = 0
+    async for _ in feeder.get_feeds():
+        n += 1
+    return n
+
+
+async def main(tmp: str):
+    for _ in range(3):
+        n = await count(RSSHubFeeder(url))
+        log("RSSHubFeeder got %d items" % n)
+        assert n == 10
+    feeder = RSSHubMultiPageFeeder(lambda page, last_page: '%s?page=%d' % (url, page) if page < 6 else None)
+    n = await count(feeder)
+    log("RSSHubMultiPageFeeder got %d items" % n)
+    assert n == 50
+    log("%d requests sent through %d connections" % (FakeRSSHub.requests, FakeRSSHub.connections))
+    assert FakeRSSHub.requests == 3 + 6
+    cache = ConditionalGetCache(os.path.join(tmp, 'conditional_get.json'))
+    for _ in range(3):
+        n = await count(RSSHubFeeder(url, conditional_get_cache=cache))
+        log("RSSHubFeeder with ConditionalGetCache got %d items" % n)
+        assert n == 10
+    log("%d requests answered with 304" % FakeRSSHub.not_modified)
+    assert FakeRSSHub.not_modified == 2
+    async for item in RSSHubFeeder(url, conditional_get_cache=cache).get_feeds():
+        item['link'] = 'changed by downloader'  # 改了重放出来的item也不影响下一次重放
+    async for item in RSSHubFeeder(url, conditional_get_cache=cache).get_feeds():
+        assert item['link'] != 'changed by downloader', item
+    await cache.save()
+    assert os.path.isfile(os.path.join(tmp, 'conditional_get.json'))
+    log("ConditionalGetCache replays copies of the cached items")
+    n = await count(RSSHubFeeder(url + '?page=1', stream=True))
+    log("RSSHubFeeder in stream mode got %d items" % n)
+    assert n == 10
+    feeder = RSSHubMultiPageFeeder(lambda page, last_page: '%s?page=%d' % (url, page) if page < 6 else None, stream=True)
+    n = await count(feeder)
+    log("RSSHubMultiPageFeeder in stream mode got %d items" % n)
+    assert n == 50
+    for ordered in [True, False]:
+        requests = FakeRSSHub.requests
+        feeder = RSSHubMultiPageFeeder(lambda page, last_page: '%s?page=%d' % (url, page),
+                                       concurrency=4, ordered=ordered)
+        n = await count(feeder)
+        log("RSSHubMultiPageFeeder concurrent(ordered=%s) got %d items in %d requests" % (
+            ordered, n, FakeRSSHub.requests - requests))
+        assert n == 50 and FakeRSSHub.requests - requests <= 5 + 4  # 遇到空页面之后最多再多发concurrency个
+    for concurrency, expected, max_requests in [(1, 50, 6), (4, 10, 4), (1, 10, 1)]:
+        requests = FakeRSSHub.requests
+        feeder = RSSHubMultiPageFeeder(lambda page, last_page: '%s?page=%d' % (url, page) if page < 6 else None,
+                                       concurrency=concurrency, incremental_path=os.path.join(tmp, 'incremental.json'))
+        n = await count(feeder)
+        log("RSSHubMultiPageFeeder incremental(concurrency=%d) got %d items in %d requests" % (
+            concurrency, n, FakeRSSHub.requests - requests))
+        assert n == expected and FakeRSSHub.requests - requests <= max_requests
+        await feeder.cycle_end()  # 下载都结束了才记录最新item
+    link_filter = TTRSSHubLinkFilter(cache_ttl=timedelta(minutes=10))
+    requests = FakeRSSHub.requests
+    for _ in range(3):
+        log("TTRSSHubLinkFilter got %s" % await link_filter.filter({'feed_url': url + '?page=1'}))
+    log("TTRSSHubLinkFilter sent %d requests" % (FakeRSSHub.requests - requests))
+    assert FakeRSSHub.requests - requests == 1
+    http_cache = os.path.join(tmp, 'http_cache')
+    for expected in [(3, 1, 1, 2), (2, 2, 2, 0)]:  # 第二次模拟重启
+        cache = HttpCache(http_cache, max_size=4096)
+        gen = cached_httpx_client_opt_generator(cache)
+        requests = FakeRSSHub.requests
+        for u in [url + '?page=1', url + '?page=1', url + '?page=2&maxage=60', url + '?page=2&maxage=60']:
+            n = await count(RSSHubFeeder(u, gen))
+            log("RSSHubFeeder with HttpCache got %d items from %s" % (n, u))
+            assert n == 10
+        got = (FakeRSSHub.requests - requests, cache.hits, cache.revalidated, cache.misses)
+        log("HttpCache: %d requests sent, %d hits, %d revalidated, %d misses" % got)
+        assert got == expected, got
+    cache = HttpCache(http_cache, max_size=1024)
+    gen = cached_httpx_client_opt_generator(cache)
+    for page in range(5):
+        await count(RSSHubFeeder('%s?page=%d&maxage=60' % (url, page), gen))
+    files = [f for f in os.listdir(http_cache) if f.endswith('.z')]
+    log("HttpCache with max_size=1024 keeps %d files" % len(files))
+    assert sum(os.path.getsize(os.path.join(http_cache, f)) for f in files) <= 1024
+    for concurrency, min_interval in [(None, 0), (2, 0), (8, 0.05)]:
+        host_scheduler.configure(urlparse(url).netloc, concurrency, min_interval)
+        FakeRSSHub.max_active = 0
+        start = time.time()
+        counts = await asyncio.gather(*[count(RSSHubFeeder('%s?page=%d&slow=1' % (url, page))) for page in range(8)])
+        log("host_scheduler(concurrency=%s, min_interval=%s): got %d items in %.2fs, at most %d requests at the same time" % (
+            concurrency, min_interval, sum(counts), time.time() - start, FakeRSSHub.max_active))
+        assert sum(counts) == 50 and (concurrency is None or FakeRSSHub.max_active <= concurrency)
+    host_scheduler.configure(urlparse(url).netloc)
+    for hedge in [None, HedgePolicy(min_delay=0.05, max_delay=0.5, min_samples=5)]:
+        start = time.time()
+        for page in range(20):
+            await count(RSSHubFeeder('%s?page=%d&stall=1' % (url, page % 5), hedge=hedge))
+        log("20 RSSHubFeeder with %s took %.2fs" % ("no hedge" if hedge is None else "hedge", time.time() - start))
+    log("HedgePolicy: %d requests, %d hedged, %d hedge wins, delay %.3fs" % (
+        hedge.requests, hedge.hedged, hedge.hedge_wins, hedge.delay()))
+    assert hedge.requests == 20 and hedge.hedge_wins > 0
+    host_scheduler.configure(urlparse(url).netloc, concurrency=1)  # 对冲请求不占名额，并发数为1时也能起作用
+    hedge = HedgePolicy(min_delay=0.05, max_delay=0.5, min_samples=5)
+    for page in range(20):
+        await count(RSSHubFeeder('%s?page=%d&stall=1' % (url, page % 5), hedge=hedge))
+    log("HedgePolicy with concurrency=1: %d requests, %d hedged, %d hedge wins, delay %.3fs" % (
+        hedge.requests, hedge.hedged, hedge.hedge_wins, hedge.delay()))
+    assert hedge.hedge_wins > 0
+    assert hedge.delay() > 0.05  # 被取消的慢请求也记下了，等待时间不会缩到min_delay
+    host_scheduler.configure(urlparse(url).netloc)
+    for expected in [[10, 10, 0, 10, 0], [0, 0, 0, 0, 0]]:  # 第二次模拟重启
+        seen_set = SeenSet(os.path.join(tmp, 'seen_set.bin'), max_entries=15)
+        for i, page in enumerate([1, 1, 1, 2, 1]):
+            feeder = RSSHubFeeder('%s?page=%d' % (url, page), seen_set=seen_set)
+            n = await count(feeder)
+            if i > 0:  # 第一次模拟这一轮没结束，不记下见过的item
+                await feeder.cycle_end()
+            log("RSSHubFeeder with SeenSet got %d items from page %d" % (n, page))
+            assert n == expected[i], (n, expected[i])
+
+
+with tempfile.TemporaryDirectory() as tmp:  # 记录文件都写在临时文件夹里，每次运行都从头开始
+    asyncio.run(main(tmp))
+assert len(httpx_client_pool) == 0  # 事件循环结束时连接池里的client都关掉了
+log("httpx_client_pool closed all clients after asyncio.run")
+server.shutdown()
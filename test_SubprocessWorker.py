@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import os
+import signal
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+from simplarchiver.example import SubprocessDownloader, SubprocessWorkerDownloader
+
+logging.basicConfig(level=logging.INFO, format=' %(asctime)s | %(levelname)-8s | %(name)-26s | %(message)s')
+
+# 一个常驻子进程：每个item打印一行日志，返回item的长度作为return code；遇到"crash"就退出，遇到"hang"就卡住
+# 给了一个文件夹参数时，运行期间在里面放一个以pid命名的文件，正常退出时删掉
+WORKER = r'''
+import json, os, sys, time
+pidfile = os.path.join(sys.argv[1], str(os.getpid())) if len(sys.argv) > 1 else None
+if pidfile:
+    open(pidfile, "w").close()
+for line in sys.stdin:
+    msg = json.loads(line)
+    item = msg["item"]
+    print("pid %d got %s" % (os.getpid(), item), flush=True)
+    if item == "crash":
+        sys.exit(3)
+    if item == "hang":
+        time.sleep(60)
+    print(json.dumps({"id": msg["id"], "return_code": 0 if item.startswith("ok") else len(item)}), flush=True)
+if pidfile:
+    os.remove(pidfile)
+'''
+
+# 每次都启动一次解释器的对照
+ONESHOT = r'''
+import sys
+print("got %s" % sys.argv[1])
+'''
+
+
+# 一个话很多的下载器，打印很多行进度条，最后失败退出
+CHATTY = r'''
+import sys
+for i in range(100000):
+    sys.stdout.write("\rprogress %d%%" % (i // 1000))
+    if i % 1000 == 0:
+        sys.stdout.write("\nchunk %d done\n" % i)
+print("error: disk full", file=sys.stderr)
+sys.exit(2)
+'''
+
+
+class Counter(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def log(msg):
+    logging.info('test_SubprocessWorker | %s' % msg)
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        worker, oneshot = os.path.join(tmp, 'worker.py'), os.path.join(tmp, 'oneshot.py')
+        with open(worker, 'w') as f:
+            f.write(WORKER)
+        with open(oneshot, 'w') as f:
+            f.write(ONESHOT)
+        logging.getLogger().setLevel(logging.WARNING)
+        items = ['ok%d' % i for i in range(100)]
+        d = SubprocessDownloader(lambda item: '"%s" "%s" %s' % (sys.executable, oneshot, item))
+        start = time.perf_counter()
+        await asyncio.gather(*[d.download(item) for item in items])
+        spawn_time = time.perf_counter() - start
+        d = SubprocessWorkerDownloader('"%s" "%s"' % (sys.executable, worker), workers=4, max_items_per_worker=1000)
+        start = time.perf_counter()
+        assert await asyncio.gather(*[d.download(item) for item in items]) == [None] * len(items)
+        worker_time = time.perf_counter() - start
+        await d.close()
+        logging.getLogger().setLevel(logging.INFO)
+        log("%d items: one process per item %.3fs, 4 persistent workers %.3fs" % (len(items), spawn_time, worker_time))
+
+        d = SubprocessWorkerDownloader('"%s" "%s"' % (sys.executable, worker), workers=1, max_items_per_worker=3,
+                                       timeout=timedelta(seconds=2), restart_delay=timedelta(seconds=0.1))
+        d.setTag('test_SubprocessWorker')
+        assert await d.download('ok') is None
+        assert await d.download('abcd') == 4
+        assert await d.download('crash') == 3  # 崩溃了重启再试一次，还是崩溃
+        assert await d.download('hang') == -9  # 超时被杀掉
+        for i in range(5):  # 每3个item换一个进程
+            assert await d.download('ok%d' % i) is None
+        await d.close()
+        log("ok")
+
+        pids = os.path.join(tmp, 'pids')
+        os.makedirs(pids)
+        async with SubprocessWorkerDownloader('"%s" "%s" "%s"' % (sys.executable, worker, pids), workers=3) as d:
+            await asyncio.gather(*[d.download('ok%d' % i) for i in range(6)])
+            assert len(os.listdir(pids)) == 3
+            await d.cycle_end()  # Pair每轮结束时会调用
+            assert len(os.listdir(pids)) == 0
+            await d.download('ok')  # 下一轮用到时再启动
+            assert len(os.listdir(pids)) == 1
+        assert len(os.listdir(pids)) == 0  # 出了async with就都退出了
+        log("workers exit at cycle_end and on leaving async with")
+
+        chatty = os.path.join(tmp, 'chatty.py')
+        with open(chatty, 'w') as f:
+            f.write(CHATTY)
+        counter = Counter()
+        logging.getLogger().addHandler(counter)
+        for what, d in [("every line", SubprocessDownloader(lambda item: '"%s" "%s"' % (sys.executable, chatty))),
+                        ("tail", SubprocessDownloader(lambda item: '"%s" "%s"' % (sys.executable, chatty),
+                                                      tail_lines=5, log_interval=timedelta(seconds=0.1)))]:
+            console = logging.getLogger().handlers[0]
+            console.setLevel(logging.WARNING if what == "every line" else logging.INFO)  # 只计数不打印
+            counter.count = 0
+            start = time.perf_counter()
+            assert await d.download('chatty') == 2
+            console.setLevel(logging.NOTSET)
+            log("chatty downloader, logging %s: %.3fs, %d log records" % (what, time.perf_counter() - start, counter.count))
+        logging.getLogger().removeHandler(counter)
+
+        for tail_lines in [None, 5]:  # 被信号杀掉时返回负数，也算失败
+            killed = SubprocessDownloader(lambda item: 'exec "%s" -c "import os, signal; os.kill(os.getpid(), %d)"' % (
+                sys.executable, signal.SIGTERM), tail_lines=tail_lines)
+            assert await killed.download('killed') == -signal.SIGTERM
+        log("process killed by a signal is a failure")
+
+
+asyncio.run(main())
@@ -0,0 +1,70 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+
+from simplarchiver.example.rss.common import aiter_json_array
+from simplarchiver.example.rss.ttrss import rfc3339_to_rfc822
+
+logging.basicConfig(level=logging.INFO, format=' %(asctime)s | %(levelname)-8s | %(name)-26s | %(message)s')
+
+
+def log(msg):
+    logging.info('test_TTRSSGenBenchmark | %s' % msg)
+
+
+# 一个假的GeneratedFeeds，50000篇文章分布在最近一年里
+start = datetime(2021, 5, 1)
+body = json.dumps({
+    'title': 'fake', 'feed_url': 'http://example.com/feed', 'self_url': 'http://example.com/',
+    'articles': [{
+        'id': i, 'link': 'http://example.com/%d' % i, 'title': '文章 %d' % i, 'content': 'x' * random.randint(0, 500),
+        'updated': (start - timedelta(minutes=random.randint(0, 525600))).strftime("%Y-%m-%dT%H:%M:%S+00:00")
+    } for i in range(50000)]
+}, ensure_ascii=False).encode('utf8')
+log("GeneratedFeeds json size: %d bytes" % len(body))
+
+
+def old_path():
+    data = json.loads(body.decode('utf8'))
+    for article in data['articles']:
+        pubDate = datetime.strptime(article['updated'], "%Y-%m-%dT%H:%M:%S%z")
+        article['pubDate'] = datetime.strftime(pubDate, "%a, %d %b %Y %H:%M:%S GMT")
+    return data['articles']
+
+
+def fast_date_path():
+    data = json.loads(body.decode('utf8'))
+    for article in data['articles']:
+        article['pubDate'] = rfc3339_to_rfc822(article['updated'])
+    return data['articles']
+
+
+async def chunks(size=65536):
+    for i in range(0, len(body), size):
+        yield body[i:i + size]
+
+
+async def stream_path():
+    articles = []
+    first = None
+    async for article in aiter_json_array(chunks(), 'articles'):
+        article['pubDate'] = rfc3339_to_rfc822(article['updated'])
+        if first is None:
+            first = time.perf_counter()
+        articles.append(article)
+    return articles, first
+
+
+t = time.perf_counter()
+expected = old_path()
+log("json.loads + strptime/strftime: %.3fs" % (time.perf_counter() - t))
+t = time.perf_counter()
+assert fast_date_path() == expected
+log("json.loads + rfc3339_to_rfc822: %.3fs" % (time.perf_counter() - t))
+t = time.perf_counter()
+got, first = asyncio.run(stream_path())
+assert got == expected
+log("aiter_json_array + rfc3339_to_rfc822: %.3fs, first article after %.4fs" % (time.perf_counter() - t, first - t))
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from simplarchiver.example.rss import TTRSSCatFeeder
+
+logging.basicConfig(level=logging.DEBUG, format=' %(asctime)s | %(levelname)-8s | %(name)-26s | %(message)s')
+
+
+def log(msg):
+    logging.info('test_TTRSSLocal | %s' % msg)
+
+
+class FakeTTRSS(BaseHTTPRequestHandler):
+    """一个假的TTRSS API，Category 1里有50个订阅，每个订阅有10篇文章，文章id越大越新"""
+    protocol_version = 'HTTP/1.1'
+    ops = {}
+    sessions = set()
+    logins = []
+    new_articles = []  # 测试since_id用的新文章
+    failing = set()  # 单独获取时会失败的订阅
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, content, status='OK'):
+        body = json.dumps({'seq': 0, 'status': 0 if status == 'OK' else 1, 'content': content}).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        op = data['op']
+        FakeTTRSS.ops[op] = FakeTTRSS.ops.get(op, 0) + 1
+        if op == 'login':
+            sid = 'sid%d' % len(FakeTTRSS.logins)
+            FakeTTRSS.logins.append(sid)
+            FakeTTRSS.sessions.add(sid)
+            return self.reply({'session_id': sid})
+        if data.get('sid') not in FakeTTRSS.sessions:
+            return self.reply({'error': 'NOT_LOGGED_IN'}, 'ERR')
+        if op == 'logout':
+            FakeTTRSS.sessions.discard(data['sid'])
+            return self.reply({'status': 'OK'})
+        if op == 'getFeeds':
+            return self.reply([{'id': f, 'feed_url': 'http://example.com/feed/%d' % f} for f in range(50)])
+        if op == 'getHeadlines' and not data.get('is_cat') and str(data['feed_id']) in FakeTTRSS.failing:
+            return self.reply({'error': 'FAILED'}, 'ERR')
+        if op == 'getHeadlines':
+            articles = [{'id': f * 10 + a, 'feed_id': str(f), 'link': 'http://example.com/%d/%d' % (f, a)}
+                        for f in range(50) for a in range(10)] + FakeTTRSS.new_articles
+            if not data.get('is_cat'):
+                articles = [a for a in articles if a['feed_id'] == str(data['feed_id'])]
+            articles = [a for a in articles if a['id'] > data.get('since_id', -1)]
+            articles.sort(key=lambda a: a['id'] % 10, reverse=True)  # 按时间排序
+            skip = data.get('skip', 0)
+            return self.reply(articles[skip:skip + data['limit']])
+        return self.reply({'error': 'UNKNOWN_METHOD'}, 'ERR')
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTTRSS)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = 'http://127.0.0.1:%d/api/' % server.server_port
+
+
+async def count(feeder):
+    return len([item async for item in feeder.get_feeds()])
+
+
+async def main():
+    for pages in [5, 0, 5]:
+        FakeTTRSS.ops = {}
+        feeder = TTRSSCatFeeder(url, 'user', 'pass', 1, cat_headlines_pages=pages)
+        items = [item async for item in feeder.get_feeds()]
+        log("TTRSSCatFeeder(cat_headlines_pages=%d) got %d items with API calls %s" % (pages, len(items), FakeTTRSS.ops))
+        assert len(items) == 50
+        assert FakeTTRSS.ops.get('getHeadlines') == (1 if pages > 0 else 50), FakeTTRSS.ops  # 一页就够了的话只请求一次
+    FakeTTRSS.ops = {}
+    FakeTTRSS.sessions.clear()  # 模拟服务器上的session过期
+    feeders = [TTRSSCatFeeder(url, 'user', 'pass', 1, cat_headlines_pages=pages) for pages in [5, 5, 0]]
+    counts = await asyncio.gather(*[asyncio.create_task(count(feeder)) for feeder in feeders])
+    log("3 TTRSSCatFeeder at the same time after session expired got %s items with API calls %s" % (counts, FakeTTRSS.ops))
+    assert counts == [50, 50, 50] and FakeTTRSS.ops.get('login') == 1, FakeTTRSS.ops  # 只重新登录一次
+    with tempfile.TemporaryDirectory() as tmp:
+        async def feed(pages, commit=True):
+            FakeTTRSS.ops = {}
+            feeder = TTRSSCatFeeder(url, 'user', 'pass', 1, cat_headlines_pages=pages,
+                                    since_id_path=os.path.join(tmp, 'since_id.json'))
+            items = [item['recent_link'] async for item in feeder.get_feeds()]
+            if commit:  # Pair每轮结束时会调用
+                await feeder.cycle_end()
+            log("TTRSSCatFeeder(cat_headlines_pages=%d) with since_id got %d items with API calls %s" % (
+                pages, len(items), FakeTTRSS.ops))
+            return items
+
+        assert len(await feed(5, commit=False)) == 50  # 这一轮没结束，since_id不记录
+        assert len(await feed(5)) == 50
+        assert len(await feed(5)) == 0
+        assert len(await feed(0)) == 0
+        FakeTTRSS.new_articles.append({'id': 1000, 'feed_id': '7', 'link': 'http://example.com/7/new'})
+        FakeTTRSS.new_articles.append({'id': 1001, 'feed_id': '3', 'link': 'http://example.com/3/new'})
+        FakeTTRSS.failing.add('7')
+        assert await feed(0) == ['http://example.com/3/new']  # 订阅7失败了，Category的since_id不能越过它的新文章
+        FakeTTRSS.failing.clear()
+        assert 'http://example.com/7/new' in await feed(5)
+        log("since_id of the cat is kept when a request failed")
+
+
+asyncio.run(main())
+server.shutdown()
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+from datetime import timedelta
+
+from simplarchiver import Pair, Feeder
+from simplarchiver.example import JustDownloader
+from simplarchiver.example.file import CentralizedUpdateDownloader, DecentralizedUpdateDownloader
+from simplarchiver.example.file.update import UpdateList, UpdateCache
+
+logging.basicConfig(level=logging.DEBUG, format=' %(asctime)s | %(levelname)-8s | %(name)-26s | %(message)s')
+
+
+def log(msg):
+    logging.info('test_Update | %s' % msg)
+
+
+class LinkFeeder(Feeder):
+    """每次都返回同样的一堆link"""
+
+    def __init__(self, n=20):
+        super().__init__()
+        self.n = n
+
+    async def get_feeds(self):
+        for i in range(self.n):
+            yield {'link': 'link%d' % i, 'pubDate': 'date%d' % (i % 3)}
+
+
+os.makedirs('./test', exist_ok=True)
+update_downloaders = [
+    CentralizedUpdateDownloader(
+        base_downloader=JustDownloader(1),
+        update_list_path="./test/test_update.json",
+        update_list_pair_gen=lambda i: (i['link'], i['pubDate']) if 'link' in i and 'pubDate' in i else (None, None),
+        batch_size=8,
+        cache_size=1024,
+        cache_ttl=timedelta(minutes=10)
+    ),
+    DecentralizedUpdateDownloader(
+        base_downloader=JustDownloader(2),
+        update_list_path="./test/test_update",
+        update_list_pair_gen=lambda i: (i['link'] + '.txt', i['pubDate']) if 'link' in i and 'pubDate' in i else (None, None),
+        batch_size=8
+    )
+]
+
+pair = Pair([LinkFeeder()], update_downloaders, downloader_concurrency=8)
+pair.setTag("test_Update")
+log("pair.coroutine_once() first time, all items should be downloaded")
+asyncio.run(pair.coroutine_once())
+log("pair.coroutine_once() second time, all items should be skipped")
+asyncio.run(pair.coroutine_once())
+log("pair.coroutine_once() third time, all items should be skipped without reading update list")
+asyncio.run(pair.coroutine_once())
+
+
+class RotatedLinkFeeder(LinkFeeder):
+    """每次都返回不同的link，旧的link不会再出现"""
+
+    def __init__(self, n=20):
+        super().__init__(n)
+        self.cycle = 0
+        self.outage = False  # 模拟RSS出错，什么都不返回
+
+    async def get_feeds(self):
+        if self.outage:
+            return
+        self.cycle += 1
+        for i in range(self.n):
+            yield {'link': 'cycle%d-link%d' % (self.cycle, i), 'pubDate': 'date'}
+
+
+for path in ["./test/test_retention.json", "./test/test_retention.json.seen", "./test/test_retention.seen"]:
+    if os.path.isfile(path):
+        os.remove(path)
+shutil.rmtree("./test/test_retention", ignore_errors=True)
+retention_downloaders = [
+    CentralizedUpdateDownloader(
+        base_downloader=JustDownloader(3),
+        update_list_path="./test/test_retention.json",
+        update_list_pair_gen=lambda i: (i['link'], i['pubDate']) if 'link' in i and 'pubDate' in i else (None, None),
+        max_cycles=1
+    ),
+    DecentralizedUpdateDownloader(
+        base_downloader=JustDownloader(4),
+        update_list_path="./test/test_retention",
+        update_list_pair_gen=lambda i: (i['link'] + '.txt', i['pubDate']) if 'link' in i and 'pubDate' in i else (None, None),
+        max_cycles=1
+    )
+]
+feeder = RotatedLinkFeeder()
+pair = Pair([feeder], retention_downloaders, downloader_concurrency=8)
+pair.setTag("test_Retention")
+
+
+async def retention():
+    for i in range(4):
+        log("retention cycle %d, update tags not seen in this cycle will be compacted" % i)
+        await pair.coroutine_once()
+        with open("./test/test_retention.json", 'r', encoding='utf8') as f:
+            keys = set(json.load(f).keys())
+        expected = set('cycle%d-link%d' % (feeder.cycle, j) for j in range(feeder.n))
+        assert keys == expected, keys
+        files = set(os.listdir("./test/test_retention"))
+        assert files == set(key + '.txt' for key in expected), files
+    feeder.outage = True
+    await pair.coroutine_once()  # 什么都没见到的一轮不算数，不能把更新标记都清掉
+    feeder.outage = False
+    with open("./test/test_retention.json", 'r', encoding='utf8') as f:
+        assert set(json.load(f).keys()) == expected
+    assert len(os.listdir("./test/test_retention")) == feeder.n
+
+
+asyncio.run(retention())
+log("retention ok")
+
+
+class CountingList(UpdateList):
+    keys_calls = 0
+
+    async def keys(self):
+        CountingList.keys_calls += 1
+        return await super().keys()
+
+
+async def cached_keys():
+    if os.path.isfile("./test/test_cached_keys.json"):
+        os.remove("./test/test_cached_keys.json")
+    cache = UpdateCache(CountingList("./test/test_cached_keys.json"))
+    await cache.put('a', '1')
+    assert sorted(await cache.keys()) == ['a']
+    await cache.put_many([('b', '2'), ('c', '3')])
+    await cache.delete_many(['a'])
+    assert sorted(await cache.keys()) == ['b', 'c']
+    assert CountingList.keys_calls == 1  # 只在第一次读
+
+
+asyncio.run(cached_keys())
+log("UpdateCache serves keys from memory")
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from simplarchiver import FilterFeeder
+from simplarchiver.example.file import FileFeeder, DirFeeder, WalkFeeder, ExtFilterFeeder, PathFilter, PathFilterFeeder
+
+logging.basicConfig(level=logging.INFO, format=' %(asctime)s | %(levelname)-8s | %(name)-26s | %(message)s')
+
+root = sys.argv[1] if len(sys.argv) > 1 else os.path.dirname(os.__file__)
+
+
+def log(msg):
+    logging.info('test_Walk | %s' % msg)
+
+
+def os_walk(files=True, dirs=False):
+    paths = set()
+    for top, ds, fs in os.walk(root):
+        if files:
+            paths.update(os.path.join(top, f) for f in fs)
+        if dirs:
+            paths.update(os.path.join(top, d) for d in ds)
+    return paths
+
+
+async def ticker(ticks: list):
+    """每1ms醒来一次，记下最长的一次间隔，看事件循环有没有被卡住"""
+    last = time.perf_counter()
+    while True:
+        await asyncio.sleep(0.001)
+        now = time.perf_counter()
+        ticks.append(now - last)
+        last = now
+
+
+async def main():
+    for feeder, files, dirs in [(FileFeeder(root), True, False), (DirFeeder(root), False, True),
+                                (WalkFeeder(root), True, True)]:
+        start = time.perf_counter()
+        expected = os_walk(files, dirs)
+        walk_time = time.perf_counter() - start
+        ticks = []
+        t = asyncio.create_task(ticker(ticks))
+        start = time.perf_counter()
+        got = [path async for path in feeder.get_feeds()]
+        feeder_time = time.perf_counter() - start
+        t.cancel()
+        assert set(got) == expected and len(got) == len(expected)
+        assert all(path.stat is not None for path in got)
+        log("%s: %d paths in %.3fs (os.walk %.3fs), longest event loop stall %.1fms" % (
+            feeder.__class__.__name__, len(got), feeder_time, walk_time, max(ticks, default=0) * 1000))
+    feeder = FileFeeder(root)
+    async for _ in feeder.get_feeds():
+        break  # 提前退出时扫描线程要能停下
+    log("stopped early")
+
+    for what, path_filter in [
+        ("extension .py", PathFilter(extensions=['.py'])),
+        ("glob + excluded dirs", PathFilter(globs=['*.py', '*.txt'], exclude_dirs=['__pycache__', 'test*'])),
+        ("size range", PathFilter(min_size=1024, max_size=64 * 1024))]:
+        start = time.perf_counter()
+        expected = [path async for path in FilterFeeder(FileFeeder(root), path_filter).get_feeds() if path is not None]
+        filter_time = time.perf_counter() - start
+        start = time.perf_counter()
+        got = [path async for path in PathFilterFeeder(FileFeeder(root), path_filter).get_feeds()]
+        pushdown_time = time.perf_counter() - start
+        assert set(got) == set(expected) and len(got) == len(expected)
+        log("%s: %d files, FilterFeeder %.3fs, pushed down into Walker %.3fs" % (
+            what, len(got), filter_time, pushdown_time))
+    assert isinstance(ExtFilterFeeder(FileFeeder(root), '.py'), FileFeeder)
+    base = FileFeeder(root)
+    py = PathFilterFeeder(base, PathFilter(extensions=['.py']))
+    txt = PathFilterFeeder(base, PathFilter(extensions=['.txt']))
+    assert py is not base and txt is not base
+    assert len([path async for path in base.get_feeds()]) == len([path async for path in FileFeeder(root).get_feeds()])
+    assert len([path async for path in txt.get_feeds()]) == len(
+        [path async for path in FilterFeeder(FileFeeder(root), PathFilter(extensions=['.txt'])).get_feeds() if path is not None])
+    log("PathFilterFeeder leaves base feeder unchanged")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'build', 'src')  # 根文件夹上面有个build
+        for name in [('keep', 'a.txt'), ('keep', 'build.log'), ('other', 'b.txt'), ('build', 'c.txt')]:
+            os.makedirs(os.path.join(src, name[0]), exist_ok=True)
+            with open(os.path.join(src, *name), 'w') as f:
+                f.write('x')
+        for path_filter, names in [
+            (PathFilter(exclude_dirs=['build']), ['keep/a.txt', 'keep/build.log', 'other/b.txt']),
+            (PathFilter(globs=['*build*']), ['keep/build.log']),  # 不带分隔符的只和文件名匹配
+            (PathFilter(globs=['*/keep/*']), ['keep/a.txt', 'keep/build.log'])]:  # 带分隔符的和完整路径匹配
+            expected = sorted(os.path.join(src, *n.split('/')) for n in names)
+            got = sorted([path async for path in PathFilterFeeder(FileFeeder(src), path_filter).get_feeds()])
+            assert got == expected, got
+            got = sorted([path async for path in FilterFeeder(FileFeeder(src), path_filter).get_feeds()
+                          if path is not None])
+            assert got == expected, got
+        path = os.path.join(src, 'keep', 'a.txt')
+        assert await PathFilter(exclude_dirs=['build']).filter(path) is None  # 不知道根文件夹就一直看到/
+        assert await PathFilter(exclude_dirs=['build'], root=src).filter(path) == path
+    log("PathFilter globs and excluded dirs agree with and without pushdown")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(20):
+            os.makedirs(os.path.join(tmp, 'tree', str(i % 4), str(i)), exist_ok=True)
+            with open(os.path.join(tmp, 'tree', str(i % 4), str(i), 'file'), 'w') as f:
+                f.write('x')
+        snapshot = os.path.join(tmp, 'snapshot.json.gz')
+        for trust in [False, True]:
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
+
+            async def scan(what, expected, commit=True):
+                feeder = FileFeeder(os.path.join(tmp, 'tree'), snapshot_path=snapshot, trust_dir_mtime=trust)
+                got = [path async for path in feeder.get_feeds()]
+                if commit:
+                    await feeder.cycle_end()
+                log("incremental(trust_dir_mtime=%s) %s: %d files" % (trust, what, len(got)))
+                assert len(got) == expected, got
+
+            await scan("first scan", 20)
+            await scan("nothing changed", 0)
+            with open(os.path.join(tmp, 'tree', '1', '5', 'new'), 'w') as f:
+                f.write('x')
+            await scan("a file added, cycle not finished", 1, commit=False)
+            await scan("a file added", 1)
+            time.sleep(0.01)
+            with open(os.path.join(tmp, 'tree', '1', '5', 'file'), 'a') as f:
+                f.write('x')
+            await scan("a file modified in place", 0 if trust else 1)  # 文件夹的mtime不变，信任它就看不到
+            os.remove(os.path.join(tmp, 'tree', '1', '5', 'new'))
+        for trust in [False, True]:
+            snapshot = os.path.join(tmp, 'root.json.gz')
+            for what in ["first scan", "rescan"]:
+                start = time.perf_counter()
+                feeder = FileFeeder(root, snapshot_path=snapshot, trust_dir_mtime=trust)
+                n = len([path async for path in feeder.get_feeds()])
+                await feeder.cycle_end()
+                log("incremental(trust_dir_mtime=%s) %s of %s: %d files in %.3fs" % (
+                    trust, what, root, n, time.perf_counter() - start))
+                assert n == (len(os_walk()) if what == "first scan" else 0), n
+            os.remove(snapshot)
+
+
+asyncio.run(main())
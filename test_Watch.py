@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+from simplarchiver.example.file import WatchFeeder
+
+logging.basicConfig(level=logging.INFO, format=' %(asctime)s | %(levelname)-8s | %(name)-26s | %(message)s')
+
+
+def log(msg):
+    logging.info('test_Watch | %s' % msg)
+
+
+async def touch(path, times=1):
+    for _ in range(times):
+        with open(path, 'a') as f:
+            f.write('x')
+        await asyncio.sleep(0.05)
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'root')
+        os.makedirs(os.path.join(root, 'a', 'b'))
+        with open(os.path.join(root, 'old'), 'w') as f:
+            f.write('x')
+        feeder = WatchFeeder(root, debounce=timedelta(seconds=0.3), duration=timedelta(seconds=2))
+        feeder.setTag('test_Watch')
+        got = []
+
+        async def collect():
+            async for path in feeder.get_feeds():
+                log("got %s" % path)
+                got.append(path)
+
+        t = asyncio.create_task(collect())
+        await asyncio.sleep(0.2)
+        await touch(os.path.join(root, 'a', 'b', 'written'), 5)  # 写了5次，只返回一次
+        os.makedirs(os.path.join(tmp, 'outside', 'sub'))
+        await touch(os.path.join(tmp, 'outside', 'sub', 'moved'))
+        shutil.move(os.path.join(tmp, 'outside'), os.path.join(root, 'a', 'moved_in'))  # 移进来的文件夹
+        await asyncio.sleep(0.1)
+        await touch(os.path.join(root, 'a', 'moved_in', 'sub', 'later'))  # 移进来的文件夹也要被监视
+        await touch(os.path.join(root, 'deleted'))
+        os.remove(os.path.join(root, 'deleted'))  # 安静下来之前就被删了，不返回
+        await t
+        expected = [os.path.join(root, 'a', 'b', 'written'),
+                    os.path.join(root, 'a', 'moved_in', 'sub', 'moved'),
+                    os.path.join(root, 'a', 'moved_in', 'sub', 'later')]
+        assert sorted(got) == sorted(expected), got
+        log("ok, %d paths" % len(got))
+
+        got = []
+        feeder = WatchFeeder(root, debounce=timedelta(seconds=0.5), duration=timedelta(seconds=1))
+        t = asyncio.create_task(collect())
+        await asyncio.sleep(0.7)
+        await touch(os.path.join(root, 'late'))  # 这一轮结束时还没安静下来
+        await t
+        assert got == [], got
+        await collect()  # 下一轮接着等它安静下来
+        assert got == [os.path.join(root, 'late')], got
+        log("ok, pending path carried over to next round")
+
+        got = []
+        await touch(os.path.join(root, 'a', 'between'))  # 两轮之间的变化
+        os.makedirs(os.path.join(root, 'new_dir'))
+        await touch(os.path.join(root, 'new_dir', 'inside'))
+        await asyncio.sleep(0.6)
+        await collect()  # 下一轮要返回它们
+        assert sorted(got) == sorted([os.path.join(root, 'a', 'between'),
+                                      os.path.join(root, 'new_dir', 'inside')]), got
+        log("ok, changes between rounds are fed in the next round")
+        feeder.close()
+
+
+asyncio.run(main())